@@ -0,0 +1,148 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+In-memory stand-ins for the Kafka, Redis and MinIO clients. They keep only
+byte counts so long benchmarks don't grow memory.
+"""
+
+
+class FakeKafkaMessage:
+    """
+    The parts of confluent_kafka.Message a delivery callback reads
+    """
+
+    def __init__(self, topic, partition):
+        self._topic = topic
+        self._partition = partition
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+
+class FakeKafkaProducer:
+    """
+    Mimics confluent_kafka.Producer: delivery is reported on the next poll
+    """
+
+    def __init__(self, config=None):
+        self.config = config
+        self.messages = 0
+        self.bytes = 0
+        self._undelivered = []
+
+    def produce(self, topic, key=None, value=None, on_delivery=None, **kwargs):
+        self.messages += 1
+        self.bytes += len(value)
+        message = FakeKafkaMessage(topic, kwargs.get('partition', 0))
+        self._undelivered.append((on_delivery, message))
+
+    def poll(self, timeout=None):
+        delivered = self._undelivered
+        self._undelivered = []
+        for on_delivery, message in delivered:
+            if on_delivery:
+                on_delivery(None, message)
+        return len(delivered)
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+
+class FakeRedisPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        self.commands.append((name, fields))
+
+    def execute(self):
+        for name, fields in self.commands:
+            self.client.xadd(name, fields)
+        self.commands = []
+
+
+class FakeRedis:
+    """
+    Mimics the parts of redis.Redis used by RedisMessaging
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.streams = {}
+        self.bytes = 0
+        self.hashes = {}
+
+    def ping(self):
+        return True
+
+    def xlen(self, name):
+        # Consumers are assumed to keep up, so streams never look full
+        return 0
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        self.streams[name] = self.streams.get(name, 0) + 1
+        self.bytes += len(fields['data'])
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        self.hashes[name] = mapping
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeMinio:
+    """
+    Mimics the parts of minio.Minio used by ObjectStoreManager
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.objects = {}
+
+    def bucket_exists(self, bucket):
+        return True
+
+    def make_bucket(self, bucket):
+        pass
+
+    def put_object(self, bucket_name, object_name, data, length, part_size=None,
+                   num_parallel_uploads=None):
+        size = 0
+        while True:
+            part = data.read(part_size)
+            if not part:
+                break
+            size += len(part)
+        self.objects[(bucket_name, object_name)] = size
+
+    def fput_object(self, bucket_name, object_name, file_path, num_parallel_uploads=None):
+        import os
+        self.objects[(bucket_name, object_name)] = os.path.getsize(file_path)
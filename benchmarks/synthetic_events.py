@@ -0,0 +1,117 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import numpy
+
+
+def synthetic_attr_names(collections, n_attributes):
+    """
+    :param collections: Dict of mean multiplicity keyed by collection name
+    :param n_attributes: Number of attributes to read from each collection
+    :return: attr_name_list in the form Collection.attrN()
+    """
+    return [collection + '.attr' + str(i) + '()'
+            for collection in sorted(collections)
+            for i in range(n_attributes)]
+
+
+class SyntheticXAODEvents:
+    """
+    Stand-in for XAODEvents that makes up events instead of reading an xAOD
+    file, so the transform can be measured without ROOT or an ATLAS release.
+    Multiplicities are Poisson distributed around the mean for each
+    collection. The same seed always gives the same events.
+    """
+
+    def __init__(self, n_events, collections, n_attributes, seed=1234):
+        """
+        :param n_events: Number of events in the fake file
+        :param collections: Dict of mean multiplicity keyed by collection name
+        :param n_attributes: Number of attributes read from each collection
+        :param seed: Random seed
+        """
+        self.n_events = n_events
+        self.collections = collections
+        self.n_attributes = n_attributes
+        self.seed = seed
+        self.attr_name_list = synthetic_attr_names(collections, n_attributes)
+
+        self.entry_start = 0
+        self.entry_stop = None
+
+    def get_entry_count(self):
+        return self.n_events
+
+    def _entry_range(self, event_limit):
+        entry_stop = self.n_events
+        if self.entry_stop is not None:
+            entry_stop = min(entry_stop, self.entry_stop)
+        if event_limit:
+            entry_stop = min(entry_stop, self.entry_start + event_limit)
+        return self.entry_start, entry_stop
+
+    def _make_chunk(self, random, n_chunk):
+        chunk = {}
+        for collection, multiplicity in self.collections.items():
+            counts = random.poisson(multiplicity, n_chunk).astype(numpy.int32)
+            offsets = numpy.zeros(n_chunk + 1, dtype=numpy.int32)
+            numpy.cumsum(counts, out=offsets[1:])
+            chunk[collection] = {
+                'offsets': offsets,
+                'content': dict(('attr' + str(i) + '()', random.standard_normal(offsets[-1]))
+                                for i in range(self.n_attributes))
+            }
+        return chunk
+
+    def iterate_columnar(self, chunk_size, event_limit=None):
+        random = numpy.random.RandomState(self.seed)
+        entry_start, entry_stop = self._entry_range(event_limit)
+
+        chunk_start = entry_start
+        while chunk_start < entry_stop:
+            next_chunk_size = chunk_size() if callable(chunk_size) else chunk_size
+            chunk_stop = min(chunk_start + next_chunk_size, entry_stop)
+            yield self._make_chunk(random, chunk_stop - chunk_start)
+            chunk_start = chunk_stop
+
+    def iterate(self, event_limit=None):
+        """
+        Events as lists of per-particle dicts, like XAODEvents.iterate
+        """
+        for chunk in self.iterate_columnar(1000, event_limit):
+            n_chunk = len(next(iter(chunk.values()))['offsets']) - 1
+            for i in range(n_chunk):
+                event = {}
+                for collection, columns in chunk.items():
+                    begin = columns['offsets'][i]
+                    end = columns['offsets'][i + 1]
+                    event[collection] = [
+                        dict((a_name, float(values[j]))
+                             for a_name, values in columns['content'].items())
+                        for j in range(begin, end)
+                    ]
+                yield event
@@ -0,0 +1,337 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Measure the transform without an ATLAS release: events come from
+SyntheticXAODEvents and results go to in-memory fakes of Kafka, Redis and
+MinIO. Each stage reports throughput, bytes per event and peak RSS.
+
+    python -m benchmarks.transform_benchmark --events 100000 \
+        --collections Electrons:3,Muons:2,Jets:8 --attributes 4
+
+Results are written to benchmarks/results/<git revision>.json. Compare
+revisions with
+
+    python -m benchmarks.transform_benchmark --compare <rev> <rev> ...
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import pyarrow as pa
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from benchmarks.fakes import FakeKafkaProducer, FakeMinio, FakeRedis
+from benchmarks.synthetic_events import SyntheticXAODEvents
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+STAGES = ['generate', 'arrow_table', 'convert', 'serialize',
+          'publish-kafka', 'publish-redis', 'upload-minio']
+
+
+class RSSSampler:
+    """
+    Sample resident set size in a background thread to find the peak reached
+    during a stage. Falls back to ru_maxrss, the peak for the whole process,
+    where /proc is not available.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        except (IOError, OSError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def measure(name, n_events, fn):
+    """
+    Run one stage
+    :param name: Stage name
+    :param n_events: Events processed by the stage
+    :param fn: Does the work and returns (output, bytes produced)
+    :return: Tuple of stage output and a dict of measurements
+    """
+    with RSSSampler() as sampler:
+        start = time.time()
+        output, n_bytes = fn()
+        elapsed = time.time() - start
+
+    result = {
+        'stage': name,
+        'events': n_events,
+        'seconds': elapsed,
+        'events_per_second': n_events / elapsed if elapsed else None,
+        'bytes': n_bytes,
+        'bytes_per_event': n_bytes / n_events if n_events else None,
+        'peak_rss_mb': sampler.peak / 1e6
+    }
+    print("%-14s %10.3f s %12.0f events/s %10.1f bytes/event %8.1f MB peak RSS" % (
+        name, elapsed, result['events_per_second'] or 0,
+        result['bytes_per_event'] or 0, result['peak_rss_mb']))
+    return output, result
+
+
+def batches_nbytes(batches):
+    return sum(column.buffers()[i].size
+               for batch in batches
+               for column in batch.columns
+               for i in range(len(column.buffers()))
+               if column.buffers()[i] is not None)
+
+
+def run_benchmark(args):
+    from servicex.transformer.serialization import BatchSerializer
+    from servicex.transformer.xaod_transformer import XAODTransformer
+
+    collections = dict((name, float(multiplicity)) for name, multiplicity in
+                       (item.split(':') for item in args.collections.split(',')))
+    events = SyntheticXAODEvents(args.events, collections, args.attributes,
+                                 seed=args.seed)
+    transformer = XAODTransformer(events)
+    stages = args.stages.split(',')
+    results = []
+
+    def generate():
+        chunks = list(events.iterate_columnar(args.chunks))
+        return chunks, sum(values.nbytes
+                           for chunk in chunks for columns in chunk.values()
+                           for values in list(columns['content'].values()) +
+                           [columns['offsets']])
+
+    chunks, result = measure('generate', args.events, generate)
+    if 'generate' in stages:
+        results.append(result)
+
+    if 'arrow_table' in stages:
+        def legacy():
+            tables = list(transformer.arrow_table(args.chunks, args.events))
+            return None, sum(batches_nbytes(table.to_batches()) for table in tables)
+        results.append(measure('arrow_table', args.events, legacy)[1])
+
+    def convert():
+        batches = [transformer.record_batch(chunk) for chunk in chunks]
+        return batches, batches_nbytes(batches)
+
+    batches, result = measure('convert', args.events, convert)
+    if 'convert' in stages:
+        results.append(result)
+    # Let the raw chunks go so they don't inflate RSS in later stages
+    chunks = None
+
+    serializer = BatchSerializer(args.message_format)
+
+    def serialize():
+        buffers = [serializer.serialize(batch) for batch in batches]
+        return buffers, sum(buffer.size for buffer in buffers)
+
+    buffers, result = measure('serialize', args.events, serialize)
+    if 'serialize' in stages:
+        results.append(result)
+    n_bytes = result['bytes']
+
+    if 'publish-kafka' in stages:
+        # KafkaMessaging imports confluent_kafka lazily, so a fake module is enough
+        fake_module = mock.MagicMock(Producer=FakeKafkaProducer)
+        with mock.patch.dict(sys.modules, {'confluent_kafka': fake_module}):
+            from servicex.transformer.kafka_messaging import KafkaMessaging
+            messaging = KafkaMessaging(None, async_publish=True)
+
+        def publish_kafka():
+            for i, buffer in enumerate(buffers):
+                messaging.publish_message('benchmark', i, buffer)
+            messaging.flush()
+            return None, messaging.producer.bytes
+        results.append(measure('publish-kafka', args.events, publish_kafka)[1])
+
+    if 'publish-redis' in stages:
+        with mock.patch('redis.Redis', FakeRedis):
+            from servicex.transformer.redis_messaging import RedisMessaging
+            messaging = RedisMessaging(shards=args.redis_shards)
+            messaging.set_redis_client()
+
+        def publish_redis():
+            for i, buffer in enumerate(buffers):
+                messaging.publish_message('benchmark', i, buffer)
+            messaging.flush()
+            return None, sum(client.bytes for client in messaging.clients)
+        results.append(measure('publish-redis', args.events, publish_redis)[1])
+
+    if 'upload-minio' in stages:
+        with mock.patch('minio.Minio', FakeMinio):
+            from servicex.transformer.object_store_manager import ObjectStoreManager
+            object_store = ObjectStoreManager('localhost:9000', 'minio', 'minio')
+
+        def upload_minio():
+            stream = object_store.open_upload_stream('benchmark', 'benchmark.arrow')
+            writer = pa.RecordBatchStreamWriter(pa.PythonFile(stream, mode='w'),
+                                                transformer.schema)
+            for batch in batches:
+                writer.write_batch(batch)
+            writer.close()
+            stream.finish().result()
+            object_store.shutdown()
+            return None, object_store.minio_client.objects[('benchmark', 'benchmark.arrow')]
+        results.append(measure('upload-minio', args.events, upload_minio)[1])
+
+    return {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'config': {
+            'events': args.events,
+            'collections': collections,
+            'attributes': args.attributes,
+            'chunks': args.chunks,
+            'seed': args.seed,
+            'message_format': args.message_format,
+            'serialized_bytes': n_bytes
+        },
+        'stages': results
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=os.path.dirname(RESULTS_DIR))
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+                                cwd=os.path.dirname(RESULTS_DIR))
+        return revision.decode().strip() + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, results_dir=RESULTS_DIR):
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    path = os.path.join(results_dir, results['revision'] + '.json')
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    print("Results written to", path)
+    return path
+
+
+def compare(revisions, results_dir=RESULTS_DIR):
+    """
+    Print events per second and peak RSS for each stage side by side
+    """
+    runs = []
+    for revision in revisions:
+        with open(os.path.join(results_dir, revision + '.json')) as results_file:
+            runs.append(json.load(results_file))
+
+    print("%-14s" % 'stage' + ''.join("%24s" % run['revision'] for run in runs))
+    for stage in STAGES:
+        cells = []
+        for run in runs:
+            matches = [result for result in run['stages'] if result['stage'] == stage]
+            if matches:
+                cells.append("%12.0f/s %7.1fMB" % (
+                    matches[0]['events_per_second'] or 0, matches[0]['peak_rss_mb']))
+            else:
+                cells.append("%24s" % '-')
+        print("%-14s" % stage + ''.join("%24s" % cell for cell in cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the transform with synthetic events')
+    parser.add_argument('--events', type=int, default=100000,
+                        help='Number of synthetic events')
+    parser.add_argument('--collections', default='Electrons:3,Muons:2,Jets:8',
+                        help='Comma separated collection:mean multiplicity pairs')
+    parser.add_argument('--attributes', type=int, default=4,
+                        help='Attributes read from each collection')
+    parser.add_argument('--chunks', type=int, default=5000,
+                        help='Events per batch')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Random seed for the synthetic events')
+    parser.add_argument('--message-format', default='arrow',
+                        help='Format batches are serialized to: arrow, arrow-lz4, '
+                             'arrow-zstd or parquet')
+    parser.add_argument('--redis-shards', type=int, default=1,
+                        help='Streams to shard Redis output over')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='Comma separated stages to report')
+    parser.add_argument('--results-dir', default=RESULTS_DIR,
+                        help='Directory results are stored in')
+    parser.add_argument('--no-save', action='store_true',
+                        help="Don't store the results")
+    parser.add_argument('--compare', nargs='+', metavar='REVISION',
+                        help='Compare stored results instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare, args.results_dir)
+        return
+
+    results = run_benchmark(args)
+    if not args.no_save:
+        save_results(results, args.results_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import ast
+import numbers
+import operator
+import re
+from collections import OrderedDict
+
+import pyarrow as pa
+
+
+def _split_top_level(expression, separator):
+    """
+    Split on separator, ignoring it inside arguments and string literals
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(expression):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(expression[start:i])
+            start = i + 1
+    parts.append(expression[start:])
+    return parts
+
+
+def _split_calls(expression):
+    """
+    Split an accessor chain on the dots that separate calls, ignoring dots
+    inside arguments such as isolation(0.4)
+    """
+    return _split_top_level(expression, '.')
+
+
+def split_attr_names(text):
+    """
+    Split a comma separated list of attributes, keeping the commas between
+    arguments such as Electrons.isolation(0.4, 1) inside their attribute
+    :param text: Attributes separated by commas
+    :return: List of attribute names
+    """
+    return [attr_name.strip() for attr_name in _split_top_level(text, ',')
+            if attr_name.strip()]
+
+
+_CALL = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:\((.*)\))?\s*$', re.DOTALL)
+
+
+def _parse_call(text, attr_name):
+    match = _CALL.match(text)
+    if not match:
+        raise ValueError("Invalid accessor " + repr(text) + " in " + repr(attr_name))
+
+    method_name, arg_text = match.groups()
+    args = ()
+    if arg_text and arg_text.strip():
+        try:
+            args = ast.literal_eval('(' + arg_text + ',)')
+        except (ValueError, SyntaxError):
+            raise ValueError("Arguments of " + method_name + " in " + repr(attr_name) +
+                             " must be literals")
+    return method_name, args
+
+
+def _column_part(method_name, args):
+    return '_'.join([method_name] + [re.sub(r'\W+', '_', str(arg)).strip('_') for arg in args])
+
+
+class Accessor:
+    """
+    One attribute read from every particle of a collection, such as
+    Electrons.pt() or Electrons.trackParticle().pt()
+    """
+
+    def __init__(self, attr_name):
+        """
+        :param attr_name: Collection name followed by a chain of method calls
+        """
+        self.attr_name = str(attr_name)
+        parts = _split_calls(self.attr_name)
+        if len(parts) < 2 or not parts[0].strip():
+            raise ValueError("Invalid attribute " + repr(self.attr_name) +
+                             ", expected Collection.method()")
+
+        self.collection = parts[0].strip(' ')
+
+        # Key of the attribute in the per-particle dicts and content buffers
+        self.key = self.attr_name[len(parts[0]) + 1:]
+
+        self.calls = [_parse_call(part, self.attr_name) for part in parts[1:]]
+        self.column_name = self.collection + '_' + '_'.join(
+            _column_part(method_name, args) for method_name, args in self.calls)
+
+        # Arrow type of the values, set from the first value read
+        self.arrow_type = None
+
+        # Bind the calls once. A single call, the common case, goes straight
+        # to the C implemented methodcaller
+        callers = [operator.methodcaller(method_name, *args)
+                   for method_name, args in self.calls]
+        if len(callers) == 1:
+            self.read = callers[0]
+        else:
+            def read(particle):
+                for caller in callers:
+                    particle = caller(particle)
+                return particle
+            self.read = read
+
+    def __call__(self, particle):
+        return self.read(particle)
+
+    def infer_type(self, value):
+        """
+        Set the Arrow type from a value read by this accessor, if not known yet
+        :param value: Value returned for one particle
+        """
+        if self.arrow_type is None:
+            if isinstance(value, bool):
+                self.arrow_type = pa.bool_()
+            elif isinstance(value, numbers.Integral):
+                self.arrow_type = pa.int64()
+            else:
+                self.arrow_type = pa.float64()
+
+    @property
+    def dtype(self):
+        """
+        numpy dtype of the content buffer, float64 until the type is known
+        """
+        return (self.arrow_type or pa.float64()).to_pandas_dtype()
+
+    def __repr__(self):
+        return 'Accessor(' + repr(self.attr_name) + ')'
+
+
+class AccessorPlan:
+    """
+    attr_name_list parsed once into accessors grouped by collection, with
+    the output column names and Arrow schema
+    """
+
+    def __init__(self, attr_name_list):
+        # A repeated attribute shares its accessor, so it is read and typed once
+        unique = {}
+        self.accessors = []
+        for attr_name in attr_name_list:
+            accessor = Accessor(attr_name)
+            accessor = unique.setdefault((accessor.collection, accessor.key), accessor)
+            self.accessors.append(accessor)
+
+        # Accessors to evaluate per collection, without duplicates
+        self.collections = OrderedDict()
+        for accessor in self.accessors:
+            accessors = self.collections.setdefault(accessor.collection, [])
+            if accessor not in accessors:
+                accessors.append(accessor)
+
+    @property
+    def schema(self):
+        """
+        Arrow schema of the columns. Attributes not read yet are fixed as
+        float64 from here on, so every batch of a file has the same schema
+        """
+        for accessor in self.accessors:
+            if accessor.arrow_type is None:
+                accessor.arrow_type = pa.float64()
+        return pa.schema([pa.field(accessor.column_name, pa.list_(accessor.arrow_type))
+                          for accessor in self.accessors])
+
+    def branch_dict(self):
+        """
+        :return: Dict of attribute keys to read, keyed by collection name
+        """
+        return OrderedDict((collection, [accessor.key for accessor in accessors])
+                           for collection, accessors in self.collections.items())
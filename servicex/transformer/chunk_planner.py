@@ -0,0 +1,105 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+class ChunkPlanner:
+    """
+    Pick the number of events for each chunk so that serialized batches come
+    out close to, but under, the maximum message size.
+    """
+
+    def __init__(self, max_message_size, initial_chunk_size=None, adaptive=True,
+                 fill_fraction=0.9, min_chunk_size=1, max_chunk_size=1000000):
+        """
+        :param max_message_size: Largest allowed serialized batch, in bytes
+        :param initial_chunk_size: Events in the first chunk. Defaults to a
+            small probe chunk when adaptive
+        :param adaptive: If False the chunk size is left at initial_chunk_size
+            and only oversized batches are split
+        :param fill_fraction: Fraction of max_message_size to aim for
+        :param min_chunk_size: Lower bound on the planned chunk size
+        :param max_chunk_size: Upper bound on the planned chunk size
+        """
+        self.max_message_size = max_message_size
+        self.adaptive = adaptive
+        self.fill_fraction = fill_fraction
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.chunk_size = initial_chunk_size or 100
+
+        self.total_events = 0
+        self.total_bytes = 0
+        self.num_splits = 0
+
+    @property
+    def bytes_per_event(self):
+        if not self.total_events:
+            return None
+        return float(self.total_bytes) / self.total_events
+
+    def next_chunk_size(self):
+        return self.chunk_size
+
+    def record(self, num_rows, num_bytes):
+        """
+        Learn from a batch that has been serialized and will be published
+        :param num_rows: Events in the batch
+        :param num_bytes: Serialized size of the batch
+        """
+        self.total_events += num_rows
+        self.total_bytes += num_bytes
+
+        if self.adaptive and self.bytes_per_event:
+            target = self.fill_fraction * self.max_message_size / self.bytes_per_event
+            self.chunk_size = int(min(max(target, self.min_chunk_size),
+                                      self.max_chunk_size))
+
+    def fit(self, batch, serialize, release=None):
+        """
+        Serialize a batch, bisecting it by rows until every piece fits in
+        max_message_size
+        :param batch: pyarrow RecordBatch
+        :param serialize: Function returning the serialized pa.Buffer of a batch
+        :param release: Called with each buffer that is too big and dropped
+        :return: Yields (batch, buffer) pairs in row order
+        """
+        buffer = serialize(batch)
+        if buffer.size <= self.max_message_size or batch.num_rows <= 1:
+            if buffer.size > self.max_message_size:
+                print("Single event of " + str(buffer.size) +
+                      " bytes exceeds max message size")
+            self.record(batch.num_rows, buffer.size)
+            yield batch, buffer
+        else:
+            self.num_splits += 1
+            if release:
+                release(buffer)
+            half = batch.num_rows // 2
+            for piece in (batch.slice(0, half), batch.slice(half)):
+                for result in self.fit(piece, serialize, release):
+                    yield result
@@ -0,0 +1,83 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import bz2
+
+
+class Codec:
+    """
+    Compression codec applied to message payloads. The name is recorded with
+    each message so consumers know how to decode it.
+    """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _lz4_codec():
+    import lz4.frame
+    return Codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+
+def _zstd_codec():
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=3)
+    decompressor = zstandard.ZstdDecompressor()
+    return Codec('zstd', compressor.compress, decompressor.decompress)
+
+
+def _bz2_codec():
+    return Codec('bz2', bz2.compress, bz2.decompress)
+
+
+def _no_codec():
+    return Codec('none', memoryview, bytes)
+
+
+_codecs = {
+    'none': _no_codec,
+    'lz4': _lz4_codec,
+    'zstd': _zstd_codec,
+    'bz2': _bz2_codec
+}
+
+
+def codec_names():
+    return sorted(_codecs.keys())
+
+
+def get_codec(name):
+    """
+    :param name: One of none, lz4, zstd or bz2
+    :return: Codec. The compression library is only imported when asked for
+    """
+    if name not in _codecs:
+        raise ValueError("Unknown codec " + str(name) + ", choose from " +
+                         ", ".join(codec_names()))
+    return _codecs[name]()
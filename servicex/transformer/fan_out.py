@@ -0,0 +1,210 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Marks the end of the items sent to a sink
+_END = object()
+
+
+class SinkError(Exception):
+    """
+    A sink failed. Raised once the other sinks have finished, with the
+    report of every sink
+    """
+
+    def __init__(self, message, report):
+        Exception.__init__(self, message)
+        self.report = report
+
+
+class Sink:
+    """
+    A result destination, fed from its own bounded queue by its own thread,
+    so a slow destination falls behind by up to queue_depth items without
+    holding up the others.
+
+    After a failure the sink discards the rest of its items, so the other
+    sinks can still finish.
+    """
+
+    def __init__(self, name, publish, finish=None, queue_depth=4):
+        """
+        :param name: Name the sink is reported under
+        :param publish: Called with each item. Returns (messages, bytes) sent
+        :param finish: Called once every item has been published, to flush
+            or close the destination. May return (messages, bytes) it sent
+        :param queue_depth: Most items waiting to be published
+        """
+        self.name = name
+        self.publish = publish
+        self.finish = finish
+
+        self.messages = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.stall_time = 0.0
+        self.error = None
+
+        self._aborted = False
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._thread = None
+
+    def start(self, on_done):
+        self._thread = threading.Thread(target=self._run, name='sink-' + self.name,
+                                        args=(on_done,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, delivery):
+        start = time.time()
+        self._queue.put(delivery)
+        self.stall_time += time.time() - start
+
+    def join(self, abort=False):
+        self._aborted = abort
+        self._queue.put(_END)
+        self._thread.join()
+
+    def _fail(self, error):
+        print("Publishing to " + self.name + " failed: " + str(error))
+        self.error = error
+
+    def _run(self, on_done):
+        while True:
+            delivery = self._queue.get()
+            if delivery is _END:
+                break
+
+            if self.error is None and not self._aborted:
+                start = time.time()
+                try:
+                    messages, n_bytes = self.publish(delivery.item)
+                    self.messages += messages
+                    self.bytes += n_bytes
+                except Exception as error:
+                    self._fail(error)
+                self.busy_time += time.time() - start
+            on_done(delivery)
+
+        if self.finish and self.error is None and not self._aborted:
+            start = time.time()
+            try:
+                sent = self.finish()
+                if sent:
+                    self.messages += sent[0]
+                    self.bytes += sent[1]
+            except Exception as error:
+                self._fail(error)
+            self.busy_time += time.time() - start
+
+    def report(self):
+        report = {
+            "status": "failure" if self.error else "success",
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "busy-time": self.busy_time,
+            "stall-time": self.stall_time
+        }
+        if self.error:
+            report["error"] = str(self.error)
+        return report
+
+
+class _Delivery:
+    def __init__(self, item, n_sinks):
+        self.item = item
+        self.remaining = n_sinks
+
+
+class FanOut:
+    """
+    Send each item to every sink at the same time. Items are shared, not
+    copied, so once serialized a batch goes to every destination as is.
+    """
+
+    def __init__(self, sinks, on_done=None):
+        """
+        :param sinks: List of Sinks
+        :param on_done: Called with each item once every sink is done with it
+        """
+        self.sinks = sinks
+        self.on_done = on_done
+        self._lock = threading.Lock()
+
+        for sink in sinks:
+            sink.start(self._done)
+
+    def _done(self, delivery):
+        with self._lock:
+            delivery.remaining -= 1
+            last = delivery.remaining == 0
+        if last and self.on_done:
+            self.on_done(delivery.item)
+
+    def publish(self, item):
+        """
+        Queue an item for every sink. Blocks only while a sink's queue is full
+        """
+        if not self.sinks:
+            if self.on_done:
+                self.on_done(item)
+            return
+
+        delivery = _Delivery(item, len(self.sinks))
+        for sink in self.sinks:
+            sink.put(delivery)
+
+    def close(self, abort=False):
+        """
+        Wait for every sink to publish its queued items and finish
+        :param abort: Drop the queued items and don't finish, after the
+            transform failed
+        """
+        for sink in self.sinks:
+            sink.join(abort)
+
+    def check(self):
+        """
+        Raise a SinkError if any sink failed
+        """
+        for sink in self.sinks:
+            if sink.error is not None:
+                raise SinkError("Publishing to " + sink.name + " failed: " + str(sink.error),
+                                self.report())
+
+    def report(self):
+        """
+        :return: Dict of each sink's status, messages and bytes, keyed by name
+        """
+        return dict((sink.name, sink.report()) for sink in self.sinks)
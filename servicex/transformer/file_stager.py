@@ -0,0 +1,186 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def is_remote(path):
+    return '://' in path and not path.startswith('file://')
+
+
+def copy_file(source, destination):
+    """
+    Copy an input file to local disk. xrootd URLs are copied with xrdcp,
+    http URLs are streamed with requests
+    """
+    if source.startswith('root://'):
+        subprocess.check_call(['xrdcp', '--force', '--silent', source, destination])
+    elif source.startswith('http://') or source.startswith('https://'):
+        import requests
+        with requests.get(source, stream=True) as response:
+            response.raise_for_status()
+            with open(destination, 'wb') as local_file:
+                shutil.copyfileobj(response.raw, local_file, 1024 * 1024)
+    else:
+        raise IOError("Don't know how to copy " + source)
+
+
+class FileStager:
+    """
+    Copy upcoming input files to local scratch in the background, so the
+    transform reads from local disk instead of opening them remotely.
+    Staged files are kept until the disk budget is exceeded, then evicted
+    least recently used first. Files in use are never evicted.
+    """
+
+    def __init__(self, scratch_dir, max_bytes, workers=1, copy_function=copy_file):
+        """
+        :param scratch_dir: Local directory to stage files into
+        :param max_bytes: Disk budget for staged files
+        :param workers: Files copied at the same time
+        :param copy_function: Called with (source, destination) to copy a file
+        """
+        self.scratch_dir = scratch_dir
+        self.max_bytes = max_bytes
+        self.copy_function = copy_function
+
+        # Staged files in least recently used order: path -> [local path,
+        # size, users]. Files being copied have no local path yet
+        self._files = OrderedDict()
+        self._copies = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.staged_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+
+    def local_path(self, path):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.scratch_dir, name + '-' + os.path.basename(path))
+
+    def stage(self, path):
+        """
+        Start copying a file, unless it is local or already staged. The file
+        is kept until release is called
+        :return: Future resolving to the path the transform should open
+        """
+        if not is_remote(path):
+            future = Future()
+            future.set_result(path[len('file://'):] if path.startswith('file://') else path)
+            return future
+
+        with self._lock:
+            if path in self._files:
+                entry = self._files.pop(path)
+                entry[2] += 1
+                self._files[path] = entry
+                if path in self._copies:
+                    return self._copies[path]
+                self.hits += 1
+                future = Future()
+                future.set_result(entry[0])
+                return future
+
+            self.misses += 1
+            self._files[path] = [None, 0, 1]
+            future = self._executor.submit(self._copy, path)
+            self._copies[path] = future
+            return future
+
+    def _copy(self, path):
+        local_path = self.local_path(path)
+        try:
+            self.copy_function(path, local_path + '.part')
+            os.rename(local_path + '.part', local_path)
+        except Exception:
+            with self._lock:
+                self._files.pop(path, None)
+                self._copies.pop(path, None)
+            if os.path.exists(local_path + '.part'):
+                os.remove(local_path + '.part')
+            raise
+
+        size = os.path.getsize(local_path)
+        with self._lock:
+            entry = self._files[path]
+            entry[0] = local_path
+            entry[1] = size
+            self.staged_bytes += size
+            del self._copies[path]
+            self._evict()
+        print("Staged " + path + " to " + local_path + " (" + str(size) + " bytes)")
+        return local_path
+
+    def release(self, path):
+        """
+        The transform is done with the file. It stays staged until evicted
+        """
+        with self._lock:
+            entry = self._files.get(path)
+            if entry:
+                entry[2] -= 1
+                self._evict()
+
+    def _evict(self):
+        for path in list(self._files):
+            if self.staged_bytes <= self.max_bytes:
+                break
+            local_path, size, users = self._files[path]
+            if users > 0 or local_path is None:
+                continue
+            del self._files[path]
+            self.staged_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(local_path)
+            except OSError as ex:
+                print("Could not remove staged file " + local_path + ":", ex)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'staged-files': len(self._files),
+                'staged-bytes': self.staged_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -26,15 +26,63 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import sys
-from messaging import Messaging
-from kafka import KafkaProducer
+from functools import partial
+from servicex.transformer.messaging import Messaging
+
+PARTITIONERS = ['hash', 'round-robin', 'size-balanced']
 
 
 class KafkaMessaging(Messaging):
-    def __init__(self, brokers, max_message_size=15):
+    name = 'kafka'
+
+    def __init__(self, brokers, max_message_size=15, async_publish=False,
+                 compression=None, linger_ms=0, batch_size=16384,
+                 max_in_flight=1000, flush_timeout=300, partitioner='hash',
+                 topic_partitions=None, replication_factor=1):
+        """
+        :param brokers: List of Kafka brokers to connect to
+        :param max_message_size: Maximum size for any message in Megabytes
+        :param async_publish: Queue messages and return without waiting for
+            delivery. Call flush() to wait for the outstanding messages
+        :param compression: Producer compression codec: lz4, zstd, gzip or snappy
+        :param linger_ms: Time to wait for more messages before sending a batch
+        :param batch_size: Maximum producer batch size in bytes
+        :param max_in_flight: Most undelivered messages allowed in async mode
+            before publish_message blocks
+        :param flush_timeout: Seconds to wait for delivery in flush()
+        :param partitioner: How messages are spread over a topic's partitions:
+            hash leaves it to the producer's hash of the key, round-robin
+            takes each partition in turn and size-balanced picks the one
+            sent the fewest bytes so far
+        :param topic_partitions: Partitions each topic should have. Missing
+            topics are created, and existing ones grown, when the brokers
+            allow it. None to leave topics alone
+        :param replication_factor: Replicas of each created topic
+        """
+        if partitioner not in PARTITIONERS:
+            raise ValueError("Unknown partitioner " + str(partitioner) + ", choose from " +
+                             ", ".join(PARTITIONERS))
 
         print("Max Message size: " + str(max_message_size) + "Mb")
         self.max_message_size = max_message_size
+        self.async_publish = async_publish
+        self.max_in_flight = max_in_flight
+        self.flush_timeout = flush_timeout
+
+        self.partitioner = partitioner
+        self.topic_partitions = topic_partitions
+        self.replication_factor = replication_factor
+
+        self.in_flight = 0
+        self.delivery_errors = []
+
+        # Partitions of each topic published to, and the bytes sent to each
+        # partition: assigned for balancing, delivered for the report
+        self._partitions = {}
+        self._topics_ensured = set()
+        self._next_partition = {}
+        self._assigned_bytes = {}
+        self._delivered_bytes = {}
 
         if not brokers:
             self.brokers = ['servicex-kafka-0.slateci.net:19092',
@@ -47,23 +95,216 @@ class KafkaMessaging(Messaging):
         print('Configured Kafka backend')
 
         try:
-            self.producer = KafkaProducer(bootstrap_servers=self.brokers,
-                                          api_version=(0, 10),
-                                          max_request_size=int(max_message_size * 1e6))
+            if async_publish:
+                from confluent_kafka import Producer
+                self.producer = Producer({
+                    'bootstrap.servers': ','.join(self.brokers),
+                    'message.max.bytes': int(max_message_size * 1e6),
+                    'compression.type': compression or 'none',
+                    'linger.ms': linger_ms,
+                    'batch.size': batch_size
+                })
+            else:
+                from kafka import KafkaProducer
+                self.producer = KafkaProducer(bootstrap_servers=self.brokers,
+                                              api_version=(0, 11),
+                                              max_request_size=int(max_message_size * 1e6),
+                                              compression_type=compression,
+                                              linger_ms=linger_ms,
+                                              batch_size=batch_size)
             print("Kafka producer created successfully")
         except Exception as ex:
             print("Exception while getting Kafka producer", ex)
             sys.exit(1)
 
     def publish_message(self, topic_name, key, value_buffer):
+        partition = self._choose_partition(topic_name, value_buffer.size)
+        if self.async_publish:
+            return self._produce(topic_name, key, value_buffer, partition)
+
         try:
-            msg_bytes = value_buffer.to_pybytes()
-            self.producer.send(topic_name, key=str(key),
-                               value=msg_bytes)
+            future = self.producer.send(topic_name, key=str(key),
+                                        value=memoryview(value_buffer),
+                                        partition=partition,
+                                        headers=[('batch-key', str(key).encode('utf-8'))])
             self.producer.flush()
+            metadata = future.get()
+            self._count_delivery(topic_name, metadata.partition, value_buffer.size)
             print("Message published to ", topic_name, " successfully ",
-                  len(msg_bytes))
+                  value_buffer.size)
         except Exception as ex:
             print("Exception in publishing message", ex)
             raise
         return True
+
+    def _partitions_for(self, topic_name):
+        if topic_name not in self._partitions:
+            if self.topic_partitions and topic_name not in self._topics_ensured:
+                self._topics_ensured.add(topic_name)
+                self.ensure_topic(topic_name, self.topic_partitions)
+
+            # Metadata the producer fetches for itself anyway
+            try:
+                if self.async_publish:
+                    metadata = self.producer.list_topics(topic_name, timeout=30)
+                    topic = metadata.topics.get(topic_name)
+                    partitions = sorted(topic.partitions.keys()) \
+                        if topic and not topic.error else []
+                else:
+                    partitions = sorted(self.producer.partitions_for(topic_name) or [])
+            except Exception as ex:
+                print("Exception fetching the partitions of " + topic_name, ex)
+                partitions = []
+
+            # A topic that doesn't exist yet, as at warm up, is looked up
+            # again on the next publish
+            if not partitions:
+                return []
+            self._partitions[topic_name] = partitions
+        return self._partitions[topic_name]
+
+    def _choose_partition(self, topic_name, n_bytes):
+        """
+        :return: Partition to send a message of n_bytes to, or None to leave
+            it to the producer
+        """
+        if self.partitioner == 'hash':
+            return None
+
+        partitions = self._partitions_for(topic_name)
+        if not partitions:
+            return None
+
+        if self.partitioner == 'round-robin':
+            index = self._next_partition.get(topic_name, 0)
+            self._next_partition[topic_name] = (index + 1) % len(partitions)
+            partition = partitions[index % len(partitions)]
+        else:
+            assigned = self._assigned_bytes.setdefault(topic_name, {})
+            partition = min(partitions, key=lambda p: (assigned.get(p, 0), p))
+
+        assigned = self._assigned_bytes.setdefault(topic_name, {})
+        assigned[partition] = assigned.get(partition, 0) + n_bytes
+        return partition
+
+    def ensure_topic(self, topic_name, num_partitions):
+        """
+        Create the topic with num_partitions partitions, or add partitions
+        to an existing topic with fewer. Carries on with the topic as it is
+        when the brokers refuse
+        """
+        try:
+            if self.async_publish:
+                self._ensure_topic_confluent(topic_name, num_partitions)
+            else:
+                self._ensure_topic_kafka(topic_name, num_partitions)
+        except Exception as ex:
+            print("Could not create " + str(num_partitions) + " partitions for " +
+                  topic_name + ": " + str(ex))
+        self._partitions.pop(topic_name, None)
+
+    def _ensure_topic_confluent(self, topic_name, num_partitions):
+        from confluent_kafka.admin import AdminClient, NewPartitions, NewTopic
+        admin = AdminClient({'bootstrap.servers': ','.join(self.brokers)})
+
+        topic = admin.list_topics(topic_name, timeout=30).topics.get(topic_name)
+        if topic is None or topic.error:
+            futures = admin.create_topics([NewTopic(topic_name, num_partitions,
+                                                    self.replication_factor)])
+            futures[topic_name].result()
+            print("Created topic " + topic_name + " with " + str(num_partitions) +
+                  " partitions")
+        elif len(topic.partitions) < num_partitions:
+            futures = admin.create_partitions([NewPartitions(topic_name, num_partitions)])
+            futures[topic_name].result()
+            print("Grew topic " + topic_name + " to " + str(num_partitions) + " partitions")
+
+    def _ensure_topic_kafka(self, topic_name, num_partitions):
+        from kafka.admin import KafkaAdminClient, NewPartitions, NewTopic
+        admin = KafkaAdminClient(bootstrap_servers=self.brokers)
+        try:
+            partitions = self.producer.partitions_for(topic_name)
+            if not partitions:
+                admin.create_topics([NewTopic(topic_name, num_partitions,
+                                              self.replication_factor)])
+                print("Created topic " + topic_name + " with " + str(num_partitions) +
+                      " partitions")
+            elif len(partitions) < num_partitions:
+                admin.create_partitions({topic_name: NewPartitions(num_partitions)})
+                print("Grew topic " + topic_name + " to " + str(num_partitions) +
+                      " partitions")
+        finally:
+            admin.close()
+
+    def _produce(self, topic_name, key, value_buffer, partition=None):
+        # Serve delivery callbacks until there is room in the in-flight window
+        while self.in_flight >= self.max_in_flight:
+            self.producer.poll(1.0)
+
+        # Keys still name the batch when the partition is picked for them, and
+        # are copied to a header so consumers can order batches. The sync
+        # producer sends the same header
+        options = {'headers': [('batch-key', str(key))]}
+        if partition is not None:
+            options['partition'] = partition
+
+        # The producer copies the payload into its own queue, straight out of
+        # the buffer
+        while True:
+            try:
+                self.producer.produce(topic_name, key=str(key), value=value_buffer,
+                                      on_delivery=partial(self._on_delivery,
+                                                          n_bytes=value_buffer.size),
+                                      **options)
+                break
+            except BufferError:
+                # Local producer queue is full
+                self.producer.poll(1.0)
+
+        self.in_flight += 1
+        self.producer.poll(0)
+        return True
+
+    def warm_up(self, topic_name):
+        # Fetching metadata opens the broker connections
+        if self.topic_partitions or self.partitioner != 'hash':
+            self._partitions_for(topic_name)
+        elif self.async_publish:
+            self.producer.list_topics(timeout=30)
+        else:
+            self.producer.partitions_for(topic_name)
+
+    def _count_delivery(self, topic_name, partition, n_bytes):
+        delivered = self._delivered_bytes.setdefault(topic_name, {})
+        delivered[partition] = delivered.get(partition, 0) + n_bytes
+
+    def _on_delivery(self, err, msg, n_bytes=0):
+        self.in_flight -= 1
+        if err:
+            print("Failed to deliver message", err)
+            self.delivery_errors.append(err)
+        else:
+            self._count_delivery(msg.topic(), msg.partition(), n_bytes)
+
+    def delivery_report(self, topic_name):
+        delivered = self._delivered_bytes.pop(topic_name, {})
+        return {
+            "partitioner": self.partitioner,
+            "partition-bytes": dict((str(partition), n_bytes)
+                                    for partition, n_bytes in sorted(delivered.items()))
+        }
+
+    def flush(self):
+        if not self.async_publish:
+            self.producer.flush()
+            return
+
+        remaining = self.producer.flush(self.flush_timeout)
+        errors = self.delivery_errors
+        self.delivery_errors = []
+        if remaining:
+            raise RuntimeError(str(remaining) + " messages not delivered after " +
+                               str(self.flush_timeout) + " seconds")
+        if errors:
+            raise RuntimeError(str(len(errors)) + " messages failed delivery: " +
+                               str(errors[0]))
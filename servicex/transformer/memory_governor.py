@@ -0,0 +1,209 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import resource
+import threading
+import time
+
+import pyarrow as pa
+
+
+def current_rss():
+    """
+    Resident set size of this process, in bytes. Falls back to the peak RSS
+    where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sizeof(item):
+    """
+    Bytes held by an item moving through the transform: numpy arrays, Arrow
+    batches and buffers, and the dicts, lists and tuples holding them.
+    Anything else is measured with pympler, which is much slower
+    :param item: Chunk, batch or buffer
+    :return: Size in bytes
+    """
+    if isinstance(item, dict):
+        return sum(sizeof(value) for value in item.values())
+    if isinstance(item, (list, tuple)):
+        return sum(sizeof(value) for value in item)
+    if isinstance(item, pa.Buffer):
+        return item.size
+    if isinstance(item, bytes):
+        return len(item)
+    if hasattr(item, 'nbytes'):
+        return item.nbytes
+
+    from pympler import asizeof
+    return asizeof.asizeof(item)
+
+
+class MemoryGovernor:
+    """
+    Keep a transform process under an RSS ceiling. The bytes held by chunks
+    and serialized buffers in flight are accounted as they move through the
+    pipeline. Approaching the ceiling, chunks are made smaller and the reader
+    waits for earlier chunks to be published before reading another.
+
+    Without a ceiling usage is only tracked, for the per file report.
+    """
+
+    def __init__(self, max_rss=None, soft_fraction=0.8, min_scale=1.0 / 64,
+                 pause_timeout=60.0, poll_interval=0.05, rss_function=current_rss):
+        """
+        :param max_rss: RSS ceiling in bytes, or None for no ceiling
+        :param soft_fraction: Fraction of max_rss above which chunks shrink
+            and the reader pauses
+        :param min_scale: Smallest fraction of the planned chunk size used
+        :param pause_timeout: Longest the reader waits for room, in seconds,
+            before reading anyway
+        :param poll_interval: Longest wait between RSS checks while paused
+        :param rss_function: Returns the current RSS in bytes
+        """
+        self.max_rss = max_rss
+        self.soft_limit = int(max_rss * soft_fraction) if max_rss else None
+        self.min_scale = min_scale
+        self.pause_timeout = pause_timeout
+        self.poll_interval = poll_interval
+        self.rss_function = rss_function
+
+        self.in_flight_bytes = 0
+        self.scale = 1.0
+        self.lock = threading.Condition()
+        self.start_file()
+
+    def start_file(self):
+        'Reset the per file peaks and counters'
+        with self.lock:
+            self.in_flight_bytes = 0
+            self.peak_in_flight_bytes = 0
+        self.peak_rss = self.rss_function()
+        self.min_file_scale = self.scale
+        self.pauses = 0
+        self.pause_time = 0.0
+        self.over_ceiling = False
+
+    def add(self, n_bytes):
+        with self.lock:
+            self.in_flight_bytes += n_bytes
+            self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+
+    def remove(self, n_bytes):
+        with self.lock:
+            self.in_flight_bytes = max(0, self.in_flight_bytes - n_bytes)
+            self.lock.notify_all()
+
+    def sample(self):
+        """
+        :return: The current RSS, after updating the peak
+        """
+        rss = self.rss_function()
+        self.peak_rss = max(self.peak_rss, rss)
+        if self.max_rss and rss > self.max_rss and not self.over_ceiling:
+            print("RSS of " + str(rss) + " bytes is over the ceiling of " +
+                  str(self.max_rss) + " bytes")
+            self.over_ceiling = True
+        return rss
+
+    def chunk_size(self, planned):
+        """
+        Halve the chunk size each time a chunk is read above the soft limit,
+        and double it back, up to the planned size, below it. When memory
+        outside the chunks in flight is already over the limit smaller
+        chunks would not help, so the size is left alone
+        :param planned: Chunk size the planner wants
+        :return: Chunk size to read
+        """
+        rss = self.sample()
+        if self.soft_limit:
+            if rss <= self.soft_limit:
+                self.scale = min(self.scale * 2, 1.0)
+            elif rss - self.in_flight_bytes < self.soft_limit:
+                self.scale = max(self.scale / 2, self.min_scale)
+            self.min_file_scale = min(self.min_file_scale, self.scale)
+        return max(1, int(planned * self.scale))
+
+    def wait_for_room(self):
+        """
+        Block while RSS is above the soft limit and earlier chunks are still
+        in flight, since publishing them is what frees memory
+        """
+        if not self.soft_limit:
+            return
+
+        start = None
+        with self.lock:
+            while self.in_flight_bytes > 0 and self.sample() > self.soft_limit:
+                if start is None:
+                    start = time.time()
+                    self.pauses += 1
+                if time.time() - start > self.pause_timeout:
+                    print("Reading on after waiting " + str(self.pause_timeout) +
+                          " seconds for memory to be freed")
+                    break
+                # Woken as soon as a chunk is published
+                self.lock.wait(self.poll_interval)
+
+        if start is not None:
+            self.pause_time += time.time() - start
+
+    def throttle(self, items, size_function=sizeof):
+        """
+        Wrap the reader, pausing before each item while memory is short and
+        accounting the bytes of each item read
+        :param items: Iterable of chunks
+        :param size_function: Returns the bytes held by one item
+        :return: Yields the items
+        """
+        iterator = iter(items)
+        while True:
+            self.wait_for_room()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(size_function(item))
+            yield item
+
+    def report(self):
+        """
+        :return: Dict of the peak usage and throttling of the current file
+        """
+        self.sample()
+        return {
+            "peak-rss": self.peak_rss,
+            "peak-in-flight-bytes": self.peak_in_flight_bytes,
+            "max-rss": self.max_rss,
+            "pauses": self.pauses,
+            "pause-time": self.pause_time,
+            "min-chunk-scale": self.min_file_scale
+        }
@@ -32,6 +32,36 @@ from abc import ABCMeta, abstractmethod
 class Messaging:
     __metaclass__ = ABCMeta
 
+    # Name the backend is reported under
+    name = 'messaging'
+
+    # True if the backend holds on to the payload after publish_message
+    # returns, so its buffer can't be reused for the next message
+    retains_payload = False
+
     @abstractmethod
     def publish_message(self, topic_name, key, value_buffer):
+        """
+        :param value_buffer: pa.Buffer holding the payload. Backends pass it,
+            or a memoryview of it, to their client rather than copying it
+        """
+        pass
+
+    def flush(self):
+        """
+        Block until every message published so far has been delivered
+        """
         pass
+
+    def warm_up(self, topic_name):
+        """
+        Connect to the backend ahead of the first message
+        """
+        pass
+
+    def delivery_report(self, topic_name):
+        """
+        :return: Dict of backend specific counters for the messages delivered
+            to topic_name since the last report
+        """
+        return {}
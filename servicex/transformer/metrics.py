@@ -0,0 +1,227 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Counters kept per request-id, with their help text
+COUNTERS = [
+    ('events', 'Events transformed'),
+    ('bytes', 'Bytes of results produced'),
+    ('messages', 'Messages published'),
+    ('files', 'Files transformed'),
+    ('failures', 'Files that failed to transform'),
+    ('result_cache_hits', 'Files answered from the result cache'),
+    ('result_cache_misses', 'Files looked up in the result cache and transformed')
+]
+
+PREFIX = 'servicex_transformer_'
+
+
+class FileTimer:
+    """
+    Wall clock time spent in each stage of transforming one file
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def as_dict(self):
+        return dict(self.stages)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(name + '="' + _escape(value) + '"'
+                          for name, value in sorted(labels.items())) + '}'
+
+
+class TransformMetrics:
+    """
+    Per request-id counters and stage times in Prometheus text format. Each
+    process writes its own textfile into textfile_dir, where a node exporter
+    textfile collector or serve_metrics can pick them up.
+    """
+
+    def __init__(self, textfile_dir=None):
+        self.textfile_dir = textfile_dir
+        self.counters = {}
+        self.stage_seconds = {}
+        self.gauges = OrderedDict()
+        self.lock = threading.Lock()
+
+    def inc(self, request_id, name, value=1):
+        with self.lock:
+            key = (name, request_id)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, help_text):
+        with self.lock:
+            self.gauges[name] = (value, help_text)
+
+    def observe_file(self, request_id, timer, events=0, n_bytes=0, messages=0):
+        """
+        Count a file that transformed successfully
+        :param request_id: Request the file belongs to
+        :param timer: FileTimer for the file
+        """
+        self.inc(request_id, 'files')
+        self.inc(request_id, 'events', events)
+        self.inc(request_id, 'bytes', n_bytes)
+        self.inc(request_id, 'messages', messages)
+        with self.lock:
+            for stage, seconds in timer.stages.items():
+                key = (request_id, stage)
+                self.stage_seconds[key] = self.stage_seconds.get(key, 0.0) + seconds
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stage_seconds = dict(self.stage_seconds)
+            gauges = list(self.gauges.items())
+
+        lines = []
+        for name, help_text in COUNTERS:
+            lines.append('# HELP ' + PREFIX + name + '_total ' + help_text)
+            lines.append('# TYPE ' + PREFIX + name + '_total counter')
+            for (counter, request_id), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(PREFIX + name + '_total' +
+                                 _labels(request_id=request_id, pid=os.getpid()) +
+                                 ' ' + str(value))
+
+        lines.append('# HELP ' + PREFIX + 'stage_seconds_total Time spent in each stage')
+        lines.append('# TYPE ' + PREFIX + 'stage_seconds_total counter')
+        for (request_id, stage), seconds in sorted(stage_seconds.items()):
+            lines.append(PREFIX + 'stage_seconds_total' +
+                         _labels(request_id=request_id, stage=stage, pid=os.getpid()) +
+                         ' ' + repr(seconds))
+
+        for name, (value, help_text) in gauges:
+            lines.append('# HELP ' + PREFIX + name + ' ' + help_text)
+            lines.append('# TYPE ' + PREFIX + name + ' gauge')
+            lines.append(PREFIX + name + _labels(pid=os.getpid()) + ' ' + repr(value))
+        return '\n'.join(lines) + '\n'
+
+    def textfile_path(self):
+        return os.path.join(self.textfile_dir, 'transformer-' + str(os.getpid()) + '.prom')
+
+    def write_textfile(self):
+        if not self.textfile_dir:
+            return
+
+        # Write then rename so a scraper never reads a partial file
+        path = self.textfile_path()
+        with open(path + '.tmp', 'w') as textfile:
+            textfile.write(self.render())
+        os.rename(path + '.tmp', path)
+
+
+def merge_textfiles(textfile_dir):
+    """
+    Combine the textfiles written by each process, keeping one HELP and
+    TYPE line per metric
+    :return: Prometheus text format
+    """
+    headers = OrderedDict()
+    samples = OrderedDict()
+    for path in sorted(glob.glob(os.path.join(textfile_dir, '*.prom'))):
+        with open(path) as textfile:
+            for line in textfile:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    name = line.split()[2]
+                    headers.setdefault(name, OrderedDict())[line] = True
+                else:
+                    name = line.split('{')[0].split(' ')[0]
+                    samples.setdefault(name, []).append(line)
+
+    lines = []
+    for name in list(headers) + [name for name in samples if name not in headers]:
+        lines.extend(headers.get(name, {}))
+        lines.extend(samples.get(name, []))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_textfiles(textfile_dir):
+    'Remove textfiles left by processes from an earlier run'
+    for path in glob.glob(os.path.join(textfile_dir, 'transformer-*.prom')):
+        os.remove(path)
+
+
+def serve_metrics(port, textfile_dir):
+    """
+    Serve the merged textfiles on /metrics from a background thread
+    :return: The HTTPServer
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = merge_textfiles(textfile_dir).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print("Serving metrics on port", server.server_port)
+    return server
@@ -25,16 +25,289 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import io
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Marks the end of the data written to an UploadStream
+_EOF = object()
+_ABORT = object()
 
 
 class ObjectStoreManager:
 
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, upload_workers=2, max_queued_uploads=4,
+                 parallel_part_uploads=3, max_connections=10):
+        """
+        :param url: Object store endpoint
+        :param username: Access key
+        :param password: Secret key
+        :param upload_workers: Uploads running at the same time in the background
+        :param max_queued_uploads: Uploads that may wait for a worker before
+            submitting another one blocks
+        :param parallel_part_uploads: Parts of a multipart upload sent at once
+        :param max_connections: Size of the reused HTTP connection pool
+        """
         from minio import Minio
+        import urllib3
+
+        http_client = urllib3.PoolManager(
+            maxsize=max_connections,
+            retries=urllib3.Retry(total=5, backoff_factor=0.2,
+                                  status_forcelist=[500, 502, 503, 504]))
         self.minio_client = Minio(endpoint=url, access_key=username,
-                                  secret_key=password, secure=False)
+                                  secret_key=password, secure=False,
+                                  http_client=http_client)
+        self.parallel_part_uploads = parallel_part_uploads
+
+        self._known_buckets = set()
+        self._bucket_lock = threading.Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self._upload_slots = threading.BoundedSemaphore(upload_workers + max_queued_uploads)
+
+    def ensure_bucket(self, bucket):
+        """
+        Create the bucket unless we already know it exists
+        """
+        with self._bucket_lock:
+            if bucket in self._known_buckets:
+                return
+            if not self.minio_client.bucket_exists(bucket):
+                self.minio_client.make_bucket(bucket)
+            self._known_buckets.add(bucket)
+
+    def warm_up(self, bucket=None):
+        """
+        Open a pooled connection, and create the result bucket, ahead of the
+        first upload
+        """
+        if bucket:
+            self.ensure_bucket(bucket)
+        else:
+            self.minio_client.list_buckets()
+
+    def _submit(self, function, *args):
+        # Blocks while the upload queue is full
+        self._upload_slots.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._upload_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._upload_slots.release())
+        return future
 
     def upload_file(self, bucket, object_name, path):
         self.minio_client.fput_object(bucket_name=bucket,
                                       object_name=object_name,
+                                      file_path=path,
+                                      num_parallel_uploads=self.parallel_part_uploads)
+
+    def put_bytes(self, bucket, object_name, data):
+        """
+        Upload a small object held in memory
+        """
+        self.ensure_bucket(bucket)
+        self.minio_client.put_object(bucket_name=bucket,
+                                     object_name=object_name,
+                                     data=io.BytesIO(data), length=len(data))
+
+    def download_file(self, bucket, object_name, path):
+        self.minio_client.fget_object(bucket_name=bucket, object_name=object_name,
                                       file_path=path)
+
+    def get_bytes(self, bucket, object_name):
+        """
+        Read a small object into memory
+        """
+        response = self.minio_client.get_object(bucket_name=bucket, object_name=object_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def list_objects(self, bucket, prefix=None):
+        """
+        :return: List of (object name, size, last modified) tuples
+        """
+        self.ensure_bucket(bucket)
+        return [(obj.object_name, obj.size, obj.last_modified)
+                for obj in self.minio_client.list_objects(bucket, prefix=prefix,
+                                                          recursive=True)]
+
+    def remove_object(self, bucket, object_name):
+        self.minio_client.remove_object(bucket_name=bucket, object_name=object_name)
+
+    def upload_file_async(self, bucket, object_name, path):
+        """
+        Queue a file for upload in the background
+        :return: Future that completes when the upload has succeeded
+        """
+        def upload():
+            self.ensure_bucket(bucket)
+            self.upload_file(bucket, object_name, path)
+        return self._submit(upload)
+
+    def _put_stream(self, bucket, object_name, stream, part_size):
+        self.ensure_bucket(bucket)
+        # An unknown length makes minio stream the data as a multipart upload
+        self.minio_client.put_object(bucket_name=bucket,
+                                     object_name=object_name,
+                                     data=stream, length=-1,
+                                     part_size=part_size,
+                                     num_parallel_uploads=self.parallel_part_uploads)
+
+    def open_upload_stream(self, bucket, object_name, part_size=16 * 1024 * 1024,
+                           max_buffered_parts=2):
+        """
+        Open a writable stream that uploads to the object store as a multipart
+        upload while it is being written
+        :param bucket: Bucket to write to
+        :param object_name: Name of the object
+        :param part_size: Size of each uploaded part in bytes
+        :param max_buffered_parts: Parts that may wait to be uploaded before
+            writes block
+        :return: UploadStream
+        """
+        stream = UploadStream(object_name, part_size, max_buffered_parts)
+        stream.start(self._submit(self._put_stream, bucket, object_name, stream, part_size))
+        return stream
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class UploadStream:
+    """
+    File-like object whose contents are uploaded in parts by a background
+    upload as they are written, so no local scratch file is needed and
+    memory use is bounded by the buffered parts.
+    """
+
+    def __init__(self, object_name, part_size, max_buffered_parts):
+        self.object_name = object_name
+        self.part_size = part_size
+        self.closed = False
+        self.position = 0
+
+        self._pending = bytearray()
+        self._parts = queue.Queue(maxsize=max_buffered_parts)
+        self._leftover = b''
+        self._future = None
+
+    def start(self, future):
+        self._future = future
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        if future.exception() is not None:
+            # Unblock a writer waiting on a full queue
+            while True:
+                try:
+                    self._parts.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _put_part(self, part):
+        while not self._future.done():
+            try:
+                self._parts.put(part, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._future.done() and self._future.exception() is not None:
+            raise IOError("Upload of " + self.object_name + " failed: " +
+                          str(self._future.exception()))
+
+    def read(self, size=-1):
+        """
+        Called by the upload to pull the next bytes
+        """
+        data = self._leftover
+        while size < 0 or len(data) < size:
+            part = self._parts.get()
+            if part is _EOF:
+                # Leave the marker for any later read
+                self._parts.put(_EOF)
+                break
+            if part is _ABORT:
+                # Failing the read makes minio abort the multipart upload
+                self._parts.put(_ABORT)
+                raise IOError("Upload of " + self.object_name + " aborted by the writer")
+            data += part
+
+        if size < 0:
+            self._leftover = b''
+            return data
+        self._leftover = data[size:]
+        return data[:size]
+
+    def write(self, data):
+        self._raise_error()
+        self._pending += data
+        self.position += len(data)
+        while len(self._pending) >= self.part_size:
+            self._put_part(bytes(self._pending[:self.part_size]))
+            del self._pending[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def finish(self):
+        """
+        Hand the remaining data to the upload without waiting for it
+        :return: Future that completes when the upload has succeeded
+        """
+        if not self.closed:
+            self.closed = True
+            if self._pending:
+                self._put_part(bytes(self._pending))
+                self._pending = bytearray()
+            self._put_part(_EOF)
+        return self._future
+
+    def abort(self):
+        """
+        Give up on the object when the writer fails partway through. The
+        upload stops waiting for more parts and fails, so the partial
+        multipart upload is discarded and its upload worker freed
+        :return: Future of the failed upload
+        """
+        if not self.closed:
+            self.closed = True
+            self._pending = bytearray()
+            try:
+                self._put_part(_ABORT)
+            except IOError:
+                # The upload had already failed by itself
+                pass
+        return self._future
+
+    def close(self):
+        """
+        Upload the remaining data and wait for the upload to finish
+        """
+        self.finish()
+        try:
+            self._future.result()
+        except Exception:
+            self._raise_error()
+            raise
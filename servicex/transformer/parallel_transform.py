@@ -0,0 +1,215 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+import multiprocessing
+
+import pyarrow as pa
+
+from servicex.transformer.chunk_planner import ChunkPlanner
+from servicex.transformer.xaod_events import XAODEvents
+from servicex.transformer.serialization import BatchSerializer
+from servicex.transformer.xaod_transformer import XAODTransformer
+
+# Files opened by this worker process, so each range doesn't repeat the
+# TFile open and MakeTransientTree
+_worker_events = {}
+
+# TTreeCache settings for files opened by this worker process
+_worker_cache_config = None
+
+# Serializer, and its buffer pool, kept for every range this worker transforms
+_worker_serializers = {}
+
+
+def cpu_limit():
+    """
+    Number of CPUs this container may use, from the cgroup CPU quota when
+    one is set, otherwise the number of CPUs on the node
+    """
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != 'max':
+            return max(1, int(int(quota) / int(period)))
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file:
+            quota = int(quota_file.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+            period = int(period_file.read())
+        if quota > 0:
+            return max(1, int(quota / period))
+    except (IOError, OSError, ValueError):
+        pass
+
+    return multiprocessing.cpu_count()
+
+
+def entry_ranges(n_entries, n_ranges):
+    """
+    Split entries into contiguous, nearly equal ranges
+    :param n_entries: Number of entries to split
+    :param n_ranges: Number of ranges wanted
+    :return: List of (start, stop) tuples in entry order
+    """
+    n_ranges = max(1, min(n_ranges, n_entries))
+    ranges = []
+    for i in range(n_ranges):
+        start = n_entries * i // n_ranges
+        stop = n_entries * (i + 1) // n_ranges
+        ranges.append((start, stop))
+    return ranges
+
+
+def _init_worker(cache_config):
+    global _worker_cache_config
+    _worker_cache_config = cache_config
+
+
+def _open_events(file_path, attr_name_list):
+    if file_path not in _worker_events:
+        _worker_events.clear()
+        _worker_events[file_path] = XAODEvents(file_path, attr_name_list,
+                                               cache_config=_worker_cache_config)
+    return _worker_events[file_path]
+
+
+def _entry_count(args):
+    file_path, attr_name_list = args
+    return _open_events(file_path, attr_name_list).get_entry_count()
+
+
+def _transform_range(args):
+    file_path, attr_name_list, entry_start, entry_stop, chunk_size, max_message_size, \
+        message_format = args
+
+    events = _open_events(file_path, attr_name_list)
+    events.entry_start = entry_start
+    events.entry_stop = entry_stop
+
+    transformer = XAODTransformer(events)
+    chunk_planner = ChunkPlanner(max_message_size, chunk_size, adaptive=not chunk_size)
+    if message_format not in _worker_serializers:
+        _worker_serializers[message_format] = BatchSerializer(message_format)
+    serializer = _worker_serializers[message_format]
+
+    # Payloads are copied to bytes once, to be sent back to the parent
+    serialized = []
+    for batch in transformer.arrow_batches(chunk_planner.next_chunk_size):
+        for _, buffer in chunk_planner.fit(batch, serializer.serialize, serializer.release):
+            serialized.append(buffer.to_pybytes())
+            serializer.release(buffer)
+    return serialized
+
+
+class ParallelTransform:
+    """
+    Transform one file with several processes, each reading its own entry
+    range with its own TFile. Batches come back in entry order so batch
+    numbers, and the keys built from them, are reproducible.
+    """
+
+    def __init__(self, file_path, attr_name_list, n_workers, chunk_size=None,
+                 max_message_size=14.5, ranges_per_worker=4, cache_config=None,
+                 message_format='arrow', max_range_events=10000, ranges_ahead=2):
+        """
+        :param file_path: Path of the xAOD file
+        :param attr_name_list: Attributes to extract
+        :param n_workers: Number of worker processes. Capped at the CPU limit
+        :param chunk_size: Events per batch. If None it is sized to fill
+            the max message size
+        :param max_message_size: Maximum size for any message in Megabytes
+        :param ranges_per_worker: Ranges to cut for each worker. More ranges
+            balance better, fewer keep less output waiting to be published
+        :param cache_config: TreeCacheConfig for each worker's TFile
+        :param message_format: Payload format, one of
+            serialization.format_names()
+        :param max_range_events: Most events in one range. A range's output
+            is held in its worker until the range is done, so this bounds the
+            memory each worker uses however large the file is
+        :param ranges_ahead: Ranges each worker may be given before the
+            output of earlier ranges has been taken
+        """
+        self.file_path = file_path
+        self.attr_name_list = attr_name_list
+        self.n_workers = max(1, min(n_workers, cpu_limit()))
+        self.chunk_size = chunk_size
+        self.max_message_size = int(max_message_size * 1e6)
+        self.ranges_per_worker = ranges_per_worker
+        self.cache_config = cache_config
+        self.max_range_events = max_range_events
+        self.ranges_ahead = ranges_ahead
+        self.serializer = BatchSerializer(message_format)
+
+    def iterate(self, event_limit=None):
+        """
+        :param event_limit: Max number of events to process
+        :return: Yields (record batch, [(record batch, buffer)]) in entry
+            order, matching the serialize stage of the transform pipeline
+        """
+        pool = multiprocessing.Pool(self.n_workers, initializer=_init_worker,
+                                    initargs=(self.cache_config,))
+        try:
+            n_entries = pool.apply(_entry_count, ((self.file_path, self.attr_name_list),))
+            if event_limit:
+                n_entries = min(n_entries, event_limit)
+
+            n_ranges = max(self.n_workers * self.ranges_per_worker,
+                           -(-n_entries // self.max_range_events))
+            tasks = [(self.file_path, self.attr_name_list, start, stop,
+                      self.chunk_size, self.max_message_size,
+                      self.serializer.message_format)
+                     for start, stop in entry_ranges(n_entries, n_ranges)]
+
+            print("Transforming " + str(n_entries) + " events in " + str(len(tasks)) +
+                  " ranges with " + str(self.n_workers) + " processes")
+
+            # Only a few ranges are handed out ahead of the one being published,
+            # so finished output doesn't pile up in this process either
+            tasks = iter(tasks)
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_transform_range, (task,)))
+                if len(pending) >= self.n_workers * self.ranges_ahead:
+                    break
+
+            while pending:
+                serialized = pending.popleft().get()
+                for task in tasks:
+                    pending.append(pool.apply_async(_transform_range, (task,)))
+                    break
+
+                for msg_bytes in serialized:
+                    buffer = pa.py_buffer(msg_bytes)
+                    batch = self.serializer.deserialize(buffer)
+                    yield batch, [(batch, buffer)]
+        finally:
+            pool.terminate()
+            pool.join()
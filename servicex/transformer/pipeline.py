@@ -0,0 +1,200 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Marks the end of the stream flowing through the stage queues
+_END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_time = 0.0
+        self.input_stall_time = 0.0
+        self.output_stall_time = 0.0
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "busy-time": self.busy_time,
+            "input-stall-time": self.input_stall_time,
+            "output-stall-time": self.output_stall_time
+        }
+
+
+class Pipeline:
+    """
+    Run a source iterator and a chain of stage functions on their own
+    threads, connected by bounded queues, so that I/O, conversion,
+    serialization and publishing overlap.
+
+    Each stage function takes the item produced by the previous stage and
+    returns the item for the next one. The result of the last stage is
+    discarded.
+    """
+
+    def __init__(self, source, stages, queue_depth=2, source_name='read'):
+        """
+        :param source: Iterable producing the items for the first stage
+        :param stages: List of (name, function) pairs, in order
+        :param queue_depth: Max items waiting in front of each stage. Either an
+            int for every queue or a dict keyed by stage name
+        :param source_name: Name used to report the source stage
+        """
+        self.source = source
+        self.stages = stages
+        self.queue_depth = queue_depth
+        self.source_name = source_name
+
+        self.stats = [StageStats(source_name)] + [StageStats(name) for name, _ in stages]
+        self._stop = threading.Event()
+        self._error = None
+
+    def _depth(self, stage_name):
+        if isinstance(self.queue_depth, dict):
+            return self.queue_depth.get(stage_name, 2)
+        return self.queue_depth
+
+    def _put(self, q, item, stats):
+        start = time.time()
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats.output_stall_time += time.time() - start
+
+    def _get(self, q, stats):
+        start = time.time()
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        stats.input_stall_time += time.time() - start
+        return item
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _run_source(self, out_queue, stats):
+        try:
+            iterator = iter(self.source)
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy_time += time.time() - start
+                stats.items += 1
+                self._put(out_queue, item, stats)
+            self._put(out_queue, _END, stats)
+        except PipelineStopped:
+            pass
+        except Exception as error:
+            self._fail(error)
+
+    def _run_stage(self, function, in_queue, out_queue, stats):
+        try:
+            while True:
+                item = self._get(in_queue, stats)
+                if item is _END:
+                    break
+
+                start = time.time()
+                result = function(item)
+                stats.busy_time += time.time() - start
+                stats.items += 1
+
+                if out_queue is not None:
+                    self._put(out_queue, result, stats)
+
+            if out_queue is not None:
+                self._put(out_queue, _END, stats)
+        except PipelineStopped:
+            pass
+        except Exception as error:
+            self._fail(error)
+
+    def run(self):
+        """
+        Run every stage to completion. Re-raises the first exception thrown
+        by any stage, after stopping the others.
+        """
+        queues = [queue.Queue(maxsize=self._depth(name)) for name, _ in self.stages]
+
+        # Threads are named after their stage so they can be told apart in profiles
+        threads = [threading.Thread(target=self._run_source, name='pipeline-' + self.source_name,
+                                    args=(queues[0], self.stats[0]))]
+        for i, (name, function) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._run_stage, name='pipeline-' + name,
+                                            args=(function, queues[i], out_queue,
+                                                  self.stats[i + 1])))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def bottleneck(self):
+        """
+        :return: Name of the stage that spent the most time working
+        """
+        return max(self.stats, key=lambda stats: stats.busy_time).name
+
+    def report(self):
+        """
+        :return: Dict of per-stage counters, keyed by stage name
+        """
+        return dict((stats.name, stats.as_dict()) for stats in self.stats)
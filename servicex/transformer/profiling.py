@@ -0,0 +1,136 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hashlib
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that periodically records the stack of every thread.
+    The sampled code runs untouched, so the overhead is just the sampling
+    thread waking up once per interval. Stacks are reported in the collapsed
+    format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_ident = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            self.sample(exclude=(own_ident,))
+
+    def sample(self, exclude=()):
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident in exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-' + str(ident)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def collapsed(self):
+        """
+        :return: One line per distinct stack: frames separated by ; then the
+                 number of samples it was seen in
+        """
+        return ''.join(stack + ' ' + str(count) + '\n'
+                       for stack, count in sorted(self.stacks.items()))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def should_profile(request_id, file_path, sample_rate=0.0, profile_requests=()):
+    """
+    Decide whether to profile a file. Sampling hashes the file path, so the
+    same files are picked on every run and every transformer agrees
+    :param sample_rate: Fraction of files to profile
+    :param profile_requests: Request ids that have every file profiled
+    """
+    if request_id in profile_requests:
+        return True
+    if sample_rate <= 0.0:
+        return False
+    digest = hashlib.md5(str(file_path).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(0xffffffff) < sample_rate
+
+
+def save_profile(profiler, object_name, object_store=None, bucket=None, local_dir=None):
+    """
+    Store the collapsed stacks next to the results in the object store, or
+    in a local directory. Failing to save never fails the transform.
+    :return: Where the profile was written, or None
+    """
+    data = profiler.collapsed().encode('utf-8')
+    object_name = object_name + '.profile.txt'
+    try:
+        if object_store and bucket:
+            object_store.put_bytes(bucket, object_name, data)
+            return bucket + '/' + object_name
+        if local_dir:
+            if not os.path.isdir(local_dir):
+                os.makedirs(local_dir)
+            path = os.path.join(local_dir, object_name)
+            with open(path, 'wb') as profile_file:
+                profile_file.write(data)
+            return path
+    except Exception as ex:
+        print("Failed to save profile " + object_name + ": " + str(ex))
+    return None
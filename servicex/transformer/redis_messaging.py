@@ -25,14 +25,39 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
 import os
 import time
 import redis
-import codecs
+from servicex.transformer.messaging import Messaging
+from servicex.transformer.compression import get_codec
 
 
-class RedisMessaging:
-    def __init__(self, host='redis.slateci.net', port=6379):
+class RedisMessaging(Messaging):
+    name = 'redis'
+
+    def __init__(self, host='redis.slateci.net', port=6379, codec='lz4',
+                 pipeline_size=50, pipeline_bytes=32 * 1024 * 1024, maxlen=None,
+                 backpressure_timeout=600, connect_timeout=60, shards=1, endpoints=None,
+                 max_messages_per_shard=None):
+        """
+        :param host: Redis host
+        :param port: Redis port
+        :param codec: Payload compression: none, lz4, zstd or bz2
+        :param pipeline_size: Messages sent together in one pipelined round trip
+        :param pipeline_bytes: Payload bytes that may wait for the pipeline
+            before it is sent, whatever the number of messages
+        :param maxlen: Approximate length streams are trimmed to. None to
+            never trim
+        :param backpressure_timeout: Seconds to wait for a full stream to drain
+            before giving up
+        :param connect_timeout: Seconds to keep retrying the first connection
+        :param shards: Number of streams each request's messages are spread over
+        :param endpoints: List of (host, port) to spread the shards over.
+            Defaults to just host and port
+        :param max_messages_per_shard: Length at which a shard's stream counts
+            as full. Defaults to MAX_MESSAGES_PER_REQUEST split over the shards
+        """
 
         self.MAX_MESSAGES_PER_REQUEST = 100000
         if 'MAX_MESSAGES_PER_REQUEST' in os.environ:
@@ -42,36 +67,138 @@ class RedisMessaging:
         self.port = port
         self.client = None
 
+        self.codec = get_codec(codec)
+        self.pipeline_size = pipeline_size
+        self.pipeline_bytes = pipeline_bytes
+
+        # Uncompressed payloads wait in the pipeline as views of the caller's
+        # buffer
+        self.retains_payload = self.codec.name == 'none'
+        self.maxlen = maxlen
+        self.backpressure_timeout = backpressure_timeout
+        self.connect_timeout = connect_timeout
+
+        self.shards = shards
+        self.endpoints = endpoints or [(host, port)]
+        self.clients = []
+        self.max_messages_per_shard = max_messages_per_shard or \
+            max(1, self.MAX_MESSAGES_PER_REQUEST // shards)
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._next_shard = {}
+        self._manifests_written = set()
+
         print('Configured Redis backend')
 
-    def set_redis_client(self):
-        self.client = redis.Redis(self.host, self.port, db=0)
+    def _connect(self, host, port):
+        client = redis.Redis(host, port, db=0,
+                             socket_connect_timeout=5,
+                             retry_on_timeout=True)
 
-    def publish_message(self, topic_name, key, value_buffer):
-        # connect if not already done
-        try:
-            while True:
-                if self.client:
-                    # print('Redis client connected.')
-                    break
-                self.set_redis_client()
+        # Retry with backoff rather than giving up or sleeping a fixed minute
+        deadline = time.time() + self.connect_timeout
+        delay = 0.5
+        while True:
+            try:
+                client.ping()
+                return client
+            except redis.exceptions.ConnectionError as ex:
+                if time.time() + delay > deadline:
+                    print("Exception connecting to redis:", ex)
+                    raise
                 print('waiting to connect redis client...')
-                time.sleep(60)
-        except Exception as ex:
-            print("Exception in publishing message:", ex)
-            raise
-        request_id = 'req_id:' + topic_name
-        # check if queue is still full, if yes return false.
-        if self.client.xlen(request_id) > self.MAX_MESSAGES_PER_REQUEST:
-            return False
-
-        # add message
-        self.client.xadd(request_id, {
-            'pa': key,
-            'data': codecs.encode(value_buffer, 'bz2')
+                time.sleep(delay)
+                delay = min(2 * delay, 10)
+
+    def set_redis_client(self):
+        self.clients = [self._connect(host, port) for host, port in self.endpoints]
+        self.client = self.clients[0]
+
+    def warm_up(self, topic_name):
+        if not self.client:
+            self.set_redis_client()
+
+    def _stream_name(self, topic_name, shard=0):
+        if self.shards == 1:
+            return 'req_id:' + topic_name
+        return 'req_id:' + topic_name + ':' + str(shard)
+
+    def _write_manifest(self, topic_name):
+        # Tells consumers which stream on which endpoint holds each shard
+        self.client.hset('req_id:' + topic_name + ':manifest', mapping={
+            'shards': self.shards,
+            'codec': self.codec.name,
+            'streams': json.dumps([self._stream_name(topic_name, shard)
+                                   for shard in range(self.shards)]),
+            'endpoints': json.dumps([
+                '%s:%d' % self.endpoints[shard % len(self.endpoints)]
+                for shard in range(self.shards)])
         })
+        self._manifests_written.add(topic_name)
+
+    def publish_message(self, topic_name, key, value_buffer):
+        if not self.client:
+            self.set_redis_client()
+
+        if self.shards > 1 and topic_name not in self._manifests_written:
+            self._write_manifest(topic_name)
+
+        # Round robin keeps the shards evenly filled
+        shard = self._next_shard.get(topic_name, 0)
+        self._next_shard[topic_name] = (shard + 1) % self.shards
+
+        data = self.codec.compress(value_buffer)
+        self._pending.append((shard, topic_name, key, data))
+        self._pending_bytes += len(data)
+        if len(self._pending) >= self.pipeline_size or \
+                self._pending_bytes >= self.pipeline_bytes:
+            self.flush()
         return True
 
+    def _wait_for_room(self, client, stream_name, n_messages):
+        # Block while consumers catch up, rather than dropping messages
+        deadline = time.time() + self.backpressure_timeout
+        delay = 0.1
+        n_messages = min(n_messages, self.max_messages_per_shard)
+        while client.xlen(stream_name) + n_messages > self.max_messages_per_shard:
+            if time.time() > deadline:
+                raise RuntimeError("Stream " + stream_name + " still full after " +
+                                   str(self.backpressure_timeout) + " seconds")
+            time.sleep(delay)
+            delay = min(2 * delay, 5)
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        counts = {}
+        for shard, topic_name, _, _ in self._pending:
+            stream = (shard % len(self.clients), self._stream_name(topic_name, shard))
+            counts[stream] = counts.get(stream, 0) + 1
+        for (client_index, stream_name), n_messages in counts.items():
+            self._wait_for_room(self.clients[client_index], stream_name, n_messages)
+
+        by_client = {}
+        for message in self._pending:
+            by_client.setdefault(message[0] % len(self.clients), []).append(message)
+
+        for client_index, messages in sorted(by_client.items()):
+            pipeline = self.clients[client_index].pipeline(transaction=False)
+            for shard, topic_name, key, data in messages:
+                pipeline.xadd(self._stream_name(topic_name, shard), {
+                    'pa': key,
+                    'codec': self.codec.name,
+                    'data': data
+                }, maxlen=self.maxlen, approximate=True)
+
+            # Messages leave the queue before they are sent, so a failure here
+            # or on a later endpoint never sends them a second time
+            self._pending = [message for message in self._pending
+                             if message[0] % len(self.clients) != client_index]
+            self._pending_bytes -= sum(len(message[3]) for message in messages)
+            pipeline.execute()
+
     def request_status_redis(self, topic_name):
         try:
             topic_name = 'req_id:' + topic_name
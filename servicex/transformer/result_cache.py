@@ -0,0 +1,251 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Bump to invalidate every cached result when the output changes
+CACHE_VERSION = 1
+
+
+def hash_directory(path):
+    """
+    Hash the names and contents of every file under a directory
+    :return: Hex digest, or None if the directory doesn't exist
+    """
+    if not path or not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+            with open(file_path, 'rb') as code_file:
+                for block in iter(lambda: code_file.read(1024 * 1024), b''):
+                    digest.update(block)
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def input_identity(file_path, checksum=None):
+    """
+    Identify an input file's contents. A checksum from the DID finder is
+    best. Local files fall back to size and modification time, remote ones
+    to their path
+    """
+    if checksum:
+        return 'checksum:' + str(checksum)
+    if os.path.exists(file_path):
+        stat = os.stat(file_path)
+        return 'local:' + file_path + ':' + str(stat.st_size) + ':' + str(int(stat.st_mtime))
+    return 'path:' + file_path
+
+
+def result_cache_key(input_id, attr_name_list, result_format, code_hash=None):
+    """
+    :param input_id: From input_identity
+    :param attr_name_list: Attributes extracted. Whitespace is ignored, order is not
+    :param result_format: Format the results are written in
+    :param code_hash: Hash of the transformer code, if it generates the columns
+    :return: Hex key for the cached result
+    """
+    normalized = [''.join(str(attr_name).split()) for attr_name in attr_name_list]
+    description = json.dumps([CACHE_VERSION, input_id, normalized, code_hash, result_format])
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Results of earlier transforms, looked up by result_cache_key, so a
+    resubmitted request can be answered without reading the input again.
+    Each entry is the result file plus a small JSON metadata document.
+    Entries are evicted least recently used first once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, destination):
+        """
+        Copy a cached result to destination
+        :return: The metadata stored with it, or None on a miss
+        """
+        try:
+            metadata = self._get(key, destination)
+        except Exception as ex:
+            print("Result cache lookup of " + key + " failed:", ex)
+            metadata = None
+
+        with self._lock:
+            if metadata is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return metadata
+
+    def put(self, key, path, metadata):
+        """
+        Store a result file. Failing to store never fails the transform
+        """
+        try:
+            self._put(key, path, metadata)
+            evicted = self._evict()
+        except Exception as ex:
+            print("Could not cache result " + key + ":", ex)
+            return
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _get(self, key, destination):
+        raise NotImplementedError
+
+    def _put(self, key, path, metadata):
+        raise NotImplementedError
+
+    def _evict(self):
+        raise NotImplementedError
+
+
+class LocalResultCache(ResultCache):
+    """
+    Result cache in a local directory. Recency is the modification time of
+    the metadata file, which is touched on every hit
+    """
+
+    def __init__(self, directory, max_bytes):
+        ResultCache.__init__(self, max_bytes)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.data', base + '.json'
+
+    def _get(self, key, destination):
+        data_path, metadata_path = self._paths(key)
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        shutil.copyfile(data_path, destination)
+        os.utime(metadata_path, None)
+        return metadata
+
+    def _put(self, key, path, metadata):
+        data_path, metadata_path = self._paths(key)
+        shutil.copyfile(path, data_path + '.part')
+        os.rename(data_path + '.part', data_path)
+        # The metadata is written last, so an entry is only visible once complete
+        with open(metadata_path + '.part', 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.rename(metadata_path + '.part', metadata_path)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            data_path, metadata_path = self._paths(name[:-len('.json')])
+            try:
+                size = os.path.getsize(data_path)
+                entries.append((os.path.getmtime(metadata_path), data_path, metadata_path, size))
+            except OSError:
+                continue
+            total += size
+
+        evicted = 0
+        for _, data_path, metadata_path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(metadata_path)
+            os.remove(data_path)
+            total -= size
+            evicted += 1
+        return evicted
+
+
+class ObjectStoreResultCache(ResultCache):
+    """
+    Result cache in an object store bucket shared by every transformer.
+    Recency is the last modified time of the metadata object, which is
+    rewritten on every hit
+    """
+
+    def __init__(self, object_store, bucket, max_bytes):
+        ResultCache.__init__(self, max_bytes)
+        self.object_store = object_store
+        self.bucket = bucket
+
+    def _get(self, key, destination):
+        from minio.error import S3Error
+        try:
+            metadata_bytes = self.object_store.get_bytes(self.bucket, key + '.json')
+        except S3Error as ex:
+            if ex.code == 'NoSuchKey':
+                return None
+            raise
+        self.object_store.download_file(self.bucket, key + '.data', destination)
+        self.object_store.put_bytes(self.bucket, key + '.json', metadata_bytes)
+        return json.loads(metadata_bytes.decode('utf-8'))
+
+    def _put(self, key, path, metadata):
+        self.object_store.ensure_bucket(self.bucket)
+        self.object_store.upload_file(self.bucket, key + '.data', path)
+        self.object_store.put_bytes(self.bucket, key + '.json',
+                                    json.dumps(metadata).encode('utf-8'))
+
+    def _evict(self):
+        objects = self.object_store.list_objects(self.bucket)
+        sizes = dict((name[:-len('.data')], size) for name, size, _ in objects
+                     if name.endswith('.data'))
+        last_used = sorted((modified, name[:-len('.json')]) for name, _, modified in objects
+                           if name.endswith('.json'))
+        total = sum(sizes.values())
+
+        evicted = 0
+        for _, key in last_used:
+            if total <= self.max_bytes:
+                break
+            self.object_store.remove_object(self.bucket, key + '.json')
+            self.object_store.remove_object(self.bucket, key + '.data')
+            total -= sizes.get(key, 0)
+            evicted += 1
+        return evicted
@@ -0,0 +1,184 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+import pyarrow as pa
+
+# Message formats, and the Arrow IPC body compression each one uses
+_ipc_formats = {
+    'arrow': None,
+    'arrow-lz4': 'lz4',
+    'arrow-zstd': 'zstd'
+}
+
+
+def format_names():
+    return sorted(list(_ipc_formats.keys()) + ['parquet'])
+
+
+class BufferPool:
+    """
+    Recycle the buffers batches are serialized into, so that once the pool
+    is warm serializing a batch allocates nothing
+    """
+
+    def __init__(self, max_buffers=8, initial_size=1 << 20):
+        """
+        :param max_buffers: Most free buffers kept for reuse. Extra buffers
+            released to the pool are freed
+        :param initial_size: Smallest buffer allocated, in bytes
+        """
+        self.max_buffers = max_buffers
+        self.initial_size = initial_size
+        self.allocations = 0
+        self.reuses = 0
+
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, min_size):
+        """
+        :param min_size: Bytes the buffer must hold
+        :return: A mutable, resizable pa.Buffer of at least min_size
+        """
+        with self._lock:
+            buffer = self._free.pop() if self._free else None
+
+        if buffer is None:
+            self.allocations += 1
+            return pa.allocate_buffer(max(min_size, self.initial_size), resizable=True)
+
+        self.reuses += 1
+        if buffer.size < min_size:
+            buffer.resize(min_size)
+        return buffer
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buffer)
+
+    def stats(self):
+        return {
+            "allocations": self.allocations,
+            "reuses": self.reuses,
+            "free-buffers": len(self._free)
+        }
+
+
+class BatchSerializer:
+    """
+    Serialize RecordBatches into message payloads, writing each batch once,
+    straight into a pooled buffer. The payload is a pa.Buffer over the part
+    of the pooled buffer that was written, so its size is known without
+    copying it to bytes.
+
+    Payloads are one of:
+        arrow: Arrow IPC stream
+        arrow-lz4, arrow-zstd: Arrow IPC stream with compressed bodies
+        parquet: A Parquet file holding the one batch
+    """
+
+    def __init__(self, message_format='arrow', pool=None):
+        """
+        :param message_format: One of format_names()
+        :param pool: BufferPool to serialize into. Defaults to a private pool
+        """
+        if message_format not in format_names():
+            raise ValueError("Unknown message format " + str(message_format) +
+                             ", choose from " + ", ".join(format_names()))
+        self.message_format = message_format
+        self.pool = pool or BufferPool()
+
+        self._ipc_options = None
+        if _ipc_formats.get(message_format):
+            self._ipc_options = pa.ipc.IpcWriteOptions(
+                compression=_ipc_formats[message_format])
+
+        # Pooled buffer behind each payload handed out, keyed by address
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    def _write(self, sink, batch):
+        if self.message_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(pa.Table.from_batches([batch]), sink)
+        else:
+            writer = pa.ipc.new_stream(sink, batch.schema, options=self._ipc_options)
+            writer.write_batch(batch)
+            writer.close()
+
+    def serialize(self, batch):
+        """
+        :param batch: pyarrow RecordBatch
+        :return: pa.Buffer holding the payload. Hand it back with release()
+            once it has been published
+        """
+        # Room for the batch plus the schema and message headers. Grow and
+        # write again in the rare case it is not enough
+        buffer = self.pool.acquire(int(batch.nbytes * 1.1) + 65536)
+        while True:
+            sink = pa.FixedSizeBufferWriter(buffer)
+            try:
+                self._write(sink, batch)
+                break
+            except (IOError, OSError):
+                buffer.resize(buffer.size * 2)
+
+        payload = buffer.slice(0, sink.tell())
+        with self._lock:
+            self._leased[payload.address] = buffer
+        return payload
+
+    def release(self, payload, reuse=True):
+        """
+        Hand back a payload once it has been published
+        :param reuse: Return the buffer behind it to the pool, after which the
+            payload must not be used. False when something still holds the
+            payload, leaving the buffer to be freed once it is let go
+        """
+        with self._lock:
+            buffer = self._leased.pop(payload.address, None)
+        if buffer is not None and reuse:
+            self.pool.release(buffer)
+
+    def deserialize(self, payload):
+        """
+        :param payload: Bytes or pa.Buffer written by serialize
+        :return: pyarrow RecordBatch
+        """
+        if self.message_format == 'parquet':
+            import pyarrow.parquet as pq
+            table = pq.read_table(pa.BufferReader(payload)).combine_chunks()
+            batches = table.to_batches()
+            if not batches:
+                return pa.RecordBatch.from_arrays(
+                    [pa.array([], type=field.type) for field in table.schema],
+                    schema=table.schema)
+            return batches[0]
+        return pa.ipc.open_stream(payload).read_next_batch()
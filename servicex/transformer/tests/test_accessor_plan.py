@@ -0,0 +1,124 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import numpy
+import pyarrow as pa
+import pytest
+
+from servicex.transformer.accessor_plan import Accessor, AccessorPlan, split_attr_names
+
+
+class Track:
+    def pt(self):
+        return 42.0
+
+
+class Electron:
+    def pt(self):
+        return 10.0
+
+    def charge(self):
+        return -1
+
+    def isTight(self):
+        return True
+
+    def isolation(self, cone, name='etcone'):
+        return cone * 100 if name == 'etcone' else -1.0
+
+    def trackParticle(self):
+        return Track()
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestAccessorPlan:
+    def test_simple_accessor(self):
+        accessor = Accessor("Electrons.pt()")
+        assert accessor.collection == 'Electrons'
+        assert accessor.key == 'pt()'
+        assert accessor.column_name == 'Electrons_pt'
+        assert accessor.calls == [('pt', ())]
+        assert accessor(Electron()) == 10.0
+
+    def test_bare_method_name(self):
+        accessor = Accessor(" Electrons.pt")
+        assert accessor.collection == 'Electrons'
+        assert accessor.column_name == 'Electrons_pt'
+        assert accessor(Electron()) == 10.0
+
+    def test_nested_accessor(self):
+        accessor = Accessor("Electrons.trackParticle().pt()")
+        assert accessor.key == 'trackParticle().pt()'
+        assert accessor.column_name == 'Electrons_trackParticle_pt'
+        assert accessor(Electron()) == 42.0
+
+    def test_arguments(self):
+        accessor = Accessor("Electrons.isolation(0.4, 'etcone')")
+        assert accessor.calls == [('isolation', (0.4, 'etcone'))]
+        assert accessor.column_name == 'Electrons_isolation_0_4_etcone'
+        assert accessor(Electron()) == 40.0
+
+    @pytest.mark.parametrize("attr_name", [
+        "Electrons", ".pt()", "Electrons.pt(", "Electrons.isolation(cone)", "Electrons.1pt()"
+    ])
+    def test_invalid(self, attr_name):
+        with pytest.raises(ValueError):
+            Accessor(attr_name)
+
+    def test_plan(self):
+        plan = AccessorPlan(["Electrons.pt()", "Muons.e()", "Electrons.eta()",
+                             "Electrons.pt()"])
+        assert list(plan.collections) == ['Electrons', 'Muons']
+        assert [accessor.key for accessor in plan.collections['Electrons']] == \
+            ['pt()', 'eta()']
+        assert plan.branch_dict() == {'Electrons': ['pt()', 'eta()'], 'Muons': ['e()']}
+        assert plan.schema.names == ['Electrons_pt', 'Muons_e', 'Electrons_eta',
+                                     'Electrons_pt']
+        assert plan.schema.field('Muons_e').type == pa.list_(pa.float64())
+
+    def test_infer_type(self):
+        plan = AccessorPlan(["Electrons.pt()", "Electrons.charge()", "Electrons.isTight()",
+                             "Electrons.charge()"])
+        for accessor in plan.accessors:
+            accessor.infer_type(accessor(Electron()))
+
+        assert plan.accessors[1] is plan.accessors[3]
+        assert plan.accessors[1].dtype == numpy.int64
+        assert plan.schema.types == [pa.list_(pa.float64()), pa.list_(pa.int64()),
+                                     pa.list_(pa.bool_()), pa.list_(pa.int64())]
+
+    def test_schema_fixes_unread_types(self):
+        plan = AccessorPlan(["Electrons.charge()"])
+        assert plan.schema.field('Electrons_charge').type == pa.list_(pa.float64())
+
+        plan.accessors[0].infer_type(-1)
+        assert plan.accessors[0].arrow_type == pa.float64()
+
+    def test_split_attr_names(self):
+        assert split_attr_names("Electrons.pt(), Electrons.isolation(0.4, 1),"
+                                "Electrons.isolation(0.2, ',') , ") == \
+            ["Electrons.pt()", "Electrons.isolation(0.4, 1)", "Electrons.isolation(0.2, ',')"]
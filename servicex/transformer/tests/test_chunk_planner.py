@@ -0,0 +1,85 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestChunkPlanner:
+    def _batch(self, num_rows):
+        import pyarrow as pa
+        return pa.RecordBatch.from_arrays([pa.array(range(num_rows))], ['x'])
+
+    def _serialize(self, bytes_per_row):
+        import pyarrow as pa
+
+        def serialize(batch):
+            return pa.py_buffer(b'x' * (bytes_per_row * batch.num_rows))
+        return serialize
+
+    def test_initial_chunk_size(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        assert ChunkPlanner(1000).next_chunk_size() == 100
+        assert ChunkPlanner(1000, 42).next_chunk_size() == 42
+
+    def test_adapts_to_bytes_per_event(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        planner = ChunkPlanner(10000, 10, fill_fraction=0.5)
+        pieces = list(planner.fit(self._batch(10), self._serialize(50)))
+        assert len(pieces) == 1
+        assert planner.bytes_per_event == 50
+        assert planner.next_chunk_size() == 100
+
+    def test_fixed_chunk_size(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        planner = ChunkPlanner(10000, 10, adaptive=False)
+        list(planner.fit(self._batch(10), self._serialize(50)))
+        assert planner.next_chunk_size() == 10
+
+    def test_split_oversized_batch(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        planner = ChunkPlanner(250, 10)
+        pieces = list(planner.fit(self._batch(10), self._serialize(100)))
+
+        assert [piece.num_rows for piece, _ in pieces] == [2, 1, 2, 2, 1, 2]
+        assert all(buffer.size <= 250 for _, buffer in pieces)
+        assert [piece.column(0)[0].as_py() for piece, _ in pieces] == [0, 2, 3, 5, 7, 8]
+        assert planner.num_splits == 5
+
+    def test_split_releases_dropped_buffers(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        planner = ChunkPlanner(250, 10)
+        released = []
+        pieces = list(planner.fit(self._batch(4), self._serialize(100), released.append))
+
+        assert len(pieces) == 2
+        assert [buffer.size for buffer in released] == [400]
+
+    def test_single_event_over_limit(self):
+        from servicex.transformer.chunk_planner import ChunkPlanner
+        planner = ChunkPlanner(10, 1)
+        pieces = list(planner.fit(self._batch(1), self._serialize(100)))
+        assert len(pieces) == 1
@@ -0,0 +1,162 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+import pytest
+
+from servicex.transformer.fan_out import FanOut, Sink, SinkError
+
+
+def recorder(items, n_bytes=10):
+    def publish(item):
+        items.append(item)
+        return 1, n_bytes
+    return publish
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestFanOut:
+    def test_every_sink_gets_every_item(self):
+        kafka_items = []
+        store_items = []
+        done = []
+        fan_out = FanOut([Sink('kafka', recorder(kafka_items)),
+                          Sink('object-store', recorder(store_items, 100))],
+                         on_done=done.append)
+        for item in range(5):
+            fan_out.publish(item)
+        fan_out.close()
+        fan_out.check()
+
+        assert kafka_items == [0, 1, 2, 3, 4]
+        assert store_items == [0, 1, 2, 3, 4]
+        assert sorted(done) == [0, 1, 2, 3, 4]
+
+        report = fan_out.report()
+        assert report['kafka']['status'] == 'success'
+        assert report['kafka']['messages'] == 5
+        assert report['kafka']['bytes'] == 50
+        assert report['object-store']['bytes'] == 500
+
+    def test_slow_sink_does_not_stall_fast_sink(self):
+        slow_started = threading.Event()
+        release_slow = threading.Event()
+        fast_items = []
+
+        def slow(item):
+            slow_started.set()
+            release_slow.wait(5)
+            return 1, 0
+
+        fan_out = FanOut([Sink('object-store', slow, queue_depth=4),
+                          Sink('kafka', recorder(fast_items), queue_depth=4)])
+        for item in range(4):
+            fan_out.publish(item)
+        slow_started.wait(5)
+
+        # The fast sink keeps going while the slow one is stuck on its first item
+        for _ in range(100):
+            if len(fast_items) == 4:
+                break
+            threading.Event().wait(0.01)
+        assert fast_items == [0, 1, 2, 3]
+
+        release_slow.set()
+        fan_out.close()
+        assert fan_out.report()['object-store']['messages'] == 4
+
+    def test_failed_sink(self):
+        kafka_items = []
+        done = []
+
+        def failing(item):
+            if item == 1:
+                raise IOError("Upload failed")
+            return 1, 10
+
+        finished = []
+        fan_out = FanOut([Sink('object-store', failing, lambda: finished.append(True)),
+                          Sink('kafka', recorder(kafka_items))],
+                         on_done=done.append)
+        for item in range(3):
+            fan_out.publish(item)
+        fan_out.close()
+
+        assert kafka_items == [0, 1, 2]
+        assert sorted(done) == [0, 1, 2]
+        assert finished == []
+
+        with pytest.raises(SinkError) as error:
+            fan_out.check()
+        assert 'object-store' in str(error.value)
+        report = error.value.report
+        assert report['object-store']['status'] == 'failure'
+        assert report['object-store']['error'] == 'Upload failed'
+        assert report['object-store']['messages'] == 1
+        assert report['kafka']['status'] == 'success'
+
+    def test_finish_counts(self):
+        fan_out = FanOut([Sink('object-store', recorder([]), lambda: (0, 7))])
+        fan_out.publish('batch')
+        fan_out.close()
+        report = fan_out.report()['object-store']
+        assert report['messages'] == 1
+        assert report['bytes'] == 17
+
+    def test_failed_finish(self):
+        def flush():
+            raise RuntimeError("Undelivered messages")
+
+        fan_out = FanOut([Sink('kafka', recorder([]), flush)])
+        fan_out.publish('batch')
+        fan_out.close()
+        with pytest.raises(SinkError):
+            fan_out.check()
+
+    def test_abort(self):
+        items = []
+        done = []
+        finished = []
+        sink = Sink('kafka', recorder(items), lambda: finished.append(True))
+        fan_out = FanOut([sink], on_done=done.append)
+        sink._aborted = True
+        fan_out.publish('batch')
+        fan_out.close(abort=True)
+
+        assert items == []
+        assert done == ['batch']
+        assert finished == []
+        fan_out.check()
+
+    def test_no_sinks(self):
+        done = []
+        fan_out = FanOut([], on_done=done.append)
+        fan_out.publish('batch')
+        fan_out.close()
+        assert done == ['batch']
+        assert fan_out.report() == {}
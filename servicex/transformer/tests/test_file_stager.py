@@ -0,0 +1,118 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+
+import pytest
+
+from servicex.transformer.file_stager import FileStager, is_remote
+
+
+def _copy_sized(sizes):
+    def copy(source, destination):
+        with open(destination, 'wb') as staged:
+            staged.write(b'x' * sizes[source])
+    return copy
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestFileStager:
+    def test_is_remote(self):
+        assert is_remote('root://eospublic.cern.ch//eos/a.root')
+        assert is_remote('https://host/a.root')
+        assert not is_remote('/data/a.root')
+        assert not is_remote('file:///data/a.root')
+
+    def test_local_files_used_directly(self, tmpdir):
+        stager = FileStager(str(tmpdir.join('scratch')), 100, copy_function=None)
+        assert stager.stage('/data/a.root').result() == '/data/a.root'
+        assert stager.stage('file:///data/a.root').result() == '/data/a.root'
+        assert stager.stats()['misses'] == 0
+
+    def test_stage_and_reuse(self, tmpdir, mocker):
+        copy = mocker.Mock(side_effect=_copy_sized({'root://host//a.root': 10}))
+        stager = FileStager(str(tmpdir), 100, copy_function=copy)
+
+        local_path = stager.stage('root://host//a.root').result()
+        assert local_path == stager.local_path('root://host//a.root')
+        assert local_path.endswith('-a.root')
+        assert os.path.getsize(local_path) == 10
+
+        stager.release('root://host//a.root')
+        assert stager.stage('root://host//a.root').result() == local_path
+        assert copy.call_count == 1
+        stats = stager.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['staged-bytes'] == 10
+        stager.shutdown()
+
+    def test_lru_eviction(self, tmpdir):
+        sizes = {'root://host//a.root': 40, 'root://host//b.root': 40,
+                 'root://host//c.root': 40}
+        stager = FileStager(str(tmpdir), 100, copy_function=_copy_sized(sizes))
+
+        a = stager.stage('root://host//a.root').result()
+        stager.release('root://host//a.root')
+        b = stager.stage('root://host//b.root').result()
+        stager.release('root://host//b.root')
+
+        # Using a again makes b the least recently used
+        stager.stage('root://host//a.root').result()
+        stager.release('root://host//a.root')
+
+        c = stager.stage('root://host//c.root').result()
+        assert os.path.exists(a)
+        assert not os.path.exists(b)
+        assert os.path.exists(c)
+        assert stager.stats()['evictions'] == 1
+        assert stager.stats()['staged-bytes'] == 80
+
+    def test_files_in_use_not_evicted(self, tmpdir):
+        sizes = {'root://host//a.root': 80, 'root://host//b.root': 80}
+        stager = FileStager(str(tmpdir), 100, copy_function=_copy_sized(sizes))
+
+        a = stager.stage('root://host//a.root').result()
+        b = stager.stage('root://host//b.root').result()
+        assert os.path.exists(a) and os.path.exists(b)
+
+        # Over budget until a file is released
+        stager.release('root://host//a.root')
+        assert not os.path.exists(a)
+        assert os.path.exists(b)
+
+    def test_failed_copy(self, tmpdir):
+        def copy(source, destination):
+            with open(destination, 'w') as partial:
+                partial.write('half')
+            raise IOError("connection reset")
+
+        stager = FileStager(str(tmpdir), 100, copy_function=copy)
+        with pytest.raises(IOError):
+            stager.stage('root://host//a.root').result()
+        assert tmpdir.listdir() == []
+        assert stager.stats()['staged-files'] == 0
@@ -0,0 +1,264 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pyarrow as pa
+import pytest
+
+from servicex.transformer.kafka_messaging import KafkaMessaging
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestKafkaMessaging:
+    def _buffer(self, mocker, value=b'data'):
+        return pa.py_buffer(value)
+
+    def test_init_async(self, mocker):
+        mock_producer = mocker.patch('confluent_kafka.Producer')
+        KafkaMessaging(['broker:9092'], 2, async_publish=True,
+                       compression='lz4', linger_ms=20, batch_size=1000)
+        config = mock_producer.call_args[0][0]
+        assert config['bootstrap.servers'] == 'broker:9092'
+        assert config['message.max.bytes'] == 2000000
+        assert config['compression.type'] == 'lz4'
+        assert config['linger.ms'] == 20
+        assert config['batch.size'] == 1000
+
+    def test_publish_async_does_not_flush(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        buffer = self._buffer(mocker)
+        assert messaging.publish_message('my-topic', 'key-0', buffer)
+        producer.produce.assert_called_once()
+        assert producer.produce.call_args[0][0] == 'my-topic'
+        assert producer.produce.call_args[1]['value'] is buffer
+        producer.flush.assert_not_called()
+        assert messaging.in_flight == 1
+
+        producer.flush = mocker.Mock(return_value=0)
+        messaging.flush()
+        producer.flush.assert_called_once()
+
+    def test_publish_sync_without_copy(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('kafka.KafkaProducer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'])
+
+        assert messaging.publish_message('my-topic', 'key-0', self._buffer(mocker))
+        value = producer.send.call_args[1]['value']
+        assert isinstance(value, memoryview)
+        assert value.tobytes() == b'data'
+        producer.flush.assert_called_once()
+
+    def test_warm_up_fetches_metadata(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.warm_up('my-topic')
+        producer.list_topics.assert_called_once_with(timeout=30)
+
+    def test_in_flight_window(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True, max_in_flight=1)
+
+        def deliver(timeout):
+            if timeout:
+                on_delivery = producer.produce.call_args[1]['on_delivery']
+                on_delivery(None, mocker.Mock())
+        producer.poll = mocker.Mock(side_effect=deliver)
+
+        messaging.publish_message('my-topic', 'key-0', self._buffer(mocker))
+        messaging.publish_message('my-topic', 'key-1', self._buffer(mocker))
+
+        producer.poll.assert_any_call(1.0)
+        assert producer.produce.call_count == 2
+        assert messaging.in_flight == 1
+
+    def test_retry_when_queue_full(self, mocker):
+        producer = mocker.Mock()
+        producer.produce = mocker.Mock(side_effect=[BufferError(), None])
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.publish_message('my-topic', 'key-0', self._buffer(mocker))
+        assert producer.produce.call_count == 2
+
+    def test_flush_raises_delivery_errors(self, mocker):
+        producer = mocker.Mock()
+        producer.flush = mocker.Mock(return_value=0)
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.publish_message('my-topic', 'key-0', self._buffer(mocker))
+        on_delivery = producer.produce.call_args[1]['on_delivery']
+        on_delivery('Broker: Message size too large', None)
+
+        with pytest.raises(RuntimeError):
+            messaging.flush()
+        assert not messaging.delivery_errors
+
+    def test_flush_raises_undelivered(self, mocker):
+        producer = mocker.Mock()
+        producer.flush = mocker.Mock(return_value=3)
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        with pytest.raises(RuntimeError):
+            messaging.flush()
+
+    def _topic_metadata(self, mocker, topic_name, num_partitions):
+        topic = mocker.Mock(error=None, partitions=dict((p, None) for p in range(num_partitions)))
+        return mocker.Mock(topics={topic_name: topic})
+
+    def test_round_robin_partitions(self, mocker):
+        producer = mocker.Mock()
+        producer.list_topics.return_value = self._topic_metadata(mocker, 'my-topic', 3)
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True,
+                                   partitioner='round-robin')
+
+        for i in range(4):
+            messaging.publish_message('my-topic', 'key-' + str(i), self._buffer(mocker))
+
+        partitions = [call[1]['partition'] for call in producer.produce.call_args_list]
+        assert partitions == [0, 1, 2, 0]
+        assert producer.produce.call_args[1]['headers'] == [('batch-key', 'key-3')]
+        producer.list_topics.assert_called_once_with('my-topic', timeout=30)
+
+    def test_round_robin_partitions_sync(self, mocker):
+        producer = mocker.Mock()
+        producer.partitions_for.return_value = set([0, 1])
+        mocker.patch('kafka.KafkaProducer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], partitioner='round-robin')
+
+        for i in range(3):
+            messaging.publish_message('my-topic', 'key-' + str(i), self._buffer(mocker))
+
+        partitions = [call[1]['partition'] for call in producer.send.call_args_list]
+        assert partitions == [0, 1, 0]
+        assert producer.send.call_args[1]['headers'] == [('batch-key', b'key-2')]
+
+    def test_partition_lookup_retried_until_topic_exists(self, mocker):
+        producer = mocker.Mock()
+        producer.list_topics.side_effect = [
+            mocker.Mock(topics={}),
+            Exception('Timed out'),
+            self._topic_metadata(mocker, 'my-topic', 2)
+        ]
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True,
+                                   partitioner='round-robin')
+
+        messaging.warm_up('my-topic')
+        for i in range(4):
+            messaging.publish_message('my-topic', 'key-' + str(i), self._buffer(mocker))
+
+        partitions = [call[1].get('partition') for call in producer.produce.call_args_list]
+        assert partitions == [None, 0, 1, 0]
+        assert producer.list_topics.call_count == 3
+
+    def test_size_balanced_partitions(self, mocker):
+        producer = mocker.Mock()
+        producer.list_topics.return_value = self._topic_metadata(mocker, 'my-topic', 2)
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True,
+                                   partitioner='size-balanced')
+
+        for value in [b'x' * 100, b'x' * 10, b'x' * 10, b'x' * 10]:
+            messaging.publish_message('my-topic', 'key', self._buffer(mocker, value))
+
+        partitions = [call[1]['partition'] for call in producer.produce.call_args_list]
+        assert partitions == [0, 1, 1, 1]
+
+    def test_hash_partitioner_leaves_partition_to_producer(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.publish_message('my-topic', 'key-0', self._buffer(mocker))
+        assert 'partition' not in producer.produce.call_args[1]
+        producer.list_topics.assert_not_called()
+
+    def test_unknown_partitioner(self, mocker):
+        mocker.patch('confluent_kafka.Producer')
+        with pytest.raises(ValueError):
+            KafkaMessaging(['broker:9092'], async_publish=True, partitioner='random')
+
+    def test_delivery_report(self, mocker):
+        producer = mocker.Mock()
+        mocker.patch('confluent_kafka.Producer', return_value=producer)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        for partition, value in [(0, b'abc'), (1, b'de'), (0, b'f')]:
+            messaging.publish_message('my-topic', 'key', self._buffer(mocker, value))
+            msg = mocker.Mock()
+            msg.topic.return_value = 'my-topic'
+            msg.partition.return_value = partition
+            producer.produce.call_args[1]['on_delivery'](None, msg)
+
+        assert messaging.delivery_report('my-topic') == {
+            'partitioner': 'hash',
+            'partition-bytes': {'0': 4, '1': 2}
+        }
+        assert messaging.delivery_report('my-topic')['partition-bytes'] == {}
+
+    def test_ensure_topic_creates(self, mocker):
+        admin = mocker.Mock()
+        admin.list_topics.return_value = mocker.Mock(topics={})
+        mocker.patch('confluent_kafka.Producer')
+        mocker.patch('confluent_kafka.admin.AdminClient', return_value=admin)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True,
+                                   topic_partitions=8, replication_factor=2)
+
+        messaging.ensure_topic('my-topic', 8)
+        new_topic = admin.create_topics.call_args[0][0][0]
+        assert new_topic.topic == 'my-topic'
+        assert new_topic.num_partitions == 8
+        assert new_topic.replication_factor == 2
+
+    def test_ensure_topic_grows(self, mocker):
+        admin = mocker.Mock()
+        admin.list_topics.return_value = self._topic_metadata(mocker, 'my-topic', 2)
+        mocker.patch('confluent_kafka.Producer')
+        mocker.patch('confluent_kafka.admin.AdminClient', return_value=admin)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.ensure_topic('my-topic', 8)
+        admin.create_topics.assert_not_called()
+        assert admin.create_partitions.call_args[0][0][0].new_total_count == 8
+
+    def test_ensure_topic_not_permitted(self, mocker):
+        admin = mocker.Mock()
+        admin.list_topics.side_effect = Exception('Topic authorization failed')
+        mocker.patch('confluent_kafka.Producer')
+        mocker.patch('confluent_kafka.admin.AdminClient', return_value=admin)
+        messaging = KafkaMessaging(['broker:9092'], async_publish=True)
+
+        messaging.ensure_topic('my-topic', 8)
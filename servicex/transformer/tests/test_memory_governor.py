@@ -0,0 +1,153 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+import numpy
+import pyarrow as pa
+
+from servicex.transformer.memory_governor import MemoryGovernor, current_rss, sizeof
+
+
+class Holder:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeRSS:
+    def __init__(self, rss):
+        self.rss = rss
+
+    def __call__(self):
+        return self.rss
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestMemoryGovernor:
+    def test_current_rss(self):
+        assert current_rss() > 0
+
+    def test_sizeof(self):
+        chunk = {
+            'Electrons': {
+                'offsets': numpy.zeros(11, dtype=numpy.int32),
+                'content': {'pt': numpy.empty(100, dtype=numpy.float64)}
+            }
+        }
+        assert sizeof(chunk) == 44 + 800
+        assert sizeof((pa.py_buffer(b'abcd'), [b'ef'])) == 6
+        # Measured by pympler
+        assert sizeof(Holder(list(range(100)))) > 800
+
+    def test_accounting(self):
+        governor = MemoryGovernor(rss_function=FakeRSS(1000))
+        governor.add(300)
+        governor.add(200)
+        governor.remove(400)
+        assert governor.in_flight_bytes == 100
+        assert governor.report()['peak-in-flight-bytes'] == 500
+
+        governor.start_file()
+        assert governor.in_flight_bytes == 0
+        assert governor.report()['peak-in-flight-bytes'] == 0
+
+    def test_no_ceiling(self):
+        rss = FakeRSS(10 ** 12)
+        governor = MemoryGovernor(rss_function=rss)
+        governor.add(100)
+        governor.wait_for_room()
+        assert governor.chunk_size(1000) == 1000
+        assert governor.report()['peak-rss'] == 10 ** 12
+
+    def test_chunk_shrinks_and_recovers(self):
+        rss = FakeRSS(900)
+        governor = MemoryGovernor(1000, soft_fraction=0.8, rss_function=rss)
+        governor.add(500)
+
+        assert governor.chunk_size(1000) == 500
+        assert governor.chunk_size(1000) == 250
+
+        rss.rss = 700
+        assert governor.chunk_size(1000) == 500
+        assert governor.chunk_size(1000) == 1000
+        assert governor.report()['min-chunk-scale'] == 0.25
+
+    def test_chunk_kept_when_baseline_over_limit(self):
+        governor = MemoryGovernor(1000, soft_fraction=0.8, rss_function=FakeRSS(900))
+        governor.add(50)
+        assert governor.chunk_size(1000) == 1000
+
+    def test_min_scale(self):
+        governor = MemoryGovernor(1000, min_scale=0.5, rss_function=FakeRSS(900))
+        governor.add(500)
+        governor.chunk_size(10)
+        governor.chunk_size(10)
+        assert governor.chunk_size(10) == 5
+
+    def test_reader_waits_for_publish(self):
+        rss = FakeRSS(900)
+        governor = MemoryGovernor(1000, rss_function=rss)
+        governor.add(500)
+
+        def publish():
+            time.sleep(0.2)
+            rss.rss = 400
+            governor.remove(500)
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        start = time.time()
+        governor.wait_for_room()
+        publisher.join()
+
+        assert time.time() - start >= 0.2
+        report = governor.report()
+        assert report['pauses'] == 1
+        assert report['pause-time'] > 0.0
+
+    def test_reader_not_paused_without_chunks_in_flight(self):
+        governor = MemoryGovernor(1000, rss_function=FakeRSS(2000))
+        governor.wait_for_room()
+        assert governor.report()['pauses'] == 0
+
+    def test_pause_timeout(self):
+        governor = MemoryGovernor(1000, pause_timeout=0.1, poll_interval=0.01,
+                                  rss_function=FakeRSS(900))
+        governor.add(500)
+        governor.wait_for_room()
+        assert governor.pause_time >= 0.1
+
+    def test_throttle_accounts_items(self):
+        governor = MemoryGovernor(rss_function=FakeRSS(1000))
+        items = list(governor.throttle([b'abc', b'de']))
+        assert items == [b'abc', b'de']
+        assert governor.in_flight_bytes == 5
+
+        governor.start_file()
+        list(governor.throttle([b'abc'], size_function=lambda item: 100))
+        assert governor.in_flight_bytes == 100
@@ -0,0 +1,121 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+
+from servicex.transformer.metrics import FileTimer, TransformMetrics, clear_textfiles, \
+    merge_textfiles, serve_metrics
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestMetrics:
+    def test_file_timer(self):
+        timer = FileTimer()
+        timer.add('read', 1.5)
+        timer.add('read', 0.5)
+        with timer.time('publish'):
+            pass
+        stages = timer.as_dict()
+        assert stages['read'] == 2.0
+        assert stages['publish'] >= 0.0
+        assert timer.elapsed() >= 0.0
+
+    def test_render(self):
+        metrics = TransformMetrics()
+        timer = FileTimer()
+        timer.add('read', 2.0)
+        metrics.observe_file('req-1', timer, events=100, n_bytes=2000, messages=3)
+        metrics.observe_file('req-1', timer, events=50, n_bytes=1000, messages=1)
+        metrics.inc('req-2', 'failures')
+
+        text = metrics.render()
+        pid = str(os.getpid())
+        assert 'servicex_transformer_events_total{pid="' + pid + \
+            '",request_id="req-1"} 150' in text
+        assert 'servicex_transformer_files_total{pid="' + pid + \
+            '",request_id="req-1"} 2' in text
+        assert 'servicex_transformer_failures_total{pid="' + pid + \
+            '",request_id="req-2"} 1' in text
+        assert 'servicex_transformer_stage_seconds_total{pid="' + pid + \
+            '",request_id="req-1",stage="read"} 4.0' in text
+        assert '# TYPE servicex_transformer_bytes_total counter' in text
+
+    def test_gauges(self):
+        metrics = TransformMetrics()
+        metrics.set_gauge('ready_seconds', 1.5, 'Seconds until ready')
+        metrics.set_gauge('ready_seconds', 2.5, 'Seconds until ready')
+
+        text = metrics.render()
+        assert '# TYPE servicex_transformer_ready_seconds gauge' in text
+        assert 'servicex_transformer_ready_seconds{pid="' + str(os.getpid()) + \
+            '"} 2.5' in text
+
+    def test_label_escaping(self):
+        metrics = TransformMetrics()
+        metrics.inc('a"b', 'files')
+        assert 'request_id="a\\"b"' in metrics.render()
+
+    def test_textfiles(self, tmpdir):
+        metrics = TransformMetrics(str(tmpdir))
+        metrics.inc('req-1', 'files')
+        metrics.write_textfile()
+        assert os.path.exists(metrics.textfile_path())
+
+        # Another process's file
+        tmpdir.join('transformer-1.prom').write(
+            '# HELP servicex_transformer_files_total Files transformed\n'
+            '# TYPE servicex_transformer_files_total counter\n'
+            'servicex_transformer_files_total{pid="1",request_id="req-1"} 4\n')
+
+        merged = merge_textfiles(str(tmpdir))
+        assert merged.count('# TYPE servicex_transformer_files_total counter') == 1
+        assert 'servicex_transformer_files_total{pid="1",request_id="req-1"} 4' in merged
+        assert 'pid="' + str(os.getpid()) + '",request_id="req-1"} 1' in merged
+
+        clear_textfiles(str(tmpdir))
+        assert tmpdir.listdir() == []
+
+    def test_write_textfile_without_dir(self):
+        TransformMetrics().write_textfile()
+
+    def test_serve_metrics(self, tmpdir):
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+
+        metrics = TransformMetrics(str(tmpdir))
+        metrics.inc('req-1', 'messages', 7)
+        metrics.write_textfile()
+
+        server = serve_metrics(0, str(tmpdir))
+        try:
+            body = urlopen('http://localhost:' + str(server.server_port) + '/metrics').read()
+            assert b'servicex_transformer_messages_total' in body
+            assert b'request_id="req-1"} 7' in body
+        finally:
+            server.shutdown()
@@ -25,8 +25,16 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import sys
+
+import pytest
+
 from servicex.transformer.object_store_manager import ObjectStoreManager
 
+# minio 7, which the object store needs, only supports Python 3
+pytestmark = pytest.mark.skipif(sys.version_info[0] < 3,
+                                reason="The object store needs Python 3")
+
 
 class TestObjectStoreManager:
     def test_init(self, mocker):
@@ -37,6 +45,7 @@ class TestObjectStoreManager:
         assert called_config['access_key'] == 'foo'
         assert called_config['secret_key'] == 'bar'
         assert not called_config['secure']
+        assert called_config['http_client']
 
     def test_upload_file(self, mocker):
         import minio
@@ -46,3 +55,219 @@ class TestObjectStoreManager:
         result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
         result.upload_file("my-bucket", "foo.txt", "/tmp/foo.txt")
         mock_minio.fput_object.assert_called()
+
+    def test_put_bytes(self, mocker):
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.bucket_exists = mocker.Mock(return_value=True)
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+        result.put_bytes("my-bucket", "foo.txt", b'hello')
+        called = mock_minio.put_object.call_args[1]
+        assert called['object_name'] == 'foo.txt'
+        assert called['length'] == 5
+        assert called['data'].read() == b'hello'
+
+    def test_get_bytes_and_list(self, mocker):
+        import datetime
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.bucket_exists = mocker.Mock(return_value=True)
+        response = mocker.Mock()
+        response.read = mocker.Mock(return_value=b'{}')
+        mock_minio.get_object = mocker.Mock(return_value=response)
+        modified = datetime.datetime.now()
+        mock_minio.list_objects = mocker.Mock(return_value=[
+            mocker.Mock(object_name='a.json', size=2, last_modified=modified)])
+        mocker.patch('minio.Minio', return_value=mock_minio)
+
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+        assert result.get_bytes("my-bucket", "a.json") == b'{}'
+        response.release_conn.assert_called_with()
+        assert result.list_objects("my-bucket") == [('a.json', 2, modified)]
+        result.remove_object("my-bucket", "a.json")
+        mock_minio.remove_object.assert_called_with(bucket_name="my-bucket",
+                                                    object_name="a.json")
+
+    def _streaming_minio(self, mocker, uploaded):
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+
+        def put_object(bucket_name, object_name, data, length, part_size,
+                       num_parallel_uploads):
+            assert length == -1
+            while True:
+                part = data.read(part_size)
+                if not part:
+                    break
+                assert len(part) <= part_size
+                uploaded.append(part)
+        mock_minio.put_object = mocker.Mock(side_effect=put_object)
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        return mock_minio
+
+    def test_upload_stream(self, mocker):
+        uploaded = []
+        mock_minio = self._streaming_minio(mocker, uploaded)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        stream = result.open_upload_stream("my-bucket", "foo.arrow", part_size=4)
+        for i in range(5):
+            stream.write(b'abc')
+        assert stream.tell() == 15
+        stream.close()
+
+        assert mock_minio.put_object.call_args[1]['bucket_name'] == 'my-bucket'
+        assert mock_minio.put_object.call_args[1]['object_name'] == 'foo.arrow'
+        assert uploaded == [b'abca', b'bcab', b'cabc', b'abc']
+
+    def test_upload_stream_arrow(self, mocker):
+        import pyarrow as pa
+        uploaded = []
+        self._streaming_minio(mocker, uploaded)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        table = pa.Table.from_arrays([pa.array([1.0, 2.0, 3.0])], ['x'])
+        stream = result.open_upload_stream("my-bucket", "foo.arrow", part_size=64)
+        writer = pa.RecordBatchStreamWriter(pa.PythonFile(stream, mode='w'), table.schema)
+        writer.write_table(table)
+        writer.write_table(table)
+        writer.close()
+        stream.close()
+
+        reader = pa.ipc.open_stream(pa.py_buffer(b''.join(uploaded)))
+        assert reader.read_all().column(0).to_pylist() == [1.0, 2.0, 3.0] * 2
+
+    def test_upload_stream_failure(self, mocker):
+        import minio
+        import pytest
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.put_object = mocker.Mock(side_effect=Exception("No such bucket"))
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        stream = result.open_upload_stream("my-bucket", "foo.arrow", part_size=1,
+                                           max_buffered_parts=1)
+        with pytest.raises(IOError):
+            for i in range(100):
+                stream.write(b'abc')
+            stream.close()
+
+    def test_ensure_bucket_cached(self, mocker):
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.bucket_exists = mocker.Mock(return_value=False)
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        result.ensure_bucket("my-bucket")
+        result.ensure_bucket("my-bucket")
+
+        mock_minio.bucket_exists.assert_called_once_with("my-bucket")
+        mock_minio.make_bucket.assert_called_once_with("my-bucket")
+
+    def test_warm_up(self, mocker):
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.bucket_exists = mocker.Mock(return_value=True)
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        result.warm_up()
+        mock_minio.list_buckets.assert_called_once()
+
+        result.warm_up("my-bucket")
+        mock_minio.bucket_exists.assert_called_once_with("my-bucket")
+        mock_minio.make_bucket.assert_not_called()
+
+    def test_upload_file_async(self, mocker):
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar',
+                                    parallel_part_uploads=4)
+
+        future = result.upload_file_async("my-bucket", "foo.txt", "/tmp/foo.txt")
+        future.result()
+
+        upload_args = mock_minio.fput_object.call_args[1]
+        assert upload_args['bucket_name'] == 'my-bucket'
+        assert upload_args['file_path'] == '/tmp/foo.txt'
+        assert upload_args['num_parallel_uploads'] == 4
+        result.shutdown()
+
+    def test_upload_file_async_failure(self, mocker):
+        import minio
+        import pytest
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        mock_minio.fput_object = mocker.Mock(side_effect=Exception("Access denied"))
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        future = result.upload_file_async("my-bucket", "foo.txt", "/tmp/foo.txt")
+        with pytest.raises(Exception):
+            future.result()
+
+    def test_upload_queue_bounded(self, mocker):
+        import threading
+        import minio
+        mock_minio = mocker.MagicMock(minio.api.Minio)
+        release = threading.Event()
+        mock_minio.fput_object = mocker.Mock(side_effect=lambda **kwargs: release.wait())
+        mocker.patch('minio.Minio', return_value=mock_minio)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar',
+                                    upload_workers=1, max_queued_uploads=1)
+
+        result.upload_file_async("my-bucket", "1.txt", "/tmp/1.txt")
+        result.upload_file_async("my-bucket", "2.txt", "/tmp/2.txt")
+
+        blocked = threading.Thread(
+            target=result.upload_file_async, args=("my-bucket", "3.txt", "/tmp/3.txt"))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive()
+
+        release.set()
+        blocked.join()
+        result.shutdown()
+        assert mock_minio.fput_object.call_count == 3
+
+    def test_upload_stream_finish(self, mocker):
+        uploaded = []
+        self._streaming_minio(mocker, uploaded)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar')
+
+        stream = result.open_upload_stream("my-bucket", "foo.arrow", part_size=4)
+        stream.write(b'abcdef')
+        future = stream.finish()
+        future.result()
+        assert uploaded == [b'abcd', b'ef']
+
+    def test_upload_stream_abort(self, mocker):
+        import pytest
+        uploaded = []
+        self._streaming_minio(mocker, uploaded)
+        result = ObjectStoreManager('localhost:9999', 'foo', 'bar',
+                                    upload_workers=1, max_queued_uploads=0)
+
+        def write_result(stream):
+            stream.write(b'abcdef')
+            raise RuntimeError("Transform failed")
+
+        stream = result.open_upload_stream("my-bucket", "foo.arrow", part_size=4)
+        with pytest.raises(RuntimeError):
+            try:
+                write_result(stream)
+            except Exception:
+                stream.abort()
+                raise
+
+        with pytest.raises(IOError):
+            stream.abort().result(timeout=5)
+        assert uploaded == [b'abcd']
+
+        # The upload worker is free for the next file
+        stream = result.open_upload_stream("my-bucket", "bar.arrow", part_size=4)
+        stream.write(b'xyz')
+        stream.finish().result(timeout=5)
+        assert uploaded == [b'abcd', b'xyz']
@@ -0,0 +1,116 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestParallelTransform:
+    def test_entry_ranges(self):
+        from servicex.transformer.parallel_transform import entry_ranges
+        assert entry_ranges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+        assert entry_ranges(2, 4) == [(0, 1), (1, 2)]
+        assert entry_ranges(0, 4) == [(0, 0)]
+
+    def test_cpu_limit_from_cgroup_v2(self, mocker):
+        from servicex.transformer import parallel_transform
+        mocker.patch.object(parallel_transform, 'open',
+                            mocker.mock_open(read_data='400000 100000'), create=True)
+        assert parallel_transform.cpu_limit() == 4
+
+    def test_workers_capped_at_cpu_limit(self, mocker):
+        from servicex.transformer import parallel_transform
+        mocker.patch.object(parallel_transform, 'cpu_limit', return_value=2)
+        parallel = parallel_transform.ParallelTransform("foo/bar", ["Muons.e()"], 16)
+        assert parallel.n_workers == 2
+
+    def test_transform_range(self, mocker):
+        import numpy
+        import pyarrow as pa
+        from servicex.transformer import parallel_transform
+
+        events = mocker.Mock()
+        events.attr_name_list = ["Muons.e()"]
+        events.iterate_columnar = mocker.Mock(return_value=iter([
+            {'Muons': {'offsets': numpy.array([0, 1, 3], dtype=numpy.int32),
+                       'content': {'e()': numpy.array([1.0, 2.0, 3.0])}}}
+        ]))
+        mock_events = mocker.patch.object(parallel_transform, 'XAODEvents',
+                                          return_value=events)
+        parallel_transform._worker_events.clear()
+
+        serialized = parallel_transform._transform_range(
+            ("foo/bar", ["Muons.e()"], 10, 12, 2, 1000000, 'arrow'))
+
+        mock_events.assert_called_with("foo/bar", ["Muons.e()"], cache_config=None)
+        assert events.entry_start == 10
+        assert events.entry_stop == 12
+        assert len(serialized) == 1
+        batch = pa.ipc.open_stream(pa.py_buffer(serialized[0])).read_next_batch()
+        assert batch.to_pydict() == {'Muons_e': [[1.0], [2.0, 3.0]]}
+
+    def test_worker_cache_config(self, mocker):
+        from servicex.transformer import parallel_transform
+        from servicex.transformer.xaod_events import TreeCacheConfig
+
+        mock_events = mocker.patch.object(parallel_transform, 'XAODEvents')
+        parallel_transform._worker_events.clear()
+        cache_config = TreeCacheConfig(cache_size=1000)
+        parallel_transform._init_worker(cache_config)
+        try:
+            parallel_transform._open_events("foo/bar", ["Muons.e()"])
+        finally:
+            parallel_transform._init_worker(None)
+            parallel_transform._worker_events.clear()
+
+        mock_events.assert_called_with("foo/bar", ["Muons.e()"], cache_config=cache_config)
+
+    def test_iterate_bounds_ranges(self, mocker):
+        from servicex.transformer import parallel_transform
+        mocker.patch.object(parallel_transform, 'cpu_limit', return_value=2)
+
+        submitted = []
+        submitted_at_get = []
+
+        def get():
+            submitted_at_get.append(len(submitted))
+            return []
+
+        def apply_async(function, args):
+            submitted.append(args[0][2:4])
+            return mocker.Mock(get=get)
+
+        pool = mocker.Mock(apply=mocker.Mock(return_value=25), apply_async=apply_async)
+        mocker.patch('multiprocessing.Pool', return_value=pool)
+        parallel = parallel_transform.ParallelTransform("foo/bar", ["Muons.e()"], 2,
+                                                        ranges_per_worker=1,
+                                                        max_range_events=10,
+                                                        ranges_ahead=1)
+        results = parallel.iterate()
+        assert list(results) == []
+        assert submitted == [(0, 8), (8, 16), (16, 25)]
+        # No more than one range per worker ahead of the one taken
+        assert submitted_at_get == [2, 3, 3]
@@ -0,0 +1,88 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+
+from servicex.transformer.pipeline import Pipeline
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestPipeline:
+    def test_run_in_order(self):
+        results = []
+        pipeline = Pipeline(range(10),
+                            [('double', lambda x: 2 * x),
+                             ('increment', lambda x: x + 1),
+                             ('collect', results.append)],
+                            queue_depth=1)
+        pipeline.run()
+
+        assert results == [2 * x + 1 for x in range(10)]
+        report = pipeline.report()
+        assert sorted(report.keys()) == ['collect', 'double', 'increment', 'read']
+        assert report['read']['items'] == 10
+        assert report['collect']['items'] == 10
+
+    def test_queue_depth_per_stage(self):
+        pipeline = Pipeline([], [('a', lambda x: x), ('b', lambda x: x)],
+                            queue_depth={'a': 5})
+        assert pipeline._depth('a') == 5
+        assert pipeline._depth('b') == 2
+
+    def test_stage_error_stops_pipeline(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError("bad chunk")
+            return x
+
+        results = []
+        pipeline = Pipeline(range(100),
+                            [('fail', fail), ('collect', results.append)])
+        with pytest.raises(ValueError):
+            pipeline.run()
+        assert 3 not in results
+
+    def test_source_error_stops_pipeline(self):
+        def source():
+            yield 1
+            raise IOError("read failed")
+
+        pipeline = Pipeline(source(), [('collect', lambda x: x)])
+        with pytest.raises(IOError):
+            pipeline.run()
+
+    def test_bottleneck(self):
+        import time
+
+        def slow(x):
+            time.sleep(0.01)
+            return x
+
+        pipeline = Pipeline(range(5), [('fast', lambda x: x), ('slow', slow)])
+        pipeline.run()
+        assert pipeline.bottleneck() == 'slow'
+        assert pipeline.report()['fast']['output-stall-time'] >= 0
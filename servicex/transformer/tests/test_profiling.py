@@ -0,0 +1,93 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+from servicex.transformer.profiling import SamplingProfiler, save_profile, should_profile
+
+
+def busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestProfiling:
+    def test_sample(self):
+        profiler = SamplingProfiler()
+        profiler.sample()
+        assert profiler.samples == 1
+        stack, count = profiler.collapsed().splitlines()[0].rsplit(' ', 1)
+        assert count == '1'
+        assert 'test_profiling.py:test_sample' in profiler.collapsed()
+
+    def test_profile_named_thread(self):
+        worker = threading.Thread(target=busy_wait, args=(0.2,), name='pipeline-read')
+        with SamplingProfiler(interval=0.005) as profiler:
+            worker.start()
+            worker.join()
+
+        assert profiler.samples > 0
+        assert 'pipeline-read;' in profiler.collapsed()
+        assert 'test_profiling.py:busy_wait' in profiler.collapsed()
+        # The sampling thread never shows up in its own profile
+        assert 'sampling-profiler' not in profiler.collapsed()
+
+    def test_should_profile(self):
+        assert should_profile('req-1', 'a.root', 0.0, profile_requests=['req-1'])
+        assert not should_profile('req-2', 'a.root', 0.0, profile_requests=['req-1'])
+        assert should_profile('req-2', 'a.root', 1.0)
+
+        files = ['file' + str(i) + '.root' for i in range(1000)]
+        sampled = [f for f in files if should_profile('req', f, 0.1)]
+        assert 50 < len(sampled) < 150
+        # The same files are picked every time
+        assert sampled == [f for f in files if should_profile('req', f, 0.1)]
+
+    def test_save_local(self, tmpdir):
+        profiler = SamplingProfiler()
+        profiler.sample()
+        path = save_profile(profiler, 'root:foo.root', local_dir=str(tmpdir.join('profiles')))
+        assert path == str(tmpdir.join('profiles', 'root:foo.root.profile.txt'))
+        with open(path) as profile_file:
+            assert profile_file.read() == profiler.collapsed()
+
+    def test_save_object_store(self, mocker):
+        object_store = mocker.Mock()
+        profiler = SamplingProfiler()
+        profiler.sample()
+        assert save_profile(profiler, 'foo.root', object_store, 'req-1') == \
+            'req-1/foo.root.profile.txt'
+        object_store.put_bytes.assert_called_with('req-1', 'foo.root.profile.txt',
+                                                  profiler.collapsed().encode('utf-8'))
+
+    def test_save_failure(self, mocker):
+        object_store = mocker.Mock()
+        object_store.put_bytes.side_effect = IOError('no route')
+        assert save_profile(SamplingProfiler(), 'foo.root', object_store, 'req-1') is None
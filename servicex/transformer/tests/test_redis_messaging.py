@@ -0,0 +1,215 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+
+from servicex.transformer.redis_messaging import RedisMessaging
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestRedisMessaging:
+    def _client(self, mocker, xlen=0):
+        client = mocker.Mock()
+        client.xlen = mocker.Mock(return_value=xlen)
+        client.pipeline = mocker.Mock(return_value=mocker.Mock())
+        mocker.patch('redis.Redis', return_value=client)
+        return client
+
+    def test_publish_pipelined(self, mocker):
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=2)
+
+        messaging.publish_message('my-request', 'key-0', b'data-0')
+        client.pipeline.assert_not_called()
+
+        messaging.publish_message('my-request', 'key-1', b'data-1')
+        pipeline = client.pipeline.return_value
+        client.pipeline.assert_called_with(transaction=False)
+        assert pipeline.xadd.call_count == 2
+        pipeline.execute.assert_called_once()
+
+        stream, fields = pipeline.xadd.call_args[0]
+        assert stream == 'req_id:my-request'
+        assert fields['pa'] == 'key-1'
+        assert fields['codec'] == 'none'
+        assert bytes(fields['data']) == b'data-1'
+
+    def test_flush_sends_remaining(self, mocker):
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='bz2', maxlen=500)
+
+        messaging.publish_message('my-request', 'key-0', b'data-0')
+        messaging.flush()
+
+        pipeline = client.pipeline.return_value
+        fields = pipeline.xadd.call_args[0][1]
+        assert fields['codec'] == 'bz2'
+        import bz2
+        assert bz2.decompress(fields['data']) == b'data-0'
+        assert pipeline.xadd.call_args[1] == {'maxlen': 500, 'approximate': True}
+
+        messaging.flush()
+        pipeline.execute.assert_called_once()
+
+    def test_backpressure_waits(self, mocker):
+        client = self._client(mocker)
+        client.xlen = mocker.Mock(side_effect=[100000, 100000, 10])
+        mock_sleep = mocker.patch('time.sleep')
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=1)
+
+        assert messaging.publish_message('my-request', 'key-0', b'data-0')
+        assert mock_sleep.call_count == 2
+        client.pipeline.return_value.execute.assert_called_once()
+
+    def test_backpressure_timeout(self, mocker):
+        self._client(mocker, xlen=100000)
+        mocker.patch('time.sleep')
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=1,
+                                   backpressure_timeout=0)
+
+        with pytest.raises(RuntimeError):
+            messaging.publish_message('my-request', 'key-0', b'data-0')
+
+    def test_connect_retry(self, mocker):
+        import redis
+        client = self._client(mocker)
+        client.ping = mocker.Mock(side_effect=[redis.exceptions.ConnectionError(), True])
+        mock_sleep = mocker.patch('time.sleep')
+        messaging = RedisMessaging('localhost', 6379, codec='none')
+
+        messaging.set_redis_client()
+        assert messaging.client == client
+        mock_sleep.assert_called_once_with(0.5)
+
+    def test_warm_up_connects_once(self, mocker):
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='none')
+
+        messaging.warm_up('my-request')
+        messaging.warm_up('my-request')
+        assert messaging.client == client
+        client.ping.assert_called_once()
+
+    def test_retains_uncompressed_payload(self, mocker):
+        import pyarrow as pa
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=2)
+        assert messaging.retains_payload
+        assert not RedisMessaging('localhost', 6379, codec='lz4').retains_payload
+
+        buffer = pa.py_buffer(b'data-0')
+        messaging.publish_message('my-request', 'key-0', buffer)
+        messaging.flush()
+        _, fields = client.pipeline.return_value.xadd.call_args[0]
+        assert isinstance(fields['data'], memoryview)
+        assert fields['data'].obj is buffer
+
+    def test_unknown_codec(self, mocker):
+        with pytest.raises(ValueError):
+            RedisMessaging('localhost', 6379, codec='rar')
+
+    def test_sharded_round_robin(self, mocker):
+        import json
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=3,
+                                   shards=3, max_messages_per_shard=10)
+
+        for i in range(3):
+            messaging.publish_message('my-request', 'key-' + str(i), b'data')
+
+        pipeline = client.pipeline.return_value
+        streams = [c[0][0] for c in pipeline.xadd.call_args_list]
+        assert streams == ['req_id:my-request:0', 'req_id:my-request:1',
+                           'req_id:my-request:2']
+
+        client.hset.assert_called_once()
+        assert client.hset.call_args[0][0] == 'req_id:my-request:manifest'
+        manifest = client.hset.call_args[1]['mapping']
+        assert manifest['shards'] == 3
+        assert json.loads(manifest['streams']) == streams
+        assert json.loads(manifest['endpoints']) == ['localhost:6379'] * 3
+
+    def test_sharded_endpoints(self, mocker):
+        clients = [mocker.Mock(), mocker.Mock()]
+        for client in clients:
+            client.xlen = mocker.Mock(return_value=0)
+        mock_redis = mocker.patch('redis.Redis', side_effect=clients)
+        messaging = RedisMessaging(codec='none', pipeline_size=4, shards=4,
+                                   endpoints=[('redis-a', 6379), ('redis-b', 6380)])
+
+        for i in range(4):
+            messaging.publish_message('my-request', 'key-' + str(i), b'data')
+
+        assert mock_redis.call_args_list[1][0] == ('redis-b', 6380)
+        streams_a = [c[0][0] for c in clients[0].pipeline.return_value.xadd.call_args_list]
+        streams_b = [c[0][0] for c in clients[1].pipeline.return_value.xadd.call_args_list]
+        assert streams_a == ['req_id:my-request:0', 'req_id:my-request:2']
+        assert streams_b == ['req_id:my-request:1', 'req_id:my-request:3']
+
+    def test_per_shard_limit(self, mocker):
+        client = self._client(mocker, xlen=25)
+        mocker.patch('time.sleep')
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=1,
+                                   shards=4, backpressure_timeout=0)
+        messaging.MAX_MESSAGES_PER_REQUEST = 100
+        messaging.max_messages_per_shard = 25
+
+        with pytest.raises(RuntimeError):
+            messaging.publish_message('my-request', 'key-0', b'data')
+        client.xlen.assert_called_with('req_id:my-request:0')
+
+    def test_pipeline_limited_by_bytes(self, mocker):
+        client = self._client(mocker)
+        messaging = RedisMessaging('localhost', 6379, codec='none', pipeline_size=50,
+                                   pipeline_bytes=10)
+
+        messaging.publish_message('my-request', 'key-0', b'data-0')
+        client.pipeline.assert_not_called()
+        messaging.publish_message('my-request', 'key-1', b'data-1')
+        client.pipeline.return_value.execute.assert_called_once()
+        assert messaging._pending_bytes == 0
+
+    def test_failed_endpoint_not_resent(self, mocker):
+        clients = [mocker.Mock(), mocker.Mock()]
+        for client in clients:
+            client.xlen = mocker.Mock(return_value=0)
+        clients[1].pipeline.return_value.execute.side_effect = \
+            Exception('Connection reset by peer')
+        mocker.patch('redis.Redis', side_effect=clients)
+        messaging = RedisMessaging(codec='none', pipeline_size=4, shards=2,
+                                   endpoints=[('redis-a', 6379), ('redis-b', 6380)])
+
+        messaging.publish_message('my-request', 'key-0', b'data')
+        messaging.publish_message('my-request', 'key-1', b'data')
+        with pytest.raises(Exception):
+            messaging.flush()
+        clients[0].pipeline.return_value.execute.assert_called_once()
+
+        # Neither the delivered nor the failed messages are sent again
+        messaging.flush()
+        clients[0].pipeline.return_value.execute.assert_called_once()
+        clients[1].pipeline.return_value.execute.assert_called_once()
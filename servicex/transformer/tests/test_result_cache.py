@@ -0,0 +1,156 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import datetime
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from servicex.transformer.result_cache import LocalResultCache, ObjectStoreResultCache, \
+    hash_directory, input_identity, result_cache_key
+
+
+def _result(tmpdir, name, size):
+    path = tmpdir.join(name)
+    path.write(b'x' * size, mode='wb')
+    return str(path)
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestResultCache:
+    def test_cache_key(self):
+        key = result_cache_key('checksum:abc', ["Electrons.pt()", "Muons.e()"], 'arrow')
+        assert key == result_cache_key('checksum:abc', [" Electrons.pt( )", "Muons.e()"],
+                                       'arrow')
+        assert key != result_cache_key('checksum:abc', ["Muons.e()", "Electrons.pt()"],
+                                       'arrow')
+        assert key != result_cache_key('checksum:abc', ["Electrons.pt()", "Muons.e()"],
+                                       'parquet')
+        assert key != result_cache_key('checksum:abd', ["Electrons.pt()", "Muons.e()"],
+                                       'arrow')
+        assert key != result_cache_key('checksum:abc', ["Electrons.pt()", "Muons.e()"],
+                                       'arrow', code_hash='1234')
+
+    def test_input_identity(self, tmpdir):
+        assert input_identity('root://host//a.root', checksum='ad:1234') == 'checksum:ad:1234'
+        assert input_identity('root://host//a.root') == 'path:root://host//a.root'
+        local = _result(tmpdir, 'a.root', 10)
+        assert input_identity(local).startswith('local:' + local + ':10:')
+
+    def test_hash_directory(self, tmpdir):
+        assert hash_directory(str(tmpdir.join('missing'))) is None
+        tmpdir.join('query.cxx').write('int main() {}')
+        first = hash_directory(str(tmpdir))
+        assert first == hash_directory(str(tmpdir))
+        tmpdir.join('query.cxx').write('int main() { return 1; }')
+        assert hash_directory(str(tmpdir)) != first
+
+    def test_local_hit_and_miss(self, tmpdir):
+        cache = LocalResultCache(str(tmpdir.join('cache')), 1000)
+        destination = str(tmpdir.join('out.arrow'))
+        assert cache.get('abc', destination) is None
+
+        cache.put('abc', _result(tmpdir, 'result.arrow', 10), {'total-events': 5})
+        assert cache.get('abc', destination) == {'total-events': 5}
+        assert os.path.getsize(destination) == 10
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+    def test_local_lru_eviction(self, tmpdir):
+        cache_dir = tmpdir.join('cache')
+        cache = LocalResultCache(str(cache_dir), 100)
+        destination = str(tmpdir.join('out.arrow'))
+
+        cache.put('a', _result(tmpdir, 'a.arrow', 40), {})
+        cache.put('b', _result(tmpdir, 'b.arrow', 40), {})
+        # Make b the least recently used
+        old = time.time() - 60
+        os.utime(str(cache_dir.join('b.json')), (old, old))
+        os.utime(str(cache_dir.join('a.json')), (old - 60, old - 60))
+        cache.get('a', destination)
+
+        cache.put('c', _result(tmpdir, 'c.arrow', 40), {})
+        assert cache.get('b', destination) is None
+        assert cache.get('a', destination) == {}
+        assert cache.get('c', destination) == {}
+        assert cache.stats()['evictions'] == 1
+
+    @pytest.mark.skipif(sys.version_info[0] < 3, reason="The object store needs Python 3")
+    def test_object_store_cache(self, mocker, tmpdir):
+        from minio.error import S3Error
+
+        stored = {}
+        object_store = mocker.Mock()
+        object_store.put_bytes = mocker.Mock(
+            side_effect=lambda bucket, name, data: stored.__setitem__(name, data))
+
+        def upload_file(bucket, name, path):
+            with open(path, 'rb') as local_file:
+                stored[name] = local_file.read()
+        object_store.upload_file = mocker.Mock(side_effect=upload_file)
+
+        def get_bytes(bucket, name):
+            if name not in stored:
+                raise S3Error(code='NoSuchKey', message='missing', resource=name,
+                              request_id=None, host_id=None, response=None)
+            return stored[name]
+        object_store.get_bytes = mocker.Mock(side_effect=get_bytes)
+
+        def download_file(bucket, name, path):
+            with open(path, 'wb') as local_file:
+                local_file.write(stored[name])
+        object_store.download_file = mocker.Mock(side_effect=download_file)
+
+        now = datetime.datetime.now()
+        object_store.list_objects = mocker.Mock(side_effect=lambda bucket: [
+            (name, len(data), now + datetime.timedelta(seconds=i))
+            for i, (name, data) in enumerate(sorted(stored.items()))])
+        object_store.remove_object = mocker.Mock(
+            side_effect=lambda bucket, name: stored.pop(name))
+
+        cache = ObjectStoreResultCache(object_store, 'result-cache', 50)
+        destination = str(tmpdir.join('out.arrow'))
+        assert cache.get('a', destination) is None
+
+        cache.put('a', _result(tmpdir, 'a.arrow', 30), {'total-events': 3})
+        assert json.loads(stored['a.json'].decode('utf-8')) == {'total-events': 3}
+        assert cache.get('a', destination) == {'total-events': 3}
+        assert os.path.getsize(destination) == 30
+
+        # Over budget, so the oldest entry goes
+        cache.put('b', _result(tmpdir, 'b.arrow', 30), {})
+        assert sorted(stored) == ['b.data', 'b.json']
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1}
+
+    def test_lookup_errors_are_misses(self, mocker, tmpdir):
+        object_store = mocker.Mock()
+        object_store.get_bytes = mocker.Mock(side_effect=IOError("connection refused"))
+        cache = ObjectStoreResultCache(object_store, 'result-cache', 50)
+        assert cache.get('a', str(tmpdir.join('out.arrow'))) is None
+        assert cache.stats()['misses'] == 1
@@ -0,0 +1,128 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pyarrow as pa
+import pytest
+
+from servicex.transformer.serialization import BatchSerializer, BufferPool, format_names
+
+
+def make_batch(num_rows=1000):
+    offsets = pa.array([0] + [2 * (i + 1) for i in range(num_rows)], type=pa.int32())
+    values = pa.array([float(i) for i in range(2 * num_rows)])
+    return pa.RecordBatch.from_arrays([pa.ListArray.from_arrays(offsets, values)],
+                                      ['Electrons_pt'])
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestSerialization:
+    def test_format_names(self):
+        assert format_names() == ['arrow', 'arrow-lz4', 'arrow-zstd', 'parquet']
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            BatchSerializer('csv')
+
+    def test_round_trip(self):
+        batch = make_batch()
+        for message_format in format_names():
+            serializer = BatchSerializer(message_format)
+            payload = serializer.serialize(batch)
+            assert serializer.deserialize(payload).equals(batch)
+            assert serializer.deserialize(payload.to_pybytes()).equals(batch)
+
+    def test_arrow_is_ipc_stream(self):
+        batch = make_batch()
+        payload = BatchSerializer('arrow').serialize(batch)
+        assert pa.ipc.open_stream(payload).read_next_batch().equals(batch)
+
+    def test_compressed_is_smaller(self):
+        batch = make_batch()
+        plain = BatchSerializer('arrow').serialize(batch)
+        compressed = BatchSerializer('arrow-zstd').serialize(batch)
+        assert compressed.size < plain.size
+
+    def test_empty_batch(self):
+        batch = make_batch(0)
+        for message_format in format_names():
+            serializer = BatchSerializer(message_format)
+            assert serializer.deserialize(serializer.serialize(batch)).num_rows == 0
+
+    def test_payload_written_into_pooled_buffer(self):
+        pool = BufferPool()
+        serializer = BatchSerializer(pool=pool)
+        batch = make_batch()
+
+        first = serializer.serialize(batch)
+        address = first.address
+        serializer.release(first)
+        second = serializer.serialize(batch)
+
+        assert second.address == address
+        assert pool.stats() == {'allocations': 1, 'reuses': 1, 'free-buffers': 0}
+
+    def test_release_without_reuse(self):
+        pool = BufferPool()
+        serializer = BatchSerializer(pool=pool)
+        payload = serializer.serialize(make_batch())
+        serializer.release(payload, reuse=False)
+
+        assert pool.stats()['free-buffers'] == 0
+        assert serializer.deserialize(payload).num_rows == 1000
+
+    def test_release_unknown_payload(self):
+        pool = BufferPool()
+        BatchSerializer(pool=pool).release(pa.py_buffer(b'abc'))
+        assert pool.stats()['free-buffers'] == 0
+
+    def test_buffer_grows_when_too_small(self, mocker):
+        serializer = BatchSerializer()
+        write = serializer._write
+        calls = []
+
+        def small_write(sink, batch):
+            calls.append(sink)
+            if len(calls) == 1:
+                raise IOError("Write out of bounds")
+            write(sink, batch)
+        mocker.patch.object(serializer, '_write', side_effect=small_write)
+
+        batch = make_batch()
+        payload = serializer.serialize(batch)
+        assert len(calls) == 2
+        assert serializer.deserialize(payload).equals(batch)
+
+    def test_pool_limit(self):
+        pool = BufferPool(max_buffers=1, initial_size=16)
+        first = pool.acquire(8)
+        second = pool.acquire(32)
+        assert first.size == 16
+        assert second.size == 32
+        pool.release(first)
+        pool.release(second)
+        assert pool.stats()['free-buffers'] == 1
+        assert pool.acquire(64).size == 64
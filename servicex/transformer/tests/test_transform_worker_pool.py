@@ -0,0 +1,304 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import os
+import time
+
+from concurrent.futures import Future
+
+from servicex.transformer.transform_worker_pool import TransformWorkerPool, defer_settle
+
+_uploads = {}
+
+
+def _transform(transform_request):
+    if transform_request['file-path'] == 'bad/file':
+        raise IOError("Could not open file")
+    if transform_request['file-path'] == 'slow/file':
+        time.sleep(1)
+    if transform_request['file-path'] == 'killed/file':
+        # As if the OOM killer took the worker
+        time.sleep(0.2)
+        os._exit(1)
+    if transform_request['file-path'] in _uploads:
+        defer_settle(_uploads[transform_request['file-path']])
+    return transform_request['file-path']
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestTransformWorkerPool:
+    def _connection(self, mocker):
+        connection = mocker.Mock()
+        connection.add_callback_threadsafe = mocker.Mock(side_effect=lambda cb: cb())
+        return connection
+
+    def _request(self, file_path):
+        return json.dumps({
+            'request-id': 'my-request',
+            'file-path': file_path,
+            'file-id': 42,
+            'service-endpoint': 'http://foo.com'
+        })
+
+    def test_start_sets_prefetch(self, mocker):
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=4, use_processes=False)
+        pool.start('my-request')
+        channel.basic_qos.assert_called_with(prefetch_count=4)
+        assert channel.basic_consume.call_args[1]['queue'] == 'my-request'
+        assert not channel.basic_consume.call_args[1]['auto_ack']
+        pool.shutdown()
+
+    def test_ack_on_success(self, mocker):
+        channel = mocker.Mock()
+        connection = self._connection(mocker)
+        pool = TransformWorkerPool(connection, channel, _transform,
+                                   max_in_flight=2, use_processes=False)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None, self._request('a/file'))
+        pool.on_message(channel, mocker.Mock(delivery_tag=2), None, self._request('b/file'))
+        pool.shutdown()
+
+        assert connection.add_callback_threadsafe.call_count == 2
+        acked = sorted(c[1]['delivery_tag'] for c in channel.basic_ack.call_args_list)
+        assert acked == [1, 2]
+        channel.basic_publish.assert_not_called()
+        assert pool.in_flight == 0
+
+    def test_warm_up_starts_workers(self, mocker):
+        initializer = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), mocker.Mock(), _transform,
+                                   max_in_flight=2, use_processes=False,
+                                   initializer=initializer, initargs=('args',))
+        pool.warm_up()
+        pool.shutdown()
+        initializer.assert_called_with('args')
+
+    def test_connect_after_warm_up(self, mocker):
+        initializer = mocker.Mock()
+        pool = TransformWorkerPool(None, None, _transform,
+                                   max_in_flight=2, use_processes=False,
+                                   initializer=initializer, initargs=('args',))
+        pool.warm_up()
+        initializer.assert_called_with('args')
+
+        connection = self._connection(mocker)
+        channel = mocker.Mock()
+        pool.start('my-request', connection, channel)
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None, self._request('a/file'))
+        pool.shutdown()
+
+        assert channel.basic_consume.call_args[1]['queue'] == 'my-request'
+        channel.basic_ack.assert_called_with(delivery_tag=1)
+
+    def test_worker_killed(self, mocker):
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=2)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None, self._request('slow/file'))
+        pool.on_message(channel, mocker.Mock(delivery_tag=2), None,
+                        self._request('killed/file'))
+        deadline = time.time() + 10
+        while channel.basic_nack.call_count < 2 and time.time() < deadline:
+            time.sleep(0.05)
+
+        # Both files were lost with the workers, not failed, so they are retried
+        nacked = sorted(call[1]['delivery_tag'] for call in channel.basic_nack.call_args_list)
+        assert nacked == [1, 2]
+        assert all(call[1]['requeue'] for call in channel.basic_nack.call_args_list)
+        channel.basic_publish.assert_not_called()
+        channel.basic_ack.assert_not_called()
+
+        # New workers take the next file
+        pool.on_message(channel, mocker.Mock(delivery_tag=3), None, self._request('a/file'))
+        pool.shutdown()
+        channel.basic_ack.assert_called_once_with(delivery_tag=3)
+        assert pool.in_flight == 0
+
+    def test_time_to_first_file(self, mocker):
+        channel = mocker.Mock()
+        on_first_file = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False,
+                                   started_at=100.0, on_first_file=on_first_file)
+        mocker.patch('time.time', return_value=112.5)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None, self._request('a/file'))
+        pool.on_message(channel, mocker.Mock(delivery_tag=2), None, self._request('b/file'))
+        pool.shutdown()
+
+        assert pool.first_file_seconds == 12.5
+        on_first_file.assert_called_once_with(12.5)
+
+    def test_failure_published_and_acked(self, mocker):
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=2, use_processes=False)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=7), None, self._request('bad/file'))
+        pool.shutdown()
+
+        channel.basic_ack.assert_called_with(delivery_tag=7)
+        publish_args = channel.basic_publish.call_args[1]
+        assert publish_args['exchange'] == 'transformation_failures'
+        assert publish_args['routing_key'] == 'my-request_errors'
+        failure = json.loads(publish_args['body'])
+        assert failure['file-path'] == 'bad/file'
+        assert failure['error'] == 'Could not open file'
+
+    def test_connection_closed(self, mocker):
+        channel = mocker.Mock()
+        connection = mocker.Mock()
+        connection.add_callback_threadsafe = mocker.Mock(
+            side_effect=Exception("Connection is closed"))
+        pool = TransformWorkerPool(connection, channel, _transform,
+                                   max_in_flight=1, use_processes=False)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=3), None, self._request('a/file'))
+        pool.shutdown()
+
+        connection.add_callback_threadsafe.assert_called_once()
+        channel.basic_ack.assert_not_called()
+
+    def test_channel_closed(self, mocker):
+        channel = mocker.Mock()
+        channel.basic_ack = mocker.Mock(side_effect=Exception("Channel is closed"))
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=3), None, self._request('a/file'))
+        pool.shutdown()
+
+        channel.basic_ack.assert_called_once()
+        assert pool.in_flight == 0
+
+    def test_ack_waits_for_deferred(self, mocker):
+        import time
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False, max_deferred=2)
+        pool.start('my-request')
+        channel.basic_qos.assert_called_with(prefetch_count=3)
+
+        upload = Future()
+        _uploads['upload/file'] = upload
+        pool.on_message(channel, mocker.Mock(delivery_tag=5), None,
+                        self._request('upload/file'))
+        pool.executor.shutdown(wait=True)
+
+        assert pool.in_flight == 0
+        channel.basic_ack.assert_not_called()
+
+        upload.set_result(None)
+        for _ in range(100):
+            if channel.basic_ack.called:
+                break
+            time.sleep(0.01)
+        channel.basic_ack.assert_called_with(delivery_tag=5)
+        channel.basic_publish.assert_not_called()
+        pool.shutdown()
+
+    def test_deferred_failure(self, mocker):
+        import time
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False, max_deferred=1)
+
+        upload = Future()
+        _uploads['failed-upload/file'] = upload
+        pool.on_message(channel, mocker.Mock(delivery_tag=6), None,
+                        self._request('failed-upload/file'))
+        pool.executor.shutdown(wait=True)
+
+        upload.set_exception(IOError("Upload failed"))
+        for _ in range(100):
+            if channel.basic_ack.called:
+                break
+            time.sleep(0.01)
+        channel.basic_ack.assert_called_with(delivery_tag=6)
+        failure = json.loads(channel.basic_publish.call_args[1]['body'])
+        assert failure['error'] == 'Upload failed'
+        pool.shutdown()
+
+    def test_defer_settle_outside_pool_waits(self):
+        future = Future()
+        future.set_result(None)
+        defer_settle(future)
+
+    def test_staged_input(self, mocker, tmpdir):
+        from servicex.transformer.file_stager import FileStager
+
+        def copy(source, destination):
+            with open(destination, 'w') as staged:
+                staged.write(source)
+
+        transformed = []
+        mocker.patch(__name__ + '._transform', side_effect=transformed.append)
+
+        channel = mocker.Mock()
+        stager = FileStager(str(tmpdir), 1000, copy_function=copy)
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False,
+                                   stager=stager, stage_ahead=2)
+        pool.start('my-request')
+        channel.basic_qos.assert_called_with(prefetch_count=3)
+
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None,
+                        self._request('root://host//a.root'))
+        pool.on_message(channel, mocker.Mock(delivery_tag=2), None, self._request('/local/b.root'))
+        pool.shutdown()
+
+        acked = sorted(c[1]['delivery_tag'] for c in channel.basic_ack.call_args_list)
+        assert acked == [1, 2]
+        local_paths = dict((request['file-path'], request['local-file-path'])
+                           for request in transformed)
+        assert local_paths['root://host//a.root'] == stager.local_path('root://host//a.root')
+        assert local_paths['/local/b.root'] == '/local/b.root'
+        assert stager.stats()['staged-files'] == 1
+
+    def test_failed_staging_reads_remote(self, mocker, tmpdir):
+        from servicex.transformer.file_stager import FileStager
+
+        def copy(source, destination):
+            raise IOError("xrdcp failed")
+
+        transformed = []
+        mocker.patch(__name__ + '._transform', side_effect=transformed.append)
+
+        channel = mocker.Mock()
+        pool = TransformWorkerPool(self._connection(mocker), channel, _transform,
+                                   max_in_flight=1, use_processes=False,
+                                   stager=FileStager(str(tmpdir), 1000, copy_function=copy))
+        pool.on_message(channel, mocker.Mock(delivery_tag=1), None,
+                        self._request('root://host//a.root'))
+        pool.shutdown()
+
+        channel.basic_ack.assert_called_with(delivery_tag=1)
+        assert 'local-file-path' not in transformed[0]
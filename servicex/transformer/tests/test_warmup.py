@@ -0,0 +1,75 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import sys
+
+from servicex.transformer.warmup import preload_xaod, signal_ready
+
+
+# noinspection PyClassHasNoInit,PyMethodMayBeStatic
+class TestWarmup:
+    def _root(self, mocker):
+        root = mocker.MagicMock()
+        mocker.patch.dict(sys.modules, {'ROOT': root})
+        return root
+
+    def test_preload_classes(self, mocker):
+        root = self._root(mocker)
+        timings = preload_xaod(['xAOD::ElectronContainer', 'xAOD::JetContainer'])
+
+        root.gROOT.SetBatch.assert_called_with(True)
+        root.xAOD.Init.assert_called_once()
+        assert root.TClass.GetClass.call_count == 2
+        root.TClass.GetClass.assert_called_with('xAOD::JetContainer', True)
+        root.TFile.Open.assert_not_called()
+        assert sorted(timings.keys()) == ['dictionaries', 'xaod-init']
+
+    def test_preload_warmup_file(self, mocker):
+        root = self._root(mocker)
+        tree = root.xAOD.MakeTransientTree.return_value
+        tree.GetEntries.return_value = 10
+
+        timings = preload_xaod(warmup_file='/data/sample.root')
+
+        root.TFile.Open.assert_called_with('/data/sample.root')
+        tree.GetEntry.assert_called_once_with(0)
+        root.xAOD.ClearTransientTrees.assert_called_once()
+        root.TFile.Open.return_value.Close.assert_called_once()
+        assert 'transient-tree' in timings
+
+    def test_signal_ready(self, tmpdir):
+        ready_file = str(tmpdir.join('ready'))
+        signal_ready(ready_file, {'ready-seconds': 3.5})
+
+        with open(ready_file) as ready:
+            assert json.load(ready) == {'ready-seconds': 3.5}
+        assert not tmpdir.join('ready.tmp').exists()
+
+    def test_signal_ready_without_file(self, tmpdir):
+        signal_ready(None, {'ready-seconds': 3.5})
+        assert tmpdir.listdir() == []
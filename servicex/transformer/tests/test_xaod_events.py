@@ -61,6 +61,8 @@ class TestXAODEvents:
         mock_tree.GetEntries = mock.Mock(return_value=2)
         mock_tree.GetEntry = mock.Mock()
         event_iterator = XAODEvents("foo/bar", attr_names)
+        assert event_iterator.open_time >= 0.0
+        assert event_iterator.make_transient_tree_time >= 0.0
 
         assert event_iterator.get_entry_count() == 2
 
@@ -137,6 +139,223 @@ class TestXAODEvents:
         with pytest.raises(StopIteration):
             array_gen.next()
 
+    def test_iterate_columnar(self, mocker):
+        import ROOT
+        import mock
+        import pytest
+        from servicex.transformer.xaod_events import XAODEvents
+
+        attr_names = [
+            "Electrons.pt()", "Electrons.eta()",  "Muons.e()"
+        ]
+
+        mocker.patch.object(ROOT.TFile, 'Open', return_value=mock.Mock())
+
+        mock_tree = mock.Mock()
+        xaod_mock = mocker.patch.object(ROOT, "xAOD")
+        xaod_mock.MakeTransientTree = mock.Mock(return_value=mock_tree)
+
+        event_iterator = XAODEvents("foo/bar", attr_names)
+
+        mock_tree.GetEntries = mock.Mock(return_value=3)
+        mock_tree.GetEntry = mock.Mock()
+
+        mock_tree.Muons = self._generate_mock_phys_obj(mock, {
+            "e": [
+                [1, 2, 3],
+                [4, 5],
+                []
+            ]
+        })
+
+        mock_tree.Electrons = self._generate_mock_phys_obj(mock, {
+            "pt": [
+                [4, 8],
+                [16, 20, 24],
+                [28]
+            ],
+            "eta": [
+                [5, 10],
+                [20, 25, 30],
+                [35]
+            ]
+        })
+
+        chunk_gen = event_iterator.iterate_columnar(2)
+
+        chunk = chunk_gen.next()
+        mock_tree.GetEntry.assert_called_with(1)
+        assert list(chunk['Muons']['offsets']) == [0, 3, 5]
+        assert list(chunk['Muons']['content']['e()']) == [1, 2, 3, 4, 5]
+        assert list(chunk['Electrons']['offsets']) == [0, 2, 5]
+        assert list(chunk['Electrons']['content']['pt()']) == [4, 8, 16, 20, 24]
+        assert list(chunk['Electrons']['content']['eta()']) == [5, 10, 20, 25, 30]
+
+        chunk2 = chunk_gen.next()
+        mock_tree.GetEntry.assert_called_with(2)
+        assert list(chunk2['Muons']['offsets']) == [0, 0]
+        assert len(chunk2['Muons']['content']['e()']) == 0
+        assert list(chunk2['Electrons']['offsets']) == [0, 1]
+        assert list(chunk2['Electrons']['content']['pt()']) == [28]
+
+        with pytest.raises(StopIteration):
+            chunk_gen.next()
+
+    def test_iterate_columnar_types(self, mocker):
+        import ROOT
+        import mock
+        import numpy
+        from servicex.transformer.xaod_events import XAODEvents
+
+        attr_names = ["Electrons.pt()", "Electrons.charge()"]
+
+        mocker.patch.object(ROOT.TFile, 'Open', return_value=mock.Mock())
+
+        mock_tree = mock.Mock()
+        xaod_mock = mocker.patch.object(ROOT, "xAOD")
+        xaod_mock.MakeTransientTree = mock.Mock(return_value=mock_tree)
+
+        event_iterator = XAODEvents("foo/bar", attr_names)
+
+        mock_tree.GetEntries = mock.Mock(return_value=3)
+        mock_tree.GetEntry = mock.Mock()
+
+        mock_tree.Electrons = self._generate_mock_phys_obj(mock, {
+            "pt": [
+                [],
+                [4.5, 8.5],
+                [16.5]
+            ],
+            "charge": [
+                [],
+                [-1, 1],
+                [1]
+            ]
+        })
+
+        chunk = event_iterator.iterate_columnar(3).next()
+        content = chunk['Electrons']['content']
+        assert content['pt()'].dtype == numpy.float64
+        assert content['charge()'].dtype == numpy.int64
+        assert list(content['pt()']) == [4.5, 8.5, 16.5]
+        assert list(content['charge()']) == [-1, 1, 1]
+
+    def test_iterate_entry_range(self, mocker):
+        import ROOT
+        import mock
+        import pytest
+        from servicex.transformer.xaod_events import XAODEvents
+
+        mocker.patch.object(ROOT.TFile, 'Open', return_value=mock.Mock())
+
+        mock_tree = mock.Mock()
+        xaod_mock = mocker.patch.object(ROOT, "xAOD")
+        xaod_mock.MakeTransientTree = mock.Mock(return_value=mock_tree)
+
+        event_iterator = XAODEvents("foo/bar", ["Muons.e()"], entry_start=2, entry_stop=4)
+
+        mock_tree.GetEntries = mock.Mock(return_value=10)
+        mock_tree.GetEntry = mock.Mock()
+        mock_tree.Muons = self._generate_mock_phys_obj(mock, {
+            "e": [
+                [1],
+                [2, 3]
+            ]
+        })
+
+        chunk_gen = event_iterator.iterate_columnar(5)
+        chunk = chunk_gen.next()
+        assert [c[0][0] for c in mock_tree.GetEntry.call_args_list] == [2, 3]
+        assert list(chunk['Muons']['offsets']) == [0, 1, 3]
+
+        with pytest.raises(StopIteration):
+            chunk_gen.next()
+
+    def _cached_events(self, mocker, cache_config):
+        import ROOT
+        import mock
+        from servicex.transformer.xaod_events import XAODEvents
+
+        mock_file = mock.Mock()
+        mock_file.GetBytesRead = mock.Mock(return_value=4096)
+        mock_file.GetReadCalls = mock.Mock(return_value=3)
+        persistent_tree = mock.Mock()
+        mock_file.Get = mock.Mock(return_value=persistent_tree)
+        mocker.patch.object(ROOT.TFile, 'Open', return_value=mock_file)
+
+        mock_tree = mock.Mock()
+        xaod_mock = mocker.patch.object(ROOT, "xAOD")
+        xaod_mock.MakeTransientTree = mock.Mock(return_value=mock_tree)
+
+        event_iterator = XAODEvents("foo/bar", ["Muons.e()"], entry_start=2, entry_stop=4,
+                                    cache_config=cache_config)
+
+        mock_tree.GetEntries = mock.Mock(return_value=10)
+        mock_tree.GetEntry = mock.Mock()
+        mock_tree.Muons = self._generate_mock_phys_obj(mock, {
+            "e": [
+                [1],
+                [2, 3]
+            ]
+        })
+        return event_iterator, mock_file, persistent_tree
+
+    def test_tree_cache(self, mocker):
+        import ROOT
+        from servicex.transformer.xaod_events import TreeCacheConfig
+
+        genv_mock = mocker.patch.object(ROOT, "gEnv")
+        event_iterator, mock_file, persistent_tree = self._cached_events(
+            mocker, TreeCacheConfig(cache_size=1000, async_prefetch=True))
+
+        list(event_iterator.iterate_columnar(5))
+
+        genv_mock.SetValue.assert_called_with("TFile.AsyncPrefetching", 1)
+        mock_file.Get.assert_called_with('CollectionTree')
+        persistent_tree.SetCacheSize.assert_called_with(1000)
+        persistent_tree.SetCacheEntryRange.assert_called_with(2, 4)
+        assert [c[0][0] for c in persistent_tree.AddBranchToCache.call_args_list] == \
+            ['EventInfo', 'EventInfoAux*', 'Muons', 'MuonsAux*']
+        persistent_tree.StopCacheLearningPhase.assert_called_with()
+        persistent_tree.SetCacheLearnEntries.assert_not_called()
+
+        cache = persistent_tree.GetReadCache.return_value
+        cache.GetBufferSize.return_value = 1000
+        cache.GetBytesRead.return_value = 4000
+        cache.GetReadCalls.return_value = 1
+        cache.GetNoCacheBytesRead.return_value = 96
+        cache.GetNoCacheReadCalls.return_value = 2
+        cache.GetEfficiency.return_value = 0.5
+        cache.GetEfficiencyRel.return_value = 0.75
+        assert event_iterator.cache_stats() == {
+            'bytes-read': 4096,
+            'read-calls': 3,
+            'cache-size': 1000,
+            'cache-bytes-read': 4000,
+            'cache-read-calls': 1,
+            'uncached-bytes-read': 96,
+            'uncached-read-calls': 2,
+            'cache-efficiency': 0.5,
+            'cache-efficiency-rel': 0.75
+        }
+
+    def test_tree_cache_learning(self, mocker):
+        from servicex.transformer.xaod_events import TreeCacheConfig
+
+        event_iterator, _, persistent_tree = self._cached_events(
+            mocker, TreeCacheConfig(cache_size=1000, learn_entries=10))
+        list(event_iterator.iterate_columnar(5))
+
+        persistent_tree.SetCacheLearnEntries.assert_called_with(10)
+        persistent_tree.StopCacheLearningPhase.assert_not_called()
+
+    def test_without_tree_cache(self, mocker):
+        event_iterator, mock_file, _ = self._cached_events(mocker, None)
+        list(event_iterator.iterate_columnar(5))
+
+        mock_file.Get.assert_not_called()
+        assert event_iterator.cache_stats() == {'bytes-read': 4096, 'read-calls': 3}
+
     def test_chunksize_greater_than_events(self, mocker):
         assert True
 
@@ -64,7 +64,7 @@ class TestXAODTransformer:
         iterator.attr_name_list = attr_names
         iterator.get_entry_count = mock.Mock(return_value=1000)
         transformer = XAODTransformer(iterator)
-        table = transformer.arrow_table(2, 100).next()
+        table = next(transformer.arrow_table(2, 100))
 
         assert table.column_names == ['Electrons_pt',
                                       'Muons_e',
@@ -83,3 +83,87 @@ class TestXAODTransformer:
         ])
 
         iterator.iterate.assert_called_with(100)
+
+    def test_arrow_batches(self, mocker):
+        import mock
+        import numpy
+        from servicex.transformer.xaod_transformer import XAODTransformer
+
+        attr_names = [
+            "Electrons.pt()", "Electrons.eta()",  "Muons.e()"
+        ]
+
+        from servicex.transformer.xaod_events import XAODEvents
+        iterator = mock.MagicMock(XAODEvents)
+        iterator.iterate_columnar = mock.Mock(return_value=iter([
+            {
+                'Electrons': {
+                    'offsets': numpy.array([0, 2, 4], dtype=numpy.int32),
+                    'content': {
+                        'pt()': numpy.array([4.0, 8.0, 14.0, 18.0]),
+                        'eta()': numpy.array([5.0, 10.0, 15.0, 20.0])
+                    }
+                },
+                'Muons': {
+                    'offsets': numpy.array([0, 3, 3], dtype=numpy.int32),
+                    'content': {
+                        'e()': numpy.array([1.0, 2.0, 3.0])
+                    }
+                }
+            }
+        ]))
+
+        iterator.attr_name_list = attr_names
+        transformer = XAODTransformer(iterator)
+        batch = next(transformer.arrow_batches(2, 100))
+
+        assert batch.schema == transformer.schema
+        assert batch.schema.names == ['Electrons_pt',
+                                      'Electrons_eta',
+                                      'Muons_e']
+        assert batch.num_rows == 2
+        assert batch.num_columns == 3
+        assert batch.to_pydict() == OrderedDict([
+            ('Electrons_pt', [[4.0, 8.0], [14.0, 18.0]]),
+            ('Electrons_eta', [[5.0, 10.0], [15.0, 20.0]]),
+            ('Muons_e', [[1.0, 2.0, 3.0], []])
+        ])
+
+        iterator.iterate_columnar.assert_called_with(2, 100)
+
+    def test_int_attribute(self, mocker):
+        import mock
+        import numpy
+        import pyarrow as pa
+        from servicex.transformer.xaod_transformer import XAODTransformer
+
+        from servicex.transformer.xaod_events import XAODEvents
+        iterator = mock.MagicMock(XAODEvents)
+        iterator.iterate_columnar = mock.Mock(return_value=iter([
+            {
+                'Electrons': {
+                    'offsets': numpy.array([0, 2, 3], dtype=numpy.int32),
+                    'content': {
+                        'charge()': numpy.array([-1, 1, 1], dtype=numpy.int64)
+                    }
+                },
+                'Muons': {
+                    'offsets': numpy.array([0, 0, 0], dtype=numpy.int32),
+                    'content': {
+                        'charge()': numpy.array([], dtype=numpy.float64)
+                    }
+                }
+            }
+        ]))
+
+        iterator.attr_name_list = ["Electrons.charge()", "Muons.charge()"]
+        transformer = XAODTransformer(iterator)
+        batch = next(transformer.arrow_batches(2))
+
+        assert batch.schema == transformer.schema
+        assert batch.schema.field('Electrons_charge').type == pa.list_(pa.int64())
+        assert batch.schema.field('Muons_charge').type == pa.list_(pa.float64())
+        assert batch.to_pydict() == OrderedDict([
+            ('Electrons_charge', [[-1, 1], [1]]),
+            ('Muons_charge', [[], []])
+        ])
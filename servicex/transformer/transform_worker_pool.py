@@ -0,0 +1,353 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import multiprocessing
+import threading
+import time
+from functools import partial
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    class BrokenProcessPool(RuntimeError):
+        pass
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Per worker thread: the queue for reporting work that finishes after a
+# transform returns, and the delivery tag and deferred count of the request
+# being transformed
+_task = threading.local()
+
+
+def _init_worker(completions, initializer, initargs):
+    _task.completions = completions
+    if initializer:
+        initializer(*initargs)
+
+
+def _run_transform(transform_function, delivery_tag, transform_request):
+    _task.delivery_tag = delivery_tag
+    _task.deferred = 0
+    try:
+        transform_function(transform_request)
+        return _task.deferred
+    finally:
+        _task.delivery_tag = None
+
+
+def _warm_up_worker():
+    # Starting the worker runs the initializer, which connects the backends
+    return True
+
+
+def defer_settle(future):
+    """
+    Hold back the ack of the request being transformed until future completes,
+    without keeping the worker busy. The request fails if the future does.
+    Outside a worker pool this waits for the future.
+    :param future: concurrent.futures.Future, such as a background upload
+    """
+    delivery_tag = getattr(_task, 'delivery_tag', None)
+    if delivery_tag is None:
+        future.result()
+        return
+
+    _task.deferred += 1
+    completions = _task.completions
+
+    def report(done):
+        error = done.exception()
+        completions.put((delivery_tag, None if error is None else str(error)))
+    future.add_done_callback(report)
+
+
+class TransformWorkerPool:
+    """
+    Consume transform requests from RabbitMQ and run them in a pool of
+    workers, off the connection's I/O loop so heartbeats keep flowing during
+    long transforms. pika channels are not thread safe, so acks and failure
+    reports are handed back to the connection's thread with
+    add_callback_threadsafe.
+
+    A transform may call defer_settle to have its ack wait for work that
+    outlives it, such as an upload, while the worker moves on to the next file.
+
+    With a FileStager, each input file is copied to local disk as soon as its
+    request arrives and the transform starts once it is staged, with the
+    local copy in the request's local-file-path.
+    """
+
+    def __init__(self, connection, channel, transform_function, max_in_flight=1,
+                 use_processes=True, initializer=None, initargs=(),
+                 failure_exchange='transformation_failures', max_deferred=0,
+                 stager=None, stage_ahead=0, started_at=None, on_first_file=None):
+        """
+        :param connection: pika connection that owns the channel. May be None
+            until start(), so workers can warm up before it is opened
+        :param channel: Channel to consume from and ack on
+        :param transform_function: Called with the decoded transform request.
+            Must be picklable when use_processes is set. Raises on failure
+        :param max_in_flight: Number of files transformed at the same time
+        :param use_processes: Run transforms in processes rather than threads
+        :param initializer: Called once in each worker when it starts
+        :param initargs: Arguments for initializer
+        :param failure_exchange: Exchange failed requests are published to
+        :param max_deferred: Requests that may wait on deferred work, such as
+            uploads, on top of the ones being transformed
+        :param stager: FileStager that copies inputs to local disk first
+        :param stage_ahead: Requests taken from the queue early so their
+            inputs are staged while earlier files are transformed
+        :param started_at: Time the process started, for time to first file.
+            Defaults to now
+        :param on_first_file: Called with the seconds from started_at until
+            the first file is transformed
+        """
+        self.connection = connection
+        self.channel = channel
+        self.transform_function = transform_function
+        self.max_in_flight = max_in_flight
+        self.max_deferred = max_deferred
+        self.failure_exchange = failure_exchange
+        self.stager = stager
+        self.stage_ahead = stage_ahead if stager else 0
+        self.in_flight = 0
+        self.started_at = started_at or time.time()
+        self.on_first_file = on_first_file
+        self.first_file_seconds = None
+
+        # Deferred work outstanding per delivery tag, and reports that arrive
+        # before the transform itself is settled. Connection thread only
+        self._deferred = {}
+        self._early_reports = {}
+
+        if use_processes:
+            self._completions = multiprocessing.Queue()
+            self._executor_class = ProcessPoolExecutor
+        else:
+            self._completions = queue.Queue()
+            self._executor_class = ThreadPoolExecutor
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor_lock = threading.Lock()
+        self.executor = self._create_executor()
+
+        self._listener = threading.Thread(target=self._listen)
+        self._listener.daemon = True
+        self._listener.start()
+
+    def _create_executor(self):
+        return self._executor_class(max_workers=self.max_in_flight,
+                                    initializer=_init_worker,
+                                    initargs=(self._completions, self._initializer,
+                                              self._initargs))
+
+    def _replace_executor(self, broken):
+        """
+        Start a new pool once a worker process has died, which leaves the old
+        one refusing work for good. Its other workers are killed with it, so
+        the uploads they were finishing are lost too
+        """
+        with self._executor_lock:
+            if self.executor is not broken:
+                return
+            print("A transform worker died, starting new workers")
+            self.executor = self._create_executor()
+        broken.shutdown(wait=False)
+        self._schedule(self._requeue_deferred, "deferred deliveries")
+
+    def warm_up(self):
+        """
+        Start every worker now, running its initializer, rather than when
+        the first files arrive
+        """
+        futures = [self.executor.submit(_warm_up_worker) for _ in range(self.max_in_flight)]
+        for future in futures:
+            future.result()
+
+    def start(self, queue_name, connection=None, channel=None):
+        """
+        Start consuming. The prefetch matches the pool size, plus the
+        requests allowed to wait on deferred work or to be staged ahead, so
+        the broker never hands us more files than we can start
+        :param queue_name: Queue to consume from
+        :param connection: pika connection, if not given to the constructor
+        :param channel: Channel on that connection, if not given to the constructor
+        """
+        if connection:
+            self.connection = connection
+            self.channel = channel
+        self.channel.basic_qos(prefetch_count=self.max_in_flight + self.max_deferred +
+                               self.stage_ahead)
+        self.channel.basic_consume(queue=queue_name,
+                                   auto_ack=False,
+                                   on_message_callback=self.on_message)
+
+    def on_message(self, channel, method, properties, body):
+        transform_request = json.loads(body)
+        print("Processing " + transform_request['file-path'])
+
+        self.in_flight += 1
+        if self.stager:
+            staged = self.stager.stage(transform_request['file-path'])
+            staged.add_done_callback(partial(self._on_staged, method.delivery_tag,
+                                             transform_request))
+        else:
+            self._submit(method.delivery_tag, transform_request)
+
+    def _on_staged(self, delivery_tag, transform_request, staged):
+        # Runs on a staging thread. A failed copy falls back to the remote file
+        error = staged.exception()
+        if error is None:
+            transform_request['local-file-path'] = staged.result()
+        else:
+            print("Could not stage " + transform_request['file-path'] + ":", error)
+        self._submit(delivery_tag, transform_request)
+
+    def _submit(self, delivery_tag, transform_request):
+        executor = self.executor
+        try:
+            future = executor.submit(_run_transform, self.transform_function,
+                                     delivery_tag, transform_request)
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            executor = self.executor
+            future = executor.submit(_run_transform, self.transform_function,
+                                     delivery_tag, transform_request)
+        future.add_done_callback(partial(self._on_done, executor, delivery_tag,
+                                         transform_request))
+
+    def _schedule(self, callback, description):
+        try:
+            self.connection.add_callback_threadsafe(callback)
+        except Exception as ex:
+            # The broker will redeliver the unacked message on a new connection
+            print("Could not settle " + description + ", connection closed:", ex)
+
+    def _on_done(self, executor, delivery_tag, transform_request, future):
+        # Runs on an executor thread, so only schedule work on the connection
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # The file was lost with a dead worker rather than failing itself,
+            # so it goes back on the queue
+            self._replace_executor(executor)
+            self._schedule(partial(self._requeue, delivery_tag, transform_request),
+                           transform_request['file-path'])
+            return
+        deferred = future.result() if error is None else 0
+        self._schedule(partial(self._complete, delivery_tag, transform_request,
+                               error, deferred),
+                       transform_request['file-path'])
+
+    def _listen(self):
+        while True:
+            delivery_tag, error = self._completions.get()
+            if delivery_tag is None:
+                break
+            self._schedule(partial(self._deferred_done, delivery_tag, error),
+                           "delivery " + str(delivery_tag))
+
+    def _complete(self, delivery_tag, transform_request, error, deferred):
+        self.in_flight -= 1
+        if self.first_file_seconds is None:
+            self.first_file_seconds = time.time() - self.started_at
+            print("Time to first file: " + str(round(self.first_file_seconds, 1)) + " seconds")
+            if self.on_first_file:
+                self.on_first_file(self.first_file_seconds)
+        if self.stager:
+            self.stager.release(transform_request['file-path'])
+        early_errors = self._early_reports.pop(delivery_tag, [])
+        if error is None and deferred > len(early_errors):
+            self._deferred[delivery_tag] = [deferred - len(early_errors),
+                                            transform_request, early_errors]
+            return
+
+        errors = [error] if error is not None else []
+        self._settle(delivery_tag, transform_request, errors + early_errors)
+
+    def _deferred_done(self, delivery_tag, error):
+        if delivery_tag not in self._deferred:
+            self._early_reports.setdefault(delivery_tag, []).append(error)
+            return
+
+        entry = self._deferred[delivery_tag]
+        entry[0] -= 1
+        entry[2].append(error)
+        if entry[0] == 0:
+            del self._deferred[delivery_tag]
+            self._settle(delivery_tag, entry[1], entry[2])
+
+    def _requeue(self, delivery_tag, transform_request):
+        self.in_flight -= 1
+        if self.stager:
+            self.stager.release(transform_request['file-path'])
+        self._nack(delivery_tag, transform_request)
+
+    def _requeue_deferred(self):
+        # The uploads these deliveries were waiting on died with the workers
+        for delivery_tag, entry in list(self._deferred.items()):
+            self._nack(delivery_tag, entry[1])
+        self._deferred.clear()
+        self._early_reports.clear()
+
+    def _nack(self, delivery_tag, transform_request):
+        print("Requeueing " + transform_request['file-path'])
+        try:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        except Exception as ex:
+            print("Could not requeue " + transform_request['file-path'] +
+                  ", channel closed:", ex)
+
+    def _settle(self, delivery_tag, transform_request, errors):
+        errors = [error for error in errors if error is not None]
+        try:
+            if errors:
+                print("Transform of " + transform_request['file-path'] + " failed:",
+                      errors[0])
+                failure = dict(transform_request)
+                failure['error'] = str(errors[0])
+                self.channel.basic_publish(
+                    exchange=self.failure_exchange,
+                    routing_key=transform_request['request-id'] + '_errors',
+                    body=json.dumps(failure))
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        except Exception as ex:
+            print("Could not settle " + transform_request['file-path'] +
+                  ", channel closed:", ex)
+
+    def shutdown(self, wait=True):
+        # Copies still running hand their requests to the executor when done
+        if self.stager:
+            self.stager.shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
+        self._completions.put((None, None))
@@ -0,0 +1,80 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import os
+import time
+
+
+def preload_xaod(class_names=(), warmup_file=None):
+    """
+    Pay ROOT's one-off costs before the first file: loading xAOD access,
+    the dictionaries of the classes that will be read and, given a sample
+    file, the first MakeTransientTree
+    :param class_names: Classes to load dictionaries for, such as
+        xAOD::ElectronContainer
+    :param warmup_file: Small xAOD file to build a transient tree from
+    :return: Dict of seconds spent in each step
+    """
+    timings = {}
+
+    start = time.time()
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    ROOT.xAOD.Init().ignore()
+    timings['xaod-init'] = time.time() - start
+
+    start = time.time()
+    for class_name in class_names:
+        if not ROOT.TClass.GetClass(class_name, True):
+            print("No dictionary for " + class_name)
+    timings['dictionaries'] = time.time() - start
+
+    if warmup_file:
+        start = time.time()
+        file_in = ROOT.TFile.Open(warmup_file)
+        tree = ROOT.xAOD.MakeTransientTree(file_in)
+        if tree.GetEntries():
+            tree.GetEntry(0)
+        ROOT.xAOD.ClearTransientTrees()
+        file_in.Close()
+        timings['transient-tree'] = time.time() - start
+
+    return timings
+
+
+def signal_ready(ready_file, info):
+    """
+    Write the readiness file a Kubernetes readiness probe can check for
+    :param info: Startup details, written as JSON
+    """
+    print("Transformer ready:", info)
+    if not ready_file:
+        return
+    with open(ready_file + '.tmp', 'w') as ready:
+        json.dump(info, ready)
+    os.rename(ready_file + '.tmp', ready_file)
@@ -26,27 +26,65 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import time
+
+import numpy
 import ROOT
 
+from servicex.transformer.accessor_plan import AccessorPlan
+
+
+class TreeCacheConfig:
+    """
+    TTreeCache settings for the persistent tree the transient tree reads
+    from. Without a cache every basket is a separate read, which costs a
+    round trip per read over xrootd.
+    """
+
+    def __init__(self, cache_size=100 * 1024 * 1024, learn_entries=0, async_prefetch=False,
+                 tree_name='CollectionTree'):
+        """
+        :param cache_size: Cache size in bytes. 0 turns the cache off
+        :param learn_entries: Entries read before the cache stops learning
+            which other branches are used. 0 caches just the selected
+            branches and EventInfo from the first entry
+        :param async_prefetch: Fetch the next cache block in the background
+        :param tree_name: Name of the persistent tree in the file
+        """
+        self.cache_size = cache_size
+        self.learn_entries = learn_entries
+        self.async_prefetch = async_prefetch
+        self.tree_name = tree_name
+
 
 class XAODEvents:
-    def __init__(self, file_path, attr_name_list):
+    def __init__(self, file_path, attr_name_list, entry_start=0, entry_stop=None,
+                 cache_config=None):
         self.file_path = file_path
+        self.cache_config = cache_config
+        self.cached_tree = None
+
+        # Prefetching has to be switched on before the file is opened
+        if cache_config and cache_config.async_prefetch:
+            ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+
+        # Seconds spent opening the file and building the transient tree
+        start = time.time()
         self.file_in = ROOT.TFile.Open(file_path)
+        self.open_time = time.time() - start
+
+        start = time.time()
         self.tree = ROOT.xAOD.MakeTransientTree(self.file_in)
+        self.make_transient_tree_time = time.time() - start
         self.attr_name_list = attr_name_list
+        self.plan = AccessorPlan(attr_name_list)
+
+        # Only entries in [entry_start, entry_stop) are read
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
 
     def _create_branch_dict(self):
-        branches = {}
-        for attr_name in self.attr_name_list:
-            attr_name = str(attr_name)
-            if not attr_name.split('.')[0].strip(' ') in branches:
-                branches[attr_name.split('.')[0].strip(' ')] = [
-                    attr_name.split('.')[1]]
-            else:
-                branches[attr_name.split('.')[0].strip(' ')].append(
-                    attr_name.split('.')[1])
-        return branches
+        return self.plan.branch_dict()
 
     def _select_branches(self):
         self.branches = self._create_branch_dict()
@@ -56,36 +94,195 @@ class XAODEvents:
         for branch_name in self.branches:
             self.tree.SetBranchStatus(branch_name, 1)
 
+    def _configure_cache(self, entry_start, entry_stop):
+        config = self.cache_config
+        if not config or not config.cache_size:
+            return
+
+        tree = self.file_in.Get(config.tree_name)
+        if not tree:
+            print("No " + config.tree_name + " in " + self.file_path +
+                  ", reading without a TTreeCache")
+            return
+
+        tree.SetCacheSize(config.cache_size)
+        tree.SetCacheEntryRange(entry_start, entry_stop)
+        for branch_name in ['EventInfo'] + list(self.branches):
+            # The interface branch and the aux store branches holding the values
+            tree.AddBranchToCache(branch_name, True)
+            tree.AddBranchToCache(branch_name + 'Aux*', True)
+
+        if config.learn_entries:
+            tree.SetCacheLearnEntries(config.learn_entries)
+        else:
+            tree.StopCacheLearningPhase()
+        self.cached_tree = tree
+
+    def cache_stats(self):
+        """
+        Bytes and read calls for the file so far, and how many went through
+        the TTreeCache
+        :return: Dict of statistics
+        """
+        stats = {
+            'bytes-read': int(self.file_in.GetBytesRead()),
+            'read-calls': int(self.file_in.GetReadCalls())
+        }
+        if self.cached_tree:
+            cache = self.cached_tree.GetReadCache(self.file_in)
+            if cache:
+                stats.update({
+                    'cache-size': int(cache.GetBufferSize()),
+                    'cache-bytes-read': int(cache.GetBytesRead()),
+                    'cache-read-calls': int(cache.GetReadCalls()),
+                    'uncached-bytes-read': int(cache.GetNoCacheBytesRead()),
+                    'uncached-read-calls': int(cache.GetNoCacheReadCalls()),
+                    'cache-efficiency': float(cache.GetEfficiency()),
+                    'cache-efficiency-rel': float(cache.GetEfficiencyRel())
+                })
+        return stats
+
     def get_entry_count(self):
         return self.tree.GetEntries()
 
+    def _entry_range(self, event_limit):
+        entry_stop = self.tree.GetEntries()
+        if self.entry_stop is not None:
+            entry_stop = min(entry_stop, self.entry_stop)
+        if event_limit:
+            entry_stop = min(entry_stop, self.entry_start + event_limit)
+            print("Limiting to the first " + str(entry_stop - self.entry_start) +
+                  " events")
+        return self.entry_start, entry_stop
+
+    def _read_entry(self, j_entry, entry_start, entry_stop):
+        self.tree.GetEntry(j_entry)
+        if j_entry % 1000 == 0:
+            print("Processing run #" + str(self.tree.EventInfo.runNumber())
+                  + ", event #" + str(self.tree.EventInfo.eventNumber())
+                  + " (" + str(
+                        round(100.0 * (j_entry - entry_start) /
+                              (entry_stop - entry_start), 2)) + "%)")
+
     def iterate(self, event_limit=None):
         self._select_branches()
 
-        n_entries = self.tree.GetEntries()
-        if event_limit:
-            n_entries = min(n_entries, event_limit)
-            print("Limiting to the first " + str(n_entries) + " events")
+        entry_start, entry_stop = self._entry_range(event_limit)
+        self._configure_cache(entry_start, entry_stop)
 
-        for j_entry in range(n_entries):
-            self.tree.GetEntry(j_entry)
-            if j_entry % 1000 == 0:
-                print("Processing run #" + str(self.tree.EventInfo.runNumber())
-                      + ", event #" + str(self.tree.EventInfo.eventNumber())
-                      + " (" + str(
-                            round(100.0 * j_entry / n_entries, 2)) + "%)")
+        for j_entry in range(entry_start, entry_stop):
+            self._read_entry(j_entry, entry_start, entry_stop)
 
             particles = {}
             full_event = {}
-            for branch_name in self.branches:
+            for branch_name, accessors in self.plan.collections.items():
                 full_event[branch_name] = []
                 particles[branch_name] = getattr(self.tree, branch_name)
                 for i in xrange(particles[branch_name].size()):
                     particle = particles[branch_name].at(i)
                     single_particle_attr = {}
-                    for a_name in self.branches[branch_name]:
-                        single_particle_attr[a_name] = \
-                            getattr(particle, a_name.strip('()'))()
+                    for accessor in accessors:
+                        single_particle_attr[accessor.key] = accessor(particle)
                     full_event[branch_name].append(single_particle_attr)
 
             yield full_event
+
+    def iterate_columnar(self, chunk_size, event_limit=None):
+        """
+        Read the selected attributes in chunks of entries, filling flat numpy
+        buffers instead of building a dict for every particle.
+        :param chunk_size: Number of entries to include in each chunk, or a
+            function returning the size of the next chunk
+        :param event_limit: Max number of entries to read
+        :return: Yields one dict per chunk, keyed by branch name. Each value
+            is a dict with an 'offsets' array of length n+1 and a 'content'
+            dict of flat value arrays keyed by attribute name.
+        """
+        self._select_branches()
+
+        entry_start, entry_stop = self._entry_range(event_limit)
+        self._configure_cache(entry_start, entry_stop)
+
+        # Particles per entry seen so far, used to size the next chunk's buffers
+        multiplicity = dict((branch_name, 1.0) for branch_name in self.branches)
+
+        chunk_start = entry_start
+        while chunk_start < entry_stop:
+            next_chunk_size = chunk_size() if callable(chunk_size) else chunk_size
+            chunk_stop = min(chunk_start + next_chunk_size, entry_stop)
+            chunk = self._read_columnar_chunk(chunk_start, chunk_stop,
+                                              entry_start, entry_stop, multiplicity)
+            for branch_name, columns in chunk.items():
+                multiplicity[branch_name] = \
+                    float(columns['offsets'][-1]) / (chunk_stop - chunk_start)
+            yield chunk
+            chunk_start = chunk_stop
+
+    def _read_columnar_chunk(self, chunk_start, chunk_stop, entry_start, entry_stop,
+                             multiplicity):
+        n_chunk = chunk_stop - chunk_start
+
+        chunk = {}
+        for branch_name, accessors in self.plan.collections.items():
+            capacity = int(multiplicity[branch_name] * n_chunk * 1.25) + 16
+            chunk[branch_name] = {
+                'offsets': numpy.zeros(n_chunk + 1, dtype=numpy.int32),
+                'content': dict((accessor.key, numpy.empty(capacity, dtype=accessor.dtype))
+                                for accessor in accessors)
+            }
+
+        # Collections with attributes whose type is taken from the first particle
+        untyped = set(branch_name for branch_name, accessors in self.plan.collections.items()
+                      if any(accessor.arrow_type is None for accessor in accessors))
+
+        for i_chunk in xrange(n_chunk):
+            self._read_entry(chunk_start + i_chunk, entry_start, entry_stop)
+
+            for branch_name, accessors in self.plan.collections.items():
+                offsets = chunk[branch_name]['offsets']
+                content = chunk[branch_name]['content']
+                particles = getattr(self.tree, branch_name)
+                n_particles = particles.size()
+
+                begin = offsets[i_chunk]
+                end = begin + n_particles
+                if end > len(content[accessors[0].key]):
+                    self._grow(content, end)
+
+                first = 0
+                if n_particles and branch_name in untyped:
+                    self._read_first_particle(accessors, particles.at(0), content, begin)
+                    untyped.discard(branch_name)
+                    first = 1
+
+                for i in xrange(first, n_particles):
+                    particle = particles.at(i)
+                    for accessor in accessors:
+                        content[accessor.key][begin + i] = accessor(particle)
+
+                offsets[i_chunk + 1] = end
+
+        # Trim the buffers down to the filled length. These are views, not copies
+        for columns in chunk.values():
+            n_filled = columns['offsets'][-1]
+            for a_name in columns['content']:
+                columns['content'][a_name] = columns['content'][a_name][:n_filled]
+
+        return chunk
+
+    @staticmethod
+    def _read_first_particle(accessors, particle, content, index):
+        for accessor in accessors:
+            value = accessor(particle)
+            if accessor.arrow_type is None:
+                accessor.infer_type(value)
+                content[accessor.key] = content[accessor.key].astype(accessor.dtype)
+            content[accessor.key][index] = value
+
+    @staticmethod
+    def _grow(content, min_capacity):
+        for a_name, values in content.items():
+            capacity = max(min_capacity, 2 * len(values))
+            grown = numpy.empty(capacity, dtype=values.dtype)
+            grown[:len(values)] = values
+            content[a_name] = grown
@@ -25,15 +25,86 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-import sys
 import awkward
+import pyarrow as pa
+
+from servicex.transformer.accessor_plan import AccessorPlan
+
+
+def serialize_batch(batch):
+    """
+    Write a RecordBatch as an Arrow IPC stream
+    :param batch: pyarrow RecordBatch
+    :return: pa.Buffer holding the stream
+    """
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchStreamWriter(sink, batch.schema)
+    writer.write_batch(batch)
+    writer.close()
+    return sink.getvalue()
 
 
 class XAODTransformer:
     def __init__(self, event_iterator):
         self.event_iterator = event_iterator
+        self._plan = None
+
+    @property
+    def plan(self):
+        """
+        AccessorPlan of the event iterator, so the attribute types it finds
+        are shared, or else parsed once from its attr_name_list
+        """
+        if self._plan is None:
+            plan = getattr(self.event_iterator, 'plan', None)
+            self._plan = plan if isinstance(plan, AccessorPlan) else \
+                AccessorPlan(self.event_iterator.attr_name_list)
+        return self._plan
+
+    @property
+    def schema(self):
+        """
+        Arrow schema of the record batches
+        """
+        return self.plan.schema
 
-    def arrow_table(self, chunk_size, event_limit=sys.maxint):
+    def record_batch(self, chunk):
+        """
+        Assemble a RecordBatch directly from the offsets and content buffers
+        of a chunk produced by XAODEvents.iterate_columnar
+        :param chunk: Dict of offsets and content arrays keyed by branch name
+        :return: pyarrow RecordBatch with one list column per attribute
+        """
+        # Attributes of a plan nobody has typed take the type of their buffer
+        for accessor in self.plan.accessors:
+            values = chunk[accessor.collection]['content'][accessor.key]
+            if accessor.arrow_type is None and len(values):
+                accessor.arrow_type = pa.from_numpy_dtype(values.dtype)
+
+        schema = self.schema
+        offsets = {}
+        arrays = []
+        for accessor in self.plan.accessors:
+            branch = chunk[accessor.collection]
+            if accessor.collection not in offsets:
+                offsets[accessor.collection] = pa.array(branch['offsets'], type=pa.int32())
+            values = pa.array(branch['content'][accessor.key], type=accessor.arrow_type)
+            arrays.append(pa.ListArray.from_arrays(offsets[accessor.collection], values))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def arrow_batches(self, chunk_size, event_limit=None):
+        """
+        Generate RecordBatches from columnar chunks of events, without going
+        through awkward arrays
+        :param chunk_size: Number of events to include in each batch, or a
+            function returning the size of the next batch
+        :param event_limit: Max number of events to process
+        :return: Yields pyarrow RecordBatches
+        """
+        for chunk in self.event_iterator.iterate_columnar(chunk_size, event_limit):
+            yield self.record_batch(chunk)
+
+    def arrow_table(self, chunk_size, event_limit=None):
 
         def group(iterator, n):
             """
@@ -47,7 +118,7 @@ class XAODTransformer:
                 results = []
                 try:
                     for i in range(n):
-                        results.append(iterator.next())
+                        results.append(next(iterator))
                     yield results
                 except StopIteration:
                     done = True
@@ -56,12 +127,9 @@ class XAODTransformer:
         for events in group(self.event_iterator.iterate(event_limit), chunk_size):
             object_array = awkward.fromiter(events)
             attr_dict = {}
-            for attr_name in self.event_iterator.attr_name_list:
-                branch_name = attr_name.split('.')[0].strip(' ')
-                a_name = attr_name.split('.')[1]
-
-                attr_dict[branch_name + '_' + a_name.strip('()')] = \
-                    object_array[branch_name][a_name]
+            for accessor in self.plan.accessors:
+                attr_dict[accessor.column_name] = \
+                    object_array[accessor.collection][accessor.key]
 
             object_table = awkward.Table(**attr_dict)
             yield awkward.toarrow(object_table)
@@ -1,21 +1,40 @@
 #!/usr/bin/env python
 from __future__ import division
 
-from servicex.transformer.kafka_messaging import KafkaMessaging
+from servicex.transformer.accessor_plan import split_attr_names
+from servicex.transformer.chunk_planner import ChunkPlanner
+from servicex.transformer.fan_out import FanOut, Sink, SinkError
+from servicex.transformer.file_stager import FileStager
+from servicex.transformer.kafka_messaging import KafkaMessaging, PARTITIONERS
+from servicex.transformer.memory_governor import MemoryGovernor, sizeof
+from servicex.transformer.metrics import FileTimer, TransformMetrics, clear_textfiles, \
+    serve_metrics
 from servicex.transformer.object_store_manager import ObjectStoreManager
-from servicex.transformer.xaod_events import XAODEvents
+from servicex.transformer.parallel_transform import ParallelTransform
+from servicex.transformer.pipeline import Pipeline
+from servicex.transformer.profiling import SamplingProfiler, save_profile, should_profile
+from servicex.transformer.redis_messaging import RedisMessaging
+from servicex.transformer.result_cache import LocalResultCache, ObjectStoreResultCache, \
+    hash_directory, input_identity, result_cache_key
+from servicex.transformer.serialization import BatchSerializer, format_names
+from servicex.transformer.transform_worker_pool import TransformWorkerPool, defer_settle
+from servicex.transformer.warmup import preload_xaod, signal_ready
+from servicex.transformer.xaod_events import TreeCacheConfig, XAODEvents
 from servicex.transformer.xaod_transformer import XAODTransformer
 
 import pika
 import pyarrow as pa
-import pyarrow.parquet as pq
 
 import requests
 import argparse
+import contextlib
 import datetime
-import json
 import os
 import sys
+import tempfile
+import time
+
+RESULT_DESTINATIONS = ['kafka', 'redis', 'object-store']
 
 # Use for default kafka backends
 default_brokerlist = "servicex-kafka-0.slateci.net:19092, " \
@@ -33,7 +52,8 @@ def post_status_update(endpoint, status_msg):
 
 def put_file_complete(endpoint, file_path, file_id, status,
                       num_messages=None, total_time=None, total_events=None,
-                      total_bytes=None):
+                      total_bytes=None, stage_times=None, cache_stats=None, cached=False,
+                      memory_stats=None, sinks=None):
     'Post back that we have finished processing a file.'
     avg_rate = 0 if not total_time else total_events/total_time
     doc = {
@@ -44,105 +64,554 @@ def put_file_complete(endpoint, file_path, file_id, status,
         "total-time": total_time,
         "total-events": total_events,
         "total-bytes": total_bytes,
-        "avg-rate": avg_rate
+        "avg-rate": avg_rate,
+        "stage-times": stage_times,
+        "cache-stats": cache_stats,
+        "cached": cached,
+        "memory": memory_stats,
+        "sinks": sinks
     }
     print("------< ", doc)
     if endpoint:
         requests.put(endpoint+"/file-complete", json=doc)
 
 
-def write_branches_to_arrow(messaging, topic_name, file_path, file_id, attr_name_list,
-                            chunk_size, server_endpoint, event_limit=None,
-                            object_store=None):
+def _open_result_writer(result_format, sink, schema):
+    if result_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(sink, schema)
+    return pa.RecordBatchStreamWriter(sink, schema)
+
+
+def _open_result_stream(result_format, object_store, bucket, object_name, schema):
+    'Open a writer that streams tables into a multipart upload'
+    result_stream = object_store.open_upload_stream(bucket, object_name)
+    sink = pa.PythonFile(result_stream, mode='w')
+    return result_stream, _open_result_writer(result_format, sink, schema)
+
+
+def _read_result_batches(path, result_format):
+    if result_format == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches():
+            yield batch
+    else:
+        for batch in pa.ipc.open_stream(pa.OSFile(path)):
+            yield batch
 
-    scratch_writer = None
 
-    event_iterator = XAODEvents(file_path, attr_name_list)
-    transformer = XAODTransformer(event_iterator)
+def publish_cached_result(cached_path, metadata, messaging, topic_name, file_path, file_id,
+                          server_endpoint, object_store, max_message_size, timer, serializer):
+    'Send on a result from the result cache, without opening the input file'
+    print("Result cache hit for " + file_path)
+
+    sinks = {}
+    if object_store:
+        with timer.time('upload'):
+            object_store.upload_file_async(args.request_id, file_path.replace('/', ':'),
+                                           cached_path).result()
+        sinks['object-store'] = {"status": "success", "messages": 1,
+                                 "bytes": os.path.getsize(cached_path)}
 
     batch_number = 0
-    total_events = 0
     total_bytes = 0
-    for pa_table in transformer.arrow_table(chunk_size, event_limit):
-        if object_store:
-            if not scratch_writer:
-                scratch_writer = _open_scratch_file(args.result_format, pa_table)
-            _append_table_to_scratch(args.result_format, scratch_writer, pa_table)
-
-        total_events = total_events + pa_table.num_rows
-        batches = pa_table.to_batches(chunksize=chunk_size)
-
-        for batch in batches:
-            if messaging:
-                key = file_path + "-" + str(batch_number)
-
-                sink = pa.BufferOutputStream()
-                writer = pa.RecordBatchStreamWriter(sink, batch.schema)
-                writer.write_batch(batch)
-                writer.close()
-                messaging.publish_message(
-                    topic_name,
-                    key,
-                    sink.getvalue())
-
-                total_bytes = total_bytes + len(sink.getvalue().to_pybytes())
-
-                avg_cell_size = len(sink.getvalue().to_pybytes()) / len(
-                    attr_name_list) / batch.num_rows
-                print("Batch number " + str(batch_number) + ", "
-                      + str(batch.num_rows) +
-                      " events published to " + topic_name,
-                      "Avg Cell Size = " + str(avg_cell_size) + " bytes")
-                batch_number += 1
+    if messaging:
+        chunk_planner = ChunkPlanner(int(max_message_size * 1e6), adaptive=False)
+        with timer.time('publish'):
+            for batch in _read_result_batches(cached_path, args.result_format):
+                for _, buffer in chunk_planner.fit(batch, serializer.serialize,
+                                                   serializer.release):
+                    messaging.publish_message(topic_name, file_path + "-" + str(batch_number),
+                                              buffer)
+                    total_bytes = total_bytes + buffer.size
+                    batch_number += 1
+                    serializer.release(buffer, reuse=not messaging.retains_payload)
+            messaging.flush()
+        sinks[messaging.name] = {"status": "success", "messages": batch_number,
+                                 "bytes": total_bytes}
 
+    if server_endpoint:
+        post_status_update(server_endpoint, "File " + file_path + " complete")
+    put_file_complete(server_endpoint, file_path, file_id, "success",
+                      num_messages=batch_number, total_time=timer.elapsed(),
+                      total_events=metadata['total-events'], total_bytes=total_bytes,
+                      stage_times=timer.as_dict(), cached=True, sinks=sinks)
+
+    metrics.observe_file(topic_name, timer, events=metadata['total-events'],
+                         n_bytes=total_bytes, messages=batch_number)
+    metrics.write_textfile()
+
+
+def write_branches_to_arrow(messaging, topic_name, file_path, file_id, attr_name_list,
+                            chunk_size, server_endpoint, event_limit=None,
+                            object_store=None, max_message_size=14.5, queue_depth=2,
+                            workers=1, cache_config=None, input_path=None,
+                            result_cache=None, cache_key=None, memory_governor=None,
+                            serializer=None, sink_queue_depth=4):
+
+    timer = FileTimer()
+    serializer = serializer or BatchSerializer()
+
+    # Without a ceiling the governor only tracks usage for the report
+    memory = memory_governor or MemoryGovernor()
+    memory.start_file()
+    result_stream = None
+    result_writer = None
+
+    if messaging and getattr(messaging, 'max_message_size', None):
+        max_message_size = messaging.max_message_size
+
+    # Identical requests for the same input are answered from the cache
+    cache_path = None
+    cache_sink = None
+    cache_writer = None
+    if result_cache and cache_key:
+        cache_fd, cache_path = tempfile.mkstemp(suffix='.' + args.result_format)
+        os.close(cache_fd)
+        with timer.time('result-cache'):
+            metadata = result_cache.get(cache_key, cache_path)
+        if metadata is not None:
+            metrics.inc(topic_name, 'result_cache_hits')
+            try:
+                publish_cached_result(cache_path, metadata, messaging, topic_name, file_path,
+                                      file_id, server_endpoint, object_store,
+                                      max_message_size, timer, serializer)
+            finally:
+                os.remove(cache_path)
+            return
+        metrics.inc(topic_name, 'result_cache_misses')
+
+    # Without an explicit chunk size, learn the bytes per event and size each
+    # chunk to fill a message. Oversized batches are always split.
+    chunk_planner = ChunkPlanner(int(max_message_size * 1e6), chunk_size,
+                                 adaptive=not chunk_size)
+
+    batch_number = 0
+    total_events = 0
+    total_bytes = 0
+    cache_stats = None
+
+    def next_chunk_size():
+        return memory.chunk_size(chunk_planner.next_chunk_size())
+
+    def serialized_size(serialized):
+        batch, pieces = serialized
+        return batch.nbytes + sum(buffer.size for _, buffer in pieces)
+
+    def convert(chunk):
+        batch = transformer.record_batch(chunk)
+        memory.remove(sizeof(chunk))
+        memory.add(batch.nbytes)
+        return batch
+
+    def serialize(batch):
+        if not messaging:
+            # Nothing is serialized for the object store alone. Learn from the
+            # batch's Arrow size instead, so its row groups still grow to fill
+            # a message's worth of events
+            chunk_planner.record(batch.num_rows, batch.nbytes)
+            return batch, []
+        pieces = list(chunk_planner.fit(batch, serializer.serialize, serializer.release))
+        memory.add(sum(buffer.size for _, buffer in pieces))
+        return batch, pieces
+
+    def release(serialized):
+        memory.remove(serialized_size(serialized))
+        # Each payload was published straight from its pooled buffer
+        for _, buffer in serialized[1]:
+            serializer.release(buffer, reuse=not messaging.retains_payload)
+
+    def publish(serialized):
+        nonlocal total_events, cache_sink, cache_writer
+        batch, pieces = serialized
+
+        if cache_path:
+            if not cache_writer:
+                cache_sink = pa.OSFile(cache_path, 'wb')
+                cache_writer = _open_result_writer(args.result_format, cache_sink,
+                                                   batch.schema)
+            cache_writer.write_table(pa.Table.from_batches([batch]))
+
+        total_events = total_events + batch.num_rows
+        fan_out.publish(serialized)
+
+    def write_result(serialized):
+        nonlocal result_stream, result_writer
+        batch, _ = serialized
+
+        if not result_writer:
+            print("Writing " + args.result_format + " to ", args.request_id, " as ",
+                  file_path.replace('/', ':'))
+            result_stream, result_writer = _open_result_stream(
+                args.result_format, object_store, args.request_id,
+                file_path.replace('/', ':'), batch.schema)
+        start = result_stream.tell()
+        result_writer.write_table(pa.Table.from_batches([batch]))
+        return 1, result_stream.tell() - start
+
+    def close_result():
+        if result_writer:
+            start = result_stream.tell()
+            result_writer.close()
+            return 0, result_stream.tell() - start
+
+    def publish_messages(serialized):
+        nonlocal batch_number, total_bytes
+        n_bytes = 0
+        for piece, buffer in serialized[1]:
+            key = file_path + "-" + str(batch_number)
+
+            messaging.publish_message(
+                topic_name,
+                key,
+                buffer)
+
+            n_bytes = n_bytes + buffer.size
+
+            avg_cell_size = buffer.size / len(attr_name_list) / piece.num_rows
+            print("Batch number " + str(batch_number) + ", "
+                  + str(piece.num_rows) +
+                  " events published to " + topic_name,
+                  "Avg Cell Size = " + str(avg_cell_size) + " bytes")
+            batch_number += 1
+        total_bytes = total_bytes + n_bytes
+        return len(serialized[1]), n_bytes
+
+    # Every destination gets each batch at the same time, from its own queue,
+    # so a slow one doesn't hold up the others
+    sinks = []
     if object_store:
-        _close_scratch_file(args.result_format, scratch_writer)
-        print("Writing parquet to ", args.request_id, " as ", file_path.replace('/', ':'))
-        object_store.upload_file(args.request_id, file_path.replace('/', ':'), "/tmp/out")
-        os.remove("/tmp/out")
+        sinks.append(Sink('object-store', write_result, close_result,
+                          queue_depth=sink_queue_depth))
+    if messaging:
+        # Wait once per file for every queued message to reach the brokers
+        sinks.append(Sink(messaging.name, publish_messages, messaging.flush,
+                          queue_depth=sink_queue_depth))
+    fan_out = FanOut(sinks, on_done=release)
+
+    if workers > 1:
+        # Entry ranges are read, converted and serialized in worker processes
+        # and come back in entry order, so batch keys stay reproducible
+        parallel = ParallelTransform(input_path or file_path, attr_name_list, workers,
+                                     chunk_size=chunk_size,
+                                     max_message_size=max_message_size,
+                                     cache_config=cache_config,
+                                     message_format=serializer.message_format)
+        pipeline = Pipeline(memory.throttle(parallel.iterate(event_limit), serialized_size),
+                            [('publish', publish)],
+                            queue_depth=queue_depth)
+    else:
+        event_iterator = XAODEvents(input_path or file_path, attr_name_list,
+                                    cache_config=cache_config)
+        timer.add('open', event_iterator.open_time)
+        timer.add('make-transient-tree', event_iterator.make_transient_tree_time)
+        transformer = XAODTransformer(event_iterator)
+
+        # ROOT reads, Arrow conversion, serialization and publishing each run on
+        # their own thread so network and compression time hide behind I/O
+        pipeline = Pipeline(
+            memory.throttle(event_iterator.iterate_columnar(next_chunk_size, event_limit)),
+            [('convert', convert),
+             ('serialize', serialize),
+             ('publish', publish)],
+            queue_depth=queue_depth)
+
+    def abandon_results():
+        # Fail the partial upload, so it doesn't hold an upload worker waiting
+        # for parts that will never come
+        if result_stream:
+            result_stream.abort()
+        if cache_path:
+            os.remove(cache_path)
+
+    try:
+        pipeline.run()
+    except Exception:
+        fan_out.close(abort=True)
+        abandon_results()
+        raise
+
+    fan_out.close()
+    sinks_report = fan_out.report()
+    if messaging:
+        # How evenly the file's batches spread over the topic's partitions
+        sinks_report[messaging.name].update(messaging.delivery_report(topic_name))
+    print("Sinks: ", sinks_report)
+    for name, report in sinks_report.items():
+        timer.add(name, report['busy-time'])
+    try:
+        fan_out.check()
+    except SinkError:
+        abandon_results()
+        raise
+
+    print("Pipeline stages: ", pipeline.report())
+    print("Pipeline bottleneck: ", pipeline.bottleneck())
+    for stage_name, stats in pipeline.report().items():
+        timer.add(stage_name, stats['busy-time'])
+
+    # Each worker process has its own file when transforming in parallel
+    if workers <= 1:
+        cache_stats = event_iterator.cache_stats()
+        print("Read stats: ", cache_stats)
 
     print("===> Total Events ", total_events)
     print("===> Total Bytes ", total_bytes)
 
-    if server_endpoint:
-        post_status_update(server_endpoint, "File " + file_path + " complete")
+    memory_stats = memory.report()
+    print("Memory: ", memory_stats)
+
+    if cache_writer:
+        cache_writer.close()
+        cache_sink.close()
+
+    def cache_result():
+        if cache_writer:
+            with timer.time('result-cache'):
+                result_cache.put(cache_key, cache_path, {
+                    'file-path': file_path,
+                    'total-events': total_events,
+                    'num-messages': batch_number,
+                    'total-bytes': total_bytes
+                })
+        if cache_path:
+            os.remove(cache_path)
+
+    def report_complete():
+        cache_result()
+        if server_endpoint:
+            post_status_update(server_endpoint, "File " + file_path + " complete")
+
+        put_file_complete(server_endpoint, file_path, file_id, "success",
+                          num_messages=batch_number, total_time=timer.elapsed(),
+                          total_events=total_events, total_bytes=total_bytes,
+                          stage_times=timer.as_dict(), cache_stats=cache_stats,
+                          memory_stats=memory_stats, sinks=sinks_report)
+
+        metrics.observe_file(topic_name, timer, events=total_events,
+                             n_bytes=total_bytes, messages=batch_number)
+        metrics.set_gauge('peak_rss_bytes', memory_stats['peak-rss'],
+                          'Peak RSS while transforming the last file')
+        metrics.write_textfile()
+
+    # The upload has been running alongside the transform. Let the worker move
+    # on to the next file while it finishes, and hold back the ack and the
+    # completion report until it has succeeded
+    if result_writer:
+        upload_start = time.time()
+        upload = result_stream.finish()
+
+        def upload_done(done):
+            # Only the part of the upload that outlasted the transform
+            timer.add('upload', time.time() - upload_start)
+            if done.exception() is None:
+                report_complete()
+            else:
+                if cache_path:
+                    os.remove(cache_path)
+                sinks_report['object-store'].update(status="failure",
+                                                    error=str(done.exception()))
+                put_file_complete(server_endpoint, file_path, file_id, "failure", 0, 0.0,
+                                  sinks=sinks_report)
+                metrics.inc(topic_name, 'failures')
+                metrics.write_textfile()
+
+        upload.add_done_callback(upload_done)
+        defer_settle(upload)
+    else:
+        report_complete()
+
+
+@contextlib.contextmanager
+def profile_file(request_id, file_path):
+    'Profile a sample of files, saving the stacks next to the results'
+    profile_requests = args.profile_requests.split(',') if args.profile_requests else ()
+    if not should_profile(request_id, file_path, args.profile_sample_rate, profile_requests):
+        yield
+        return
+
+    profiler = SamplingProfiler(args.profile_interval / 1000.0)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        print("Profile of " + file_path + " saved to ",
+              save_profile(profiler, file_path.replace('/', ':'), object_store,
+                           request_id, args.profile_dir))
+
+
+def request_columns(transform_request):
+    'Attributes to extract, named in the request or else on the command line'
+    return split_attr_names(transform_request.get('columns') or args.attrs)
+
+
+def tree_cache_config(args):
+    'TTreeCache settings from the command line, or None to leave the cache alone'
+    if not args.tree_cache_size:
+        return None
+    return TreeCacheConfig(cache_size=int(args.tree_cache_size * 1024 * 1024),
+                           learn_entries=args.tree_cache_learn_entries,
+                           async_prefetch=args.tree_cache_prefetch)
 
-    put_file_complete(server_endpoint, file_path, file_id, "success",
-                      num_messages=batch_number, total_time="??",
-                      total_events=total_events, total_bytes=total_bytes)
 
+def request_cache_key(transform_request, attr_name_list):
+    'Result cache key for a transform request, or None without a result cache'
+    if not result_cache:
+        return None
+    return result_cache_key(
+        input_identity(transform_request['file-path'], transform_request.get('file-checksum')),
+        attr_name_list, args.result_format, code_hash)
 
 
-def presetup():
+def presetup(args):
     'Called for setup before things start going'
+    timings = {}
 
-def callback(channel, method, properties, body):
-    transform_request = json.loads(body)
+    # Load xAOD and the dictionaries of the classes read, and pay for the
+    # first transient tree, so none of it lands on the first file
+    if args.preload_classes or args.warmup_file:
+        timings.update(preload_xaod(args.preload_classes, args.warmup_file))
+
+    return timings
+
+
+def transform_file(transform_request):
+    'Transform one file. Reports failure to the server and re-raises'
     _request_id = transform_request['request-id']
     _file_path = transform_request['file-path']
     _file_id = transform_request['file-id']
     _server_endpoint = transform_request['service-endpoint']
 
-    print(f'Processing {_file_path}')
+    # Local copy of the input when it has been staged
+    _input_path = transform_request.get('local-file-path', _file_path)
+    _columns = request_columns(transform_request)
+
     try:
-        result_root_file = write_root_file(file_path=_file_path)
-        # write_branches_to_arrow(messaging=messaging, topic_name=_request_id,
-        #                         file_path=_file_path, file_id=_file_id,
-        #                         attr_name_list=columns,
-        #                         chunk_size=chunk_size, server_endpoint=_server_endpoint,
-        #                         object_store=object_store)
+        with profile_file(_request_id, _file_path):
+            write_branches_to_arrow(messaging=messaging, topic_name=_request_id,
+                                    file_path=_file_path, file_id=_file_id,
+                                    attr_name_list=_columns,
+                                    chunk_size=args.chunks, server_endpoint=_server_endpoint,
+                                    object_store=object_store,
+                                    max_message_size=args.max_message_size,
+                                    queue_depth=args.queue_depth, workers=args.workers,
+                                    cache_config=tree_cache_config(args),
+                                    input_path=_input_path,
+                                    result_cache=result_cache,
+                                    cache_key=request_cache_key(transform_request, _columns),
+                                    memory_governor=memory_governor,
+                                    serializer=batch_serializer,
+                                    sink_queue_depth=args.sink_queue_depth)
     except Exception as error:
-        transform_request['error'] = str(error)
-        channel.basic_publish(exchange='transformation_failures',
-                              routing_key=_request_id + '_errors',
-                              body=json.dumps(transform_request))
+        # Sinks that did succeed are reported along with the one that failed
+        sinks = error.report if isinstance(error, SinkError) else None
         put_file_complete(_server_endpoint, _file_path, _file_id,
-                          "failure", 0, 0.0)
-    finally:
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+                          "failure", 0, 0.0, sinks=sinks)
+        metrics.inc(_request_id, 'failures')
+        metrics.write_textfile()
+        raise
+
+
+def result_destinations(value):
+    'Parse a comma separated list of result destinations'
+    destinations = [destination.strip() for destination in value.split(',')
+                    if destination.strip()]
+    if not destinations:
+        raise argparse.ArgumentTypeError("No result destination given")
+    for destination in destinations:
+        if destination not in RESULT_DESTINATIONS:
+            raise argparse.ArgumentTypeError("Unknown result destination " + destination +
+                                             ", choose from " +
+                                             ", ".join(RESULT_DESTINATIONS))
+    if 'kafka' in destinations and 'redis' in destinations:
+        raise argparse.ArgumentTypeError("Choose one of kafka or redis")
+    return destinations
+
+
+def create_backends(args):
+    'Connect to the result destinations. Called again in each worker process'
+    global messaging, object_store
+
+    messaging = None
+    object_store = None
+
+    if 'kafka' in args.result_destination:
+        messaging = KafkaMessaging([broker.strip() for broker in args.brokerlist.split(',')],
+                                   args.max_message_size,
+                                   async_publish=args.kafka_async,
+                                   compression=args.kafka_compression,
+                                   linger_ms=args.kafka_linger_ms,
+                                   batch_size=args.kafka_batch_size,
+                                   max_in_flight=args.kafka_max_in_flight,
+                                   partitioner=args.kafka_partitioner,
+                                   topic_partitions=args.kafka_partitions,
+                                   replication_factor=args.kafka_replication_factor)
+
+    if 'redis' in args.result_destination:
+        redis_endpoints = None
+        if args.redis_endpoints:
+            redis_endpoints = [(endpoint.strip().split(':')[0],
+                                int(endpoint.strip().split(':')[1]))
+                               for endpoint in args.redis_endpoints.split(',')]
+        messaging = RedisMessaging(args.redis_host, args.redis_port,
+                                   codec=args.redis_codec,
+                                   maxlen=args.redis_maxlen,
+                                   shards=args.redis_shards,
+                                   endpoints=redis_endpoints)
+
+    if 'object-store' in args.result_destination:
+        object_store = ObjectStoreManager(os.environ['MINIO_URL'],
+                                          os.environ['MINIO_ACCESS_KEY'],
+                                          os.environ['MINIO_SECRET_KEY'],
+                                          upload_workers=args.upload_workers,
+                                          parallel_part_uploads=args.parallel_part_uploads)
+        print("Object store initialized to ", object_store.minio_client)
+
+
+def create_result_cache(args):
+    'Result cache shared through the object store, or in a local directory'
+    global result_cache, code_hash
+
+    result_cache = None
+    code_hash = hash_directory(args.code_path)
+    max_bytes = int(args.result_cache_size * 1e9)
+
+    if args.result_cache_bucket:
+        cache_store = object_store or ObjectStoreManager(os.environ['MINIO_URL'],
+                                                         os.environ['MINIO_ACCESS_KEY'],
+                                                         os.environ['MINIO_SECRET_KEY'])
+        result_cache = ObjectStoreResultCache(cache_store, args.result_cache_bucket, max_bytes)
+    elif args.result_cache_dir:
+        result_cache = LocalResultCache(args.result_cache_dir, max_bytes)
+
+
+def warm_up_backends(args):
+    'Open the backend connections now, so the first file does not wait on them'
+    try:
+        if messaging:
+            messaging.warm_up(args.request_id)
+        if object_store:
+            object_store.warm_up(args.request_id)
+    except Exception as eek:
+        print("Failed to warm up backends: " + str(eek))
+
+
+def init_worker(args):
+    'Set up the backends and metrics of a process that transforms files'
+    global metrics, memory_governor, batch_serializer
+
+    create_backends(args)
+    create_result_cache(args)
+    warm_up_backends(args)
+    metrics = TransformMetrics(args.metrics_dir)
+    memory_governor = MemoryGovernor(int(args.memory_limit * 1e6) if args.memory_limit else None,
+                                     soft_fraction=args.memory_soft_fraction)
+    batch_serializer = BatchSerializer(args.message_format)
 
 
 if __name__ == "__main__":
+    process_start = time.time()
 
     parser = argparse.ArgumentParser(
         description='Transform xAOD files into flat n-tuples.')
@@ -152,16 +621,184 @@ if __name__ == "__main__":
     #                     help='Max number of events to process')
 
     parser.add_argument('--result-destination', dest='result_destination', action='store',
-                        default='object-store', help='object-store is the only thing available at this time',
-                        choices=['object-store'])
+                        type=result_destinations, default='object-store',
+                        help='Comma separated: kafka or redis, and object-store')
 
     parser.add_argument('--result-format', dest='result_format', action='store',
                         default='arrow', help='arrow, parquet', choices=['arrow', 'parquet'])
 
+    parser.add_argument('--message-format', dest='message_format', action='store',
+                        default='arrow', choices=format_names(),
+                        help='Format of the batches published to kafka or redis')
+
     parser.add_argument("--dataset", dest='dataset', action='store',
                         default=None,
                         help='JSON Dataset document from DID Finder')
 
+    parser.add_argument("--attrs", dest='attrs', action='store',
+                        default='Electrons.pt(), Electrons.eta(), Electrons.phi(), '
+                                'Electrons.e()',
+                        help='Comma separated attributes to extract, for requests that '
+                             'do not list their columns')
+
+    parser.add_argument("--chunks", dest='chunks', action='store', type=int,
+                        default=None,
+                        help='Number of events to include in each message. If omitted, '
+                             'sized to fill the max message size')
+
+    parser.add_argument("--max-message-size", dest='max_message_size', action='store',
+                        type=float, default=14.5,
+                        help='Maximum size for any message in Megabytes')
+
+    parser.add_argument("--queue-depth", dest='queue_depth', action='store', type=int,
+                        default=2,
+                        help='Max chunks waiting between each stage of the transform pipeline')
+
+    parser.add_argument("--workers", dest='workers', action='store', type=int,
+                        default=1,
+                        help='Processes used to transform each file, each reading its own '
+                             'range of entries. Capped at the CPU limit of the container')
+
+    parser.add_argument("--tree-cache-size", dest='tree_cache_size', action='store',
+                        type=float, default=100,
+                        help='TTreeCache size in Megabytes. 0 to read without a cache')
+
+    parser.add_argument("--tree-cache-learn-entries", dest='tree_cache_learn_entries',
+                        action='store', type=int, default=0,
+                        help='Entries the TTreeCache learns used branches from. 0 to cache '
+                             'just the selected branches and EventInfo')
+
+    parser.add_argument("--tree-cache-prefetch", dest='tree_cache_prefetch',
+                        action='store_true', default=False,
+                        help='Prefetch the next TTreeCache block in the background')
+
+    parser.add_argument("--scratch-dir", dest='scratch_dir', action='store', default=None,
+                        help='Local directory to stage input files into before they are '
+                             'transformed. Files are read remotely if omitted')
+
+    parser.add_argument("--scratch-budget", dest='scratch_budget', action='store',
+                        type=float, default=50,
+                        help='Gigabytes of staged input files kept on local disk')
+
+    parser.add_argument("--stage-ahead", dest='stage_ahead', action='store', type=int,
+                        default=1,
+                        help='Queued files staged while earlier files are transformed')
+
+    parser.add_argument("--max-files-in-flight", dest='max_files_in_flight', action='store',
+                        type=int, default=1,
+                        help='Number of files from the queue transformed at the same time')
+
+    parser.add_argument("--upload-workers", dest='upload_workers', action='store',
+                        type=int, default=2,
+                        help='Object store uploads running at the same time in each worker')
+
+    parser.add_argument("--parallel-part-uploads", dest='parallel_part_uploads',
+                        action='store', type=int, default=3,
+                        help='Parts of each multipart upload sent at the same time')
+
+    parser.add_argument("--max-pending-uploads", dest='max_pending_uploads', action='store',
+                        type=int, default=1,
+                        help='Files whose upload may still be finishing while the next '
+                             'file is transformed. Their messages are acked once uploaded')
+
+    parser.add_argument("--brokerlist", dest='brokerlist', action='store',
+                        default=default_brokerlist,
+                        help='List of Kafka broker to connect to')
+
+    parser.add_argument("--kafka-async", dest='kafka_async', action='store_true',
+                        default=False,
+                        help='Publish to Kafka without waiting for each message to be '
+                             'delivered. Delivery is confirmed once per file')
+
+    parser.add_argument("--kafka-compression", dest='kafka_compression', action='store',
+                        default=None, choices=['lz4', 'zstd', 'gzip', 'snappy'],
+                        help='Kafka producer compression codec')
+
+    parser.add_argument("--kafka-linger-ms", dest='kafka_linger_ms', action='store',
+                        type=int, default=0,
+                        help='Time the Kafka producer waits to fill a batch')
+
+    parser.add_argument("--kafka-batch-size", dest='kafka_batch_size', action='store',
+                        type=int, default=16384,
+                        help='Kafka producer batch size in bytes')
+
+    parser.add_argument("--kafka-max-in-flight", dest='kafka_max_in_flight', action='store',
+                        type=int, default=1000,
+                        help='Most undelivered messages allowed when publishing async')
+
+    parser.add_argument("--kafka-partitioner", dest='kafka_partitioner', action='store',
+                        default='hash', choices=PARTITIONERS,
+                        help='Spread batches over the topic partitions by key hash, '
+                             'in turn or by bytes sent')
+
+    parser.add_argument("--kafka-partitions", dest='kafka_partitions', action='store',
+                        type=int, default=None,
+                        help='Create the topic, or grow it, to this many partitions '
+                             'when the brokers allow it')
+
+    parser.add_argument("--kafka-replication-factor", dest='kafka_replication_factor',
+                        action='store', type=int, default=1,
+                        help='Replicas of a topic created with --kafka-partitions')
+
+    parser.add_argument("--redis-host", dest='redis_host', action='store',
+                        default='redis.slateci.net', help='Redis host to publish to')
+
+    parser.add_argument("--redis-port", dest='redis_port', action='store', type=int,
+                        default=6379, help='Redis port')
+
+    parser.add_argument("--redis-codec", dest='redis_codec', action='store',
+                        default='lz4', choices=['none', 'lz4', 'zstd', 'bz2'],
+                        help='Compression applied to each Redis message')
+
+    parser.add_argument("--redis-maxlen", dest='redis_maxlen', action='store', type=int,
+                        default=None,
+                        help='Approximate length Redis streams are trimmed to')
+
+    parser.add_argument("--redis-shards", dest='redis_shards', action='store', type=int,
+                        default=1,
+                        help='Number of Redis streams each request is spread over')
+
+    parser.add_argument("--redis-endpoints", dest='redis_endpoints', action='store',
+                        default=None,
+                        help='Comma separated host:port list to spread Redis shards over')
+
+    parser.add_argument("--result-cache-bucket", dest='result_cache_bucket', action='store',
+                        default=None,
+                        help='Object store bucket to cache results in, so identical '
+                             'requests for the same file are not transformed again')
+
+    parser.add_argument("--result-cache-dir", dest='result_cache_dir', action='store',
+                        default=None,
+                        help='Local directory to cache results in instead of a bucket')
+
+    parser.add_argument("--result-cache-size", dest='result_cache_size', action='store',
+                        type=float, default=100,
+                        help='Gigabytes of cached results kept before the least recently '
+                             'used are evicted')
+
+    parser.add_argument("--metrics-dir", dest='metrics_dir', action='store', default=None,
+                        help='Directory each process writes Prometheus textfile metrics to')
+
+    parser.add_argument("--metrics-port", dest='metrics_port', action='store', type=int,
+                        default=None,
+                        help='Port to serve Prometheus metrics on, from all processes')
+
+    parser.add_argument("--profile-sample-rate", dest='profile_sample_rate', action='store',
+                        type=float, default=0.0,
+                        help='Fraction of files to run under the sampling profiler')
+
+    parser.add_argument("--profile-requests", dest='profile_requests', action='store',
+                        default=None,
+                        help='Comma separated request ids to profile every file of')
+
+    parser.add_argument("--profile-interval", dest='profile_interval', action='store',
+                        type=float, default=10.0,
+                        help='Milliseconds between profiler samples')
+
+    parser.add_argument("--profile-dir", dest='profile_dir', action='store', default=None,
+                        help='Local directory for profiles when not writing to the '
+                             'object store')
+
     parser.add_argument('--rabbit-uri', dest="rabbit_uri", action='store',
                         default='host.docker.internal')
 
@@ -171,33 +808,96 @@ if __name__ == "__main__":
     parser.add_argument('--code-path', dest="code_path", action='store', default='/code',
                         help='Path where the 6 files have been written containing the code that is to be compiled and run.')
 
+    parser.add_argument('--sink-queue-depth', dest='sink_queue_depth', action='store',
+                        type=int, default=4,
+                        help='Batches each result destination may fall behind the others')
+
+    parser.add_argument('--memory-limit', dest='memory_limit', type=float, action='store',
+                        default=None,
+                        help='RSS ceiling for each transform process in Megabytes')
+
+    parser.add_argument('--memory-soft-fraction', dest='memory_soft_fraction', type=float,
+                        action='store', default=0.8,
+                        help='Fraction of the memory limit where chunks shrink and reads pause')
+
+    parser.add_argument('--preload-classes', dest='preload_classes', action='store',
+                        default='',
+                        help='Comma separated xAOD classes to load dictionaries for at startup')
+
+    parser.add_argument('--warmup-file', dest='warmup_file', action='store',
+                        default=None,
+                        help='Small xAOD file opened at startup to build the first transient tree')
+
+    parser.add_argument('--ready-file', dest='ready_file', action='store',
+                        default=None,
+                        help='File written once the transformer is ready, for a readiness probe')
+
     # Print help if no args are provided
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         parser.exit()
 
     args = parser.parse_args()
-
-    if args.result_destination == 'object-store':
-        object_store = ObjectStoreManager(os.environ['MINIO_URL'],
-                                          os.environ['MINIO_ACCESS_KEY'],
-                                          os.environ['MINIO_SECRET_KEY'])
-        print("Object store initialized to ", object_store.minio_client)
+    args.preload_classes = [name.strip() for name in args.preload_classes.split(',')
+                            if name.strip()]
+
+    if args.metrics_port and not args.metrics_dir:
+        args.metrics_dir = tempfile.mkdtemp(prefix='transformer-metrics-')
+    if args.metrics_dir:
+        clear_textfiles(args.metrics_dir)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port, args.metrics_dir)
+
+    # The parent only reports startup metrics. Backend clients are made by the
+    # workers' initializer, after the fork, since librdkafka and the pooled
+    # connections of the other clients can't be shared with a forked child
+    metrics = TransformMetrics(args.metrics_dir)
+
+    # Do pre-running setup. This is done before we have to start grabbing any files off the queue.
+    # Nothing would service heartbeats through a slow warm-up, so it runs before the RabbitMQ
+    # connection is opened
+    startup_timings = presetup(args)
+
+    # Next start picking files off the input queue. Transforms run in worker
+    # processes so the connection's I/O loop keeps serving heartbeats while a
+    # long file is processed. Each worker makes its own backend connections,
+    # since they don't survive a fork
+    stager = None
+    if args.scratch_dir:
+        stager = FileStager(args.scratch_dir, int(args.scratch_budget * 1e9))
+
+    def first_file_done(seconds):
+        metrics.set_gauge('first_file_seconds', seconds,
+                          'Seconds from process start until the first file was transformed')
+        metrics.write_textfile()
+
+    worker_pool = TransformWorkerPool(None, None, transform_file,
+                                      max_in_flight=args.max_files_in_flight,
+                                      max_deferred=args.max_pending_uploads,
+                                      stager=stager, stage_ahead=args.stage_ahead,
+                                      initializer=init_worker, initargs=(args,),
+                                      started_at=process_start,
+                                      on_first_file=first_file_done)
+
+    # Start the workers, which connect their backends, before reporting ready
+    start = time.time()
+    worker_pool.warm_up()
+    startup_timings['workers'] = time.time() - start
 
     # Get RabbitMQ set up 
     rabbitmq = pika.BlockingConnection(pika.URLParameters(args.rabbit_uri))
     _channel = rabbitmq.channel()
 
-    # Do pre-running setup. This is done before we have to start grabbing any files off the queue
-    presetup()
+    ready_seconds = time.time() - process_start
+    metrics.set_gauge('ready_seconds', ready_seconds,
+                      'Seconds from process start until ready to take files')
+    metrics.write_textfile()
+    signal_ready(args.ready_file, {"ready-seconds": ready_seconds,
+                                   "startup-times": startup_timings})
+    worker_pool.start(args.request_id, rabbitmq, _channel)
 
-    # Next start picking files off the input queue.
-    # Each operation is going to take a very long time (10-15 seconds or so), so don't
-    # prefetch anything.
-    _channel.basic_qos(prefetch_count=1)
-
-    _channel.basic_consume(queue=args.request_id,
-                            auto_ack=False,
-                            on_message_callback=callback)
     print("Atlas C++ xAOD Transformer")
-    _channel.start_consuming()
+    try:
+        _channel.start_consuming()
+    finally:
+        worker_pool.shutdown()